@@ -1,66 +1,395 @@
-from django.contrib import admin
-
-
-from legal_editions import models as edition_models
-
-
-class EditionsInline (admin.TabularInline):
-
+import operator
+
+from django.contrib import admin, messages
+from django.contrib.admin.options import IncorrectLookupParameters
+from django.contrib.admin.views.main import ChangeList, ORDER_VAR
+from django.core.cache import cache
+from django.core.exceptions import PermissionDenied
+from django.db.models.sql.datastructures import EmptyResultSet
+from django.db import connections, models
+from django.http import HttpResponse, HttpResponseBadRequest
+from django.utils import simplejson
+from django.utils.encoding import smart_str
+from django.utils.hashcompat import md5_constructor
+
+
+from legal_editions import commentaries, export, models as edition_models
+from legal_editions.widgets import ForeignKeySearchInput
+
+
+# Relations followed by the __unicode__ method of each model. They are
+# fetched with select_related wherever the admin displays these objects
+# (changelists, inline rows and foreign key dropdowns).
+UNICODE_SELECT_RELATED = {
+    edition_models.Commentary: ('user', 'edition__version__work'),
+    edition_models.Edition: ('version__work',),
+    edition_models.Hyperarchetype: ('edition__version__work',),
+    edition_models.Version: ('work',),
+    edition_models.Witness: ('manuscript', 'work'),
+    edition_models.WitnessTranscription: ('witness__manuscript',),
+}
+
+
+class SelectRelatedMixin (object):
+
+    """Fetches the related objects needed to display the rows of an admin
+    page and the choices of its foreign key dropdowns in the same
+    queries.
+
+    queryset_select_related lists the relations followed by the page
+    itself (list_display or inline rows), it defaults to the relations
+    used by the model's __unicode__."""
+
+    queryset_select_related = None
+
+    def get_queryset_select_related (self):
+        if self.queryset_select_related is None:
+            return UNICODE_SELECT_RELATED.get(self.model, ())
+        return self.queryset_select_related
+
+    def queryset (self, request):
+        qs = super(SelectRelatedMixin, self).queryset(request)
+        related = self.get_queryset_select_related()
+        if related:
+            qs = qs.select_related(*related)
+        return qs
+
+    def formfield_for_foreignkey (self, db_field, request=None, **kwargs):
+        related = UNICODE_SELECT_RELATED.get(db_field.rel.to)
+        if related and 'queryset' not in kwargs:
+            kwargs['queryset'] = db_field.rel.to._default_manager.using(
+                kwargs.get('using')).complex_filter(
+                db_field.rel.limit_choices_to).select_related(*related)
+        return super(SelectRelatedMixin, self).formfield_for_foreignkey(
+            db_field, request, **kwargs)
+
+
+# Number of results per page and cache timeout (in seconds) of the lookup
+# views.
+LOOKUP_PAGE_SIZE = 20
+LOOKUP_CACHE_TIMEOUT = 60
+
+
+class ForeignKeySearchMixin (SelectRelatedMixin):
+
+    """The foreign keys listed in autocomplete_fields use a search box
+    (widgets.ForeignKeySearchInput) instead of a <select> listing the
+    whole related table.
+
+    Each ModelAdmin also gets a JSON lookup view used by these search
+    boxes, at <changelist url>/lookup/?q=<terms>&page=<n>. It searches
+    the admin's search_fields and its results are cached for
+    LOOKUP_CACHE_TIMEOUT seconds."""
+
+    autocomplete_fields = ()
+
+    def formfield_for_foreignkey (self, db_field, request=None, **kwargs):
+        if db_field.name in self.autocomplete_fields:
+            kwargs['widget'] = ForeignKeySearchInput(
+                db_field.rel, UNICODE_SELECT_RELATED.get(db_field.rel.to, ()),
+                using=kwargs.get('using'))
+            # the choices are never listed
+            kwargs['queryset'] = db_field.rel.to._default_manager.using(
+                kwargs.get('using')).complex_filter(
+                db_field.rel.limit_choices_to)
+        return super(ForeignKeySearchMixin, self).formfield_for_foreignkey(
+            db_field, request, **kwargs)
+
+    def get_urls (self):
+        from django.conf.urls.defaults import patterns, url
+        info = self.model._meta.app_label, self.model._meta.module_name
+        urlpatterns = patterns(
+            '',
+            url(r'^lookup/$', self.admin_site.admin_view(self.lookup_view),
+                name='%s_%s_lookup' % info))
+        return urlpatterns + super(ForeignKeySearchMixin, self).get_urls()
+
+    def get_lookup_queryset (self, request, query):
+        qs = self.queryset(request)
+        for bit in query.split():
+            or_queries = []
+            for field_name in self.search_fields:
+                if field_name.startswith('^'):
+                    lookup = '%s__istartswith' % field_name[1:]
+                elif field_name.startswith('='):
+                    lookup = '%s__iexact' % field_name[1:]
+                else:
+                    lookup = '%s__icontains' % field_name
+                or_queries.append(models.Q(**{lookup: bit}))
+            if or_queries:
+                qs = qs.filter(reduce(operator.or_, or_queries))
+        return qs
+
+    def lookup_view (self, request):
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        query = request.GET.get('q', '').strip()
+        try:
+            page = max(int(request.GET.get('page', 1)), 1)
+        except ValueError:
+            page = 1
+        opts = self.model._meta
+        key = 'legal_editions:lookup:%s.%s:%s:%d' % (
+            opts.app_label, opts.module_name,
+            md5_constructor(query.encode('utf-8')).hexdigest(), page)
+        data = cache.get(key)
+        if data is None:
+            start = (page - 1) * LOOKUP_PAGE_SIZE
+            # one more object tells if there is a next page, without a count
+            objects = list(self.get_lookup_queryset(request, query)[
+                    start:start + LOOKUP_PAGE_SIZE + 1])
+            data = simplejson.dumps({
+                    'results': [{'id': obj.pk, 'text': unicode(obj)}
+                                for obj in objects[:LOOKUP_PAGE_SIZE]],
+                    'more': len(objects) > LOOKUP_PAGE_SIZE})
+            cache.set(key, data, LOOKUP_CACHE_TIMEOUT)
+        return HttpResponse(data, mimetype='application/json')
+
+
+# Query string parameters of the keyset paginated changelists.
+AFTER_VAR = 'after'
+BEFORE_VAR = 'before'
+# Cache timeout (in seconds) of the estimated changelist counts.
+COUNT_CACHE_TIMEOUT = 300
+
+
+def estimated_count (queryset):
+    """Returns the number of objects in queryset, cheaply. An unfiltered
+    queryset on PostgreSQL uses the row estimate of the planner; other
+    counts are cached for COUNT_CACHE_TIMEOUT seconds."""
+    connection = connections[queryset.db]
+    if not queryset.query.where and connection.vendor == 'postgresql':
+        cursor = connection.cursor()
+        # the table of the search path, not a namesake in another schema
+        cursor.execute('SELECT reltuples FROM pg_class WHERE oid = %s::regclass',
+                       [connection.ops.quote_name(queryset.model._meta.db_table)])
+        row = cursor.fetchone()
+        if row and row[0] > 0:
+            return int(row[0])
+    try:
+        sql, params = queryset.query.get_compiler(queryset.db).as_sql()
+    except EmptyResultSet:
+        return 0
+    # the parameters may be non-ASCII search terms
+    key = 'legal_editions:count:%s' % md5_constructor(
+        '%s\n%s' % (smart_str(sql), smart_str(repr(params)))).hexdigest()
+    count = cache.get(key)
+    if count is None:
+        count = queryset.count()
+        cache.set(key, count, COUNT_CACHE_TIMEOUT)
+    return count
+
+
+class KeysetChangeList (ChangeList):
+
+    """Changelist paginated by seeking: a page starts after the
+    ordering values of the last row of the previous page (or ends before
+    the first row of the next page) instead of skipping OFFSET rows, so
+    every page costs the same with an index on the ordering fields.
+
+    The ordering is the ModelAdmin's keyset_ordering, which must end
+    with a unique field. Only previous/next links are available and the
+    count is estimated (see estimated_count). Ordering by a column from
+    the changelist falls back to the default pagination."""
+
+    def get_cursor (self, var):
+        value = self.params.pop(var, None)
+        if value is None:
+            return None
+        try:
+            cursor = simplejson.loads(value)
+        except ValueError:
+            raise IncorrectLookupParameters
+        if (not isinstance(cursor, list) or
+            len(cursor) != len(self.get_keyset_ordering())):
+            raise IncorrectLookupParameters
+        return cursor
+
+    def get_keyset_ordering (self):
+        return self.model_admin.keyset_ordering
+
+    def get_query_set (self):
+        # the cursors must not be taken for filters
+        self.after = self.get_cursor(AFTER_VAR)
+        self.before = self.get_cursor(BEFORE_VAR)
+        qs = super(KeysetChangeList, self).get_query_set()
+        self.keyset = ORDER_VAR not in self.params
+        if self.keyset:
+            qs = qs.order_by(*self.get_keyset_ordering())
+        return qs
+
+    def get_seek_filter (self, cursor, lookup):
+        # (a, b, c) > (x, y, z) as
+        # a > x OR (a = x AND b > y) OR (a = x AND b = y AND c > z)
+        fields = self.get_keyset_ordering()
+        ret = None
+        for i, field in enumerate(fields):
+            q = models.Q(**{'%s__%s' % (field, lookup): cursor[i]})
+            for j in range(i):
+                q &= models.Q(**{fields[j]: cursor[j]})
+            ret = ret is None and q or ret | q
+        return ret
+
+    def get_cursor_query_string (self, obj, var):
+        cursor = [getattr(obj, field) for field in self.get_keyset_ordering()]
+        return self.get_query_string({var: simplejson.dumps(cursor)})
+
+    def get_results (self, request):
+        if not self.keyset:
+            return super(KeysetChangeList, self).get_results(request)
+        qs = self.query_set
+        if self.before is not None:
+            qs = qs.filter(self.get_seek_filter(self.before, 'lt')).order_by(
+                *['-%s' % field for field in self.get_keyset_ordering()])
+        elif self.after is not None:
+            qs = qs.filter(self.get_seek_filter(self.after, 'gt'))
+        # one more row tells if there is another page in that direction
+        result_list = list(qs[:self.list_per_page + 1])
+        has_more = len(result_list) > self.list_per_page
+        result_list = result_list[:self.list_per_page]
+        if self.before is not None:
+            result_list.reverse()
+            has_previous, has_next = has_more, True
+        else:
+            has_previous, has_next = self.after is not None, has_more
+        self.previous_query_string = self.next_query_string = None
+        if has_previous and result_list:
+            self.previous_query_string = self.get_cursor_query_string(
+                result_list[0], BEFORE_VAR)
+        if has_next and result_list:
+            self.next_query_string = self.get_cursor_query_string(
+                result_list[-1], AFTER_VAR)
+        self.result_count = estimated_count(self.query_set)
+        if not self.query_set.query.where:
+            self.full_result_count = self.result_count
+        else:
+            self.full_result_count = estimated_count(self.root_query_set)
+        self.result_list = result_list
+        self.can_show_all = False
+        self.multi_page = has_previous or has_next
+        self.paginator = None
+
+
+class EditionsInline (ForeignKeySearchMixin, admin.TabularInline):
+
+    autocomplete_fields = ('edition',)
     model = edition_models.Edition.editors.through
     verbose_name = 'Edited Edition'
     verbose_name_plural = 'Edited Editions'
 
 
-class EditorsInline (admin.TabularInline):
+class EditorsInline (ForeignKeySearchMixin, admin.TabularInline):
 
     model = edition_models.Edition.editors.through
     verbose_name = 'Editor'
     verbose_name_plural = 'Editors'
 
 
-class HyperarchetypeInline (admin.TabularInline):
+class HyperarchetypeInline (ForeignKeySearchMixin, admin.TabularInline):
 
     model = edition_models.Hyperarchetype
 
 
-class TextAttributeInline (admin.TabularInline):
+class TextAttributeInline (ForeignKeySearchMixin, admin.TabularInline):
 
+    autocomplete_fields = ('work',)
     model = edition_models.Work.text_attributes.through
     verbose_name = 'Work-Text Attribute Relationship'
     verbose_name_plural = 'Work-Text Attribute relationships'
 
 
-class VersionLanguagesInline (admin.TabularInline):
+class VersionLanguagesInline (ForeignKeySearchMixin, admin.TabularInline):
 
+    autocomplete_fields = ('version',)
     model = edition_models.Version.languages.through
 
 
-class WitnessInline (admin.TabularInline):
+class WitnessInline (ForeignKeySearchMixin, admin.TabularInline):
 
+    autocomplete_fields = ('version', 'witness')
     model = edition_models.Version.witnesses.through
 
 
-class WitnessLanguagesInline (admin.TabularInline):
+class WitnessLanguagesInline (ForeignKeySearchMixin, admin.TabularInline):
 
+    autocomplete_fields = ('witness',)
     model = edition_models.Witness.languages.through
 
 
-class WitnessTranscriptionInline (admin.TabularInline):
+class WitnessTranscriptionInline (ForeignKeySearchMixin, admin.TabularInline):
 
+    autocomplete_fields = ('witness',)
     model = edition_models.WitnessTranscription
 
 
-class EditionAdmin (admin.ModelAdmin):
+class CommentaryAdmin (ForeignKeySearchMixin, admin.ModelAdmin):
+
+    autocomplete_fields = ('edition',)
+
 
+class EditionAdmin (ForeignKeySearchMixin, admin.ModelAdmin):
+
+    autocomplete_fields = ('version',)
     fieldsets = (
         (None, {'fields': ('abbreviation', 'version', 'date', 'status')}),
         ('Introduction', {'fields': ('introduction',)}),
         ('Texts', {'fields': ('text', 'translation')}),
         ('Further information', {'fields': ('internal_notes',)}),)
     inlines = [EditorsInline, HyperarchetypeInline, WitnessTranscriptionInline]
-
-
-class EditorAdmin (admin.ModelAdmin):
+    search_fields = ('abbreviation', 'version__standard_abbreviation')
+
+    def get_urls (self):
+        from django.conf.urls.defaults import patterns, url
+        info = self.model._meta.app_label, self.model._meta.module_name
+        urlpatterns = patterns(
+            '',
+            url(r'^export/(jsonl|tei)/$',
+                self.admin_site.admin_view(self.export_view),
+                name='%s_%s_export' % info))
+        return urlpatterns + super(EditionAdmin, self).get_urls()
+
+    def change_view (self, request, object_id, extra_context=None):
+        if request.method == 'GET':
+            # see commentaries._check_edition; a report of another text
+            # is ignored
+            text = self.model._default_manager.filter(
+                pk=object_id).values_list('text', flat=True)[:1]
+            report = text and commentaries.get_orphan_report(object_id,
+                                                             text[0])
+            if report and report['orphans']:
+                messages.warning(request, 'The elements of %d commentaries '
+                                 'are no longer in the text: %s.' % (
+                        len(report['orphans']), ', '.join(
+                            [element_id for pk, element_id in
+                             report['orphans']])))
+        return super(EditionAdmin, self).change_view(request, object_id,
+                                                     extra_context)
+
+    def export_view (self, request, format):
+        """Streams the export of the editions (those of the comma separated
+        ids parameter, or all of them) in format (jsonl or tei)."""
+        if not self.has_change_permission(request):
+            raise PermissionDenied
+        editions = self.model.objects.all()
+        ids = request.GET.get('ids')
+        if ids:
+            try:
+                editions = editions.filter(pk__in=[int(pk) for pk in
+                                                   ids.split(',')])
+            except ValueError:
+                return HttpResponseBadRequest('Invalid ids.')
+        if format == 'tei':
+            content = export.export_tei(editions)
+        else:
+            content = export.export_jsonl(editions)
+        extension, content_type = export.FORMATS[format]
+        response = HttpResponse(content, mimetype=content_type)
+        response['Content-Disposition'] = (
+            'attachment; filename=editions.%s' % extension)
+        return response
+
+
+class EditorAdmin (ForeignKeySearchMixin, admin.ModelAdmin):
 
     fieldsets = (
         ('Name', {'fields': ('abbreviation', 'last_name', 'first_name')}),)
@@ -71,8 +400,9 @@ class EditorAdmin (admin.ModelAdmin):
     search_fields = list_display
 
 
-class FolioImageAdmin (admin.ModelAdmin):
+class FolioImageAdmin (ForeignKeySearchMixin, admin.ModelAdmin):
 
+    autocomplete_fields = ('manuscript',)
     fieldsets = (
         ('Image file', {'fields': ('filename', 'batch', 'path', 'filepath')}),
         ('Manuscript', {'fields': ('manuscript', 'folio_number', 'folio_side',
@@ -84,10 +414,20 @@ class FolioImageAdmin (admin.ModelAdmin):
     list_display_links = list_display
     list_per_page = 300
     ordering = ('batch', 'path', 'filename')
-    search_fields = ('archived', 'batch', 'manuscript', 'path')
+    # see KeysetChangeList and sql/folioimage.sql
+    keyset_ordering = ('batch', 'path', 'filename', 'id')
+    search_fields = ('^batch', '^path', '^filename', '=manuscript__sigla')
+
+    def get_changelist (self, request, **kwargs):
+        return KeysetChangeList
+
+
+class HyperarchetypeAdmin (ForeignKeySearchMixin, admin.ModelAdmin):
+
+    autocomplete_fields = ('edition',)
 
 
-class ManuscriptAdmin (admin.ModelAdmin):
+class ManuscriptAdmin (ForeignKeySearchMixin, admin.ModelAdmin):
 
     fieldsets = (
         ('Sigla', {'fields': ('sigla', 'sigla_provenance')}),
@@ -96,6 +436,7 @@ class ManuscriptAdmin (admin.ModelAdmin):
                                'checked_folios', 'single_sheet',
                                'standard_edition')}))
     list_display = ('id', 'sigla', 'shelf_mark', 'archive', 'single_sheet')
+    queryset_select_related = ('archive',)
     list_display_links = list_display
     list_filter = ('single_sheet', 'hide_from_listings', 'checked_folios',
                    'sigla_provenance', 'archive')
@@ -103,8 +444,9 @@ class ManuscriptAdmin (admin.ModelAdmin):
     search_fields = ('id', 'shelf_mark', 'sigla')
 
 
-class VersionAdmin (admin.ModelAdmin):
+class VersionAdmin (ForeignKeySearchMixin, admin.ModelAdmin):
 
+    autocomplete_fields = ('work',)
     fieldsets = (
         ('Info', {'fields': ('standard_abbreviation', 'slug', 'name', 'work',
                              'date')}),
@@ -118,14 +460,16 @@ class VersionAdmin (admin.ModelAdmin):
     search_fields = ('id', 'standard_abbreviation')
 
 
-class VersionRelationshipAdmin (admin.ModelAdmin):
+class VersionRelationshipAdmin (ForeignKeySearchMixin, admin.ModelAdmin):
 
+    autocomplete_fields = ('source', 'target')
     fieldsets = ((None, {'fields': ('relationship_type', 'source', 'target',
                                     'description')}),)
 
 
-class WitnessAdmin (admin.ModelAdmin):
+class WitnessAdmin (ForeignKeySearchMixin, admin.ModelAdmin):
 
+    autocomplete_fields = ('manuscript', 'work')
     fieldsets = (
         ('Work', {'fields': ('work',)}),
         ('Location', {'fields': ('manuscript', 'range_start', 'range_end',
@@ -133,28 +477,31 @@ class WitnessAdmin (admin.ModelAdmin):
         ('Description', {'fields': ('description',)}),)
     inlines = [WitnessLanguagesInline, WitnessInline]
     list_display = ('id', 'work', 'manuscript', 'range_start', 'range_end')
+    queryset_select_related = ('work', 'manuscript')
     list_display_links = list_display
     ordering = ('work',)
-    search_fields = ('id', 'range_start', 'range_end')
+    search_fields = ('id', 'range_start', 'range_end', 'manuscript__sigla',
+                     'manuscript__shelf_mark', 'work__name')
 
 
-class WorkAdmin (admin.ModelAdmin):
+class WorkAdmin (ForeignKeySearchMixin, admin.ModelAdmin):
 
     fieldsets = ((None, {'fields': ('name', 'king', 'date')}),)
     inlines = [TextAttributeInline]
     list_display = ('id', 'name')
     list_display_links = list_display
     list_filter = ['text_attributes']
+    search_fields = ('name',)
 
 
 admin.site.register(edition_models.Archive)
-admin.site.register(edition_models.Commentary)
+admin.site.register(edition_models.Commentary, CommentaryAdmin)
 admin.site.register(edition_models.Edition, EditionAdmin)
 admin.site.register(edition_models.EditionStatus)
 admin.site.register(edition_models.Editor, EditorAdmin)
 admin.site.register(edition_models.FolioImage, FolioImageAdmin)
 admin.site.register(edition_models.FolioSide)
-admin.site.register(edition_models.Hyperarchetype)
+admin.site.register(edition_models.Hyperarchetype, HyperarchetypeAdmin)
 admin.site.register(edition_models.King)
 admin.site.register(edition_models.Language)
 admin.site.register(edition_models.Manuscript, ManuscriptAdmin)
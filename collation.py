@@ -0,0 +1,239 @@
+"""Collation of the witness transcriptions of an edition.
+
+Each transcription is aligned word by word against a base transcription
+(by default the first one of the edition) with Myers' O(ND) difference
+algorithm, and the differences are grouped into a variant apparatus:
+
+    collation = collate(edition)
+    for variant in collation.variants:
+        print variant.lemma, variant.readings
+
+Words are compared in their normalized form (see search.tokenize), so
+that differences of case, markup, accents and spelling folded by the
+tokenizer are not variants.
+
+The differences of each transcription are saved in a WitnessAlignment
+with the MD5 digests of both texts, and only computed again when one of
+them changed. The whole collation is also cached (django.core.cache) under
+the digests of all the transcriptions.
+"""
+
+import difflib
+
+from django.core.cache import cache
+from django.utils import simplejson
+from django.utils.hashcompat import md5_constructor
+
+from legal_editions.models import WitnessAlignment, WitnessTranscription
+from legal_editions.search import tokenize
+
+
+CACHE_TIMEOUT = 60 * 60 * 24
+# Beyond this number of differences between two transcriptions, Myers'
+# algorithm (O(D^2) memory) gives way to difflib.
+MAX_DIFFERENCES = 2000
+
+
+def get_text_hash (text):
+    return md5_constructor((text or u'').encode('utf-8')).hexdigest()
+
+
+def get_words (text):
+    """Returns the (normalized words, original words) of a
+    transcription."""
+    tokens = list(tokenize(text or u''))
+    return ([token for token, start, end in tokens],
+            [text[start:end] for token, start, end in tokens])
+
+
+def _myers_matches (a, b):
+    # Yields the (i, j) pairs of a[i] == b[j] of a shortest edit script,
+    # last first, or returns None beyond MAX_DIFFERENCES.
+    n, m = len(a), len(b)
+    v = {1: 0}
+    trace = []
+    for d in xrange(min(n + m, MAX_DIFFERENCES) + 1):
+        trace.append(v.copy())
+        for k in xrange(-d, d + 1, 2):
+            if k == -d or (k != d and v[k - 1] < v[k + 1]):
+                x = v[k + 1]
+            else:
+                x = v[k - 1] + 1
+            y = x - k
+            while x < n and y < m and a[x] == b[y]:
+                x += 1
+                y += 1
+            v[k] = x
+            if x >= n and y >= m:
+                break
+        else:
+            continue
+        break
+    else:
+        return None
+    matches = []
+    x, y = n, m
+    for d in xrange(len(trace) - 1, -1, -1):
+        v = trace[d]
+        k = x - y
+        if k == -d or (k != d and v[k - 1] < v[k + 1]):
+            previous_k = k + 1
+        else:
+            previous_k = k - 1
+        previous_x = v[previous_k]
+        previous_y = previous_x - previous_k
+        while x > previous_x and y > previous_y:
+            x -= 1
+            y -= 1
+            matches.append((x, y))
+        x, y = previous_x, previous_y
+    return matches
+
+
+def get_opcodes (a, b):
+    """Returns the differences between the sequences a and b as the
+    non-equal opcodes of difflib.SequenceMatcher.get_opcodes."""
+    # the common beginning and end are left out of the search
+    prefix = 0
+    while prefix < len(a) and prefix < len(b) and a[prefix] == b[prefix]:
+        prefix += 1
+    suffix = 0
+    while (suffix < len(a) - prefix and suffix < len(b) - prefix and
+           a[-suffix - 1] == b[-suffix - 1]):
+        suffix += 1
+    middle_a = a[prefix:len(a) - suffix]
+    middle_b = b[prefix:len(b) - suffix]
+    matches = _myers_matches(middle_a, middle_b)
+    if matches is None:
+        matcher = difflib.SequenceMatcher(None, middle_a, middle_b, False)
+        matches = []
+        for i, j, size in matcher.get_matching_blocks():
+            matches.extend([(i + offset, j + offset) for offset in range(size)])
+    else:
+        matches.reverse()
+    opcodes = []
+    i = j = 0
+    for x, y in matches + [(len(middle_a), len(middle_b))]:
+        if x > i or y > j:
+            if x > i and y > j:
+                tag = 'replace'
+            elif x > i:
+                tag = 'delete'
+            else:
+                tag = 'insert'
+            opcodes.append((tag, i + prefix, x + prefix, j + prefix,
+                            y + prefix))
+        i, j = x + 1, y + 1
+    return opcodes
+
+
+class Variant (object):
+
+    """Readings of the witnesses that differ from the base between the
+    words start and end of the base (start == end for an addition).
+    readings is a list of (reading, sigla of the witnesses), an empty
+    reading is an omission."""
+
+    def __init__ (self, start, end, lemma):
+        self.start = start
+        self.end = end
+        self.lemma = lemma
+        self.readings = []
+
+    def __repr__ (self):
+        return '<Variant %d-%d %r: %r>' % (self.start, self.end, self.lemma,
+                                           self.readings)
+
+
+class Collation (object):
+
+    """The variants of the transcriptions of an edition against a base
+    transcription. See collate()."""
+
+    def __init__ (self, base, words, sigla, variants):
+        self.base = base
+        self.words = words
+        self.sigla = sigla
+        self.variants = variants
+
+    def get_variants (self, start, end):
+        """Returns the variants overlapping the words start to end of the
+        base."""
+        return [variant for variant in self.variants
+                if variant.start < end and variant.end >= start]
+
+
+def get_sigla (transcription):
+    return transcription.witness.manuscript.sigla or unicode(
+        transcription.witness.manuscript)
+
+
+def get_differences (base_words, words, original):
+    """Returns the differences between the words of the base and those of
+    a transcription: a list of (base start, base end, reading, normalized
+    reading)."""
+    return [(i1, i2, u' '.join(original[j1:j2]), u' '.join(words[j1:j2]))
+            for tag, i1, i2, j1, j2 in get_opcodes(base_words, words)]
+
+
+def collate (edition, base=None):
+    """Returns the Collation of the transcriptions of an edition against
+    base, a transcription of the edition (by default the first one)."""
+    transcriptions = list(WitnessTranscription.objects.filter(
+            edition=edition).select_related('witness__manuscript').order_by(
+            'id'))
+    if not transcriptions:
+        return Collation(None, [], [], [])
+    if base is None:
+        base = transcriptions[0]
+    elif not isinstance(base, WitnessTranscription):
+        base = [transcription for transcription in transcriptions
+                if transcription.pk == int(base)][0]
+    hashes = dict([(transcription.pk,
+                    get_text_hash(transcription.transcription))
+                   for transcription in transcriptions])
+    key = 'legal_editions:collation:%s:%s' % (edition.pk, md5_constructor(
+            repr((base.pk, sorted(hashes.items())))).hexdigest())
+    collation = cache.get(key)
+    if collation is not None:
+        return collation
+    base_words, base_original = get_words(base.transcription)
+    alignments = dict([(alignment.transcription_id, alignment) for alignment in
+                       WitnessAlignment.objects.filter(base=base)])
+    variants = {}
+    # (start, end) -> normalized reading -> sigla
+    readings = {}
+    sigla = []
+    for transcription in transcriptions:
+        if transcription.pk == base.pk:
+            continue
+        sigla.append(get_sigla(transcription))
+        alignment = alignments.get(transcription.pk)
+        if alignment is None:
+            alignment = WitnessAlignment(transcription=transcription,
+                                         base=base)
+        hashes_pair = (hashes[base.pk], hashes[transcription.pk])
+        if (alignment.base_hash, alignment.transcription_hash) == hashes_pair:
+            differences = simplejson.loads(alignment.differences)
+        else:
+            # the only texts tokenized, apart from the base
+            words, original = get_words(transcription.transcription)
+            differences = get_differences(base_words, words, original)
+            alignment.base_hash, alignment.transcription_hash = hashes_pair
+            alignment.differences = simplejson.dumps(differences)
+            alignment.save()
+        for i1, i2, reading, normalized in differences:
+            variant = variants.get((i1, i2))
+            if variant is None:
+                variant = variants[(i1, i2)] = Variant(
+                    i1, i2, u' '.join(base_original[i1:i2]))
+                readings[(i1, i2)] = {}
+            reading_sigla = readings[(i1, i2)].get(normalized)
+            if reading_sigla is None:
+                reading_sigla = readings[(i1, i2)][normalized] = []
+                variant.readings.append((reading, reading_sigla))
+            reading_sigla.append(sigla[-1])
+    collation = Collation(base.pk, base_original, sigla,
+                          [variants[position] for position in sorted(variants)])
+    cache.set(key, collation, CACHE_TIMEOUT)
+    return collation
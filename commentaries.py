@@ -0,0 +1,171 @@
+"""The commentaries of an edition, anchored to the elements of its text.
+
+A Commentary refers to the element of Edition.text whose id (or xml:id)
+attribute is its element_id, in order of sort_order:
+
+    for element_id, element_commentaries in edition.get_commentaries().items():
+        ...
+
+The commentaries of an element whose id is no longer in the text are
+orphaned. After an edition is saved with a new text, or one of its
+commentaries is saved or deleted, they are looked for in a background
+thread and reported in the log and, to the editors, on the admin page of
+the edition (see get_orphan_report).
+"""
+
+import logging
+import re
+import threading
+
+from django.core.cache import cache
+from django.db.models import get_model, signals
+from django.utils.datastructures import SortedDict
+from django.utils.hashcompat import md5_constructor
+
+
+ELEMENT_ID_RE = re.compile(r'''\s(?:xml:)?id\s*=\s*(?:"([^"]*)"|'([^']*)')''')
+
+CHUNK_SIZE = 100
+
+REPORT_TIMEOUT = 60 * 60 * 24 * 7
+
+logger = logging.getLogger('legal_editions.commentaries')
+
+
+def get_commentaries (edition):
+    """Returns the commentaries of an edition with their users, grouped by
+    element: a SortedDict of the lists of commentaries by element_id, in
+    order of element_id then sort_order (one query)."""
+    commentary_model = get_model('legal_editions', 'Commentary')
+    ret = SortedDict()
+    for commentary in commentary_model.objects.filter(
+        edition=edition).select_related('user').order_by(
+        'element_id', 'sort_order', 'id'):
+        ret.setdefault(commentary.element_id, []).append(commentary)
+    return ret
+
+
+def get_element_ids (text):
+    """Returns the set of the ids of the elements of a text."""
+    return set([double or single for double, single in
+                ELEMENT_ID_RE.findall(text or u'')])
+
+
+def get_orphans (text, anchors):
+    """Returns the (commentary id, element_id) of anchors, a list of
+    (commentary id, element_id), whose element isn't in text."""
+    element_ids = get_element_ids(text)
+    return [(pk, element_id) for pk, element_id in anchors
+            if element_id and element_id not in element_ids]
+
+
+def _get_anchors (edition_ids, using):
+    # edition id -> (commentary id, element_id) of its anchored commentaries
+    commentary_model = get_model('legal_editions', 'Commentary')
+    ret = {}
+    for pk, edition_id, element_id in commentary_model.objects.using(
+        using).filter(edition__in=edition_ids).exclude(
+        element_id='').values_list('id', 'edition', 'element_id').order_by(
+        'edition', 'element_id', 'sort_order', 'id'):
+        ret.setdefault(edition_id, []).append((pk, element_id))
+    return ret
+
+
+def find_orphaned_commentaries (editions=None, using=None):
+    """Returns {edition id: [(commentary id, element_id)]} of the orphaned
+    commentaries of editions, a queryset (by default all the editions).
+    Two queries per CHUNK_SIZE editions."""
+    if editions is None:
+        editions = get_model('legal_editions', 'Edition').objects.using(using)
+    editions = editions.order_by('pk')
+    ret = {}
+    last = None
+    while True:
+        chunk = editions
+        if last is not None:
+            chunk = chunk.filter(pk__gt=last)
+        chunk = list(chunk.values_list('pk', 'text')[:CHUNK_SIZE])
+        if not chunk:
+            break
+        last = chunk[-1][0]
+        anchors = _get_anchors([pk for pk, text in chunk], editions.db)
+        for pk, text in chunk:
+            orphans = get_orphans(text, anchors.get(pk, []))
+            if orphans:
+                ret[pk] = orphans
+    return ret
+
+
+def _get_report_key (edition_id):
+    return 'legal_editions:orphaned_commentaries:%s' % edition_id
+
+
+def get_text_hash (text):
+    return md5_constructor((text or u'').encode('utf-8')).hexdigest()
+
+
+def get_orphan_report (edition_id, text=None):
+    """Returns the last report of the orphaned commentaries of an edition:
+    a dictionary of the digest of the text checked (text_hash) and the
+    (commentary id, element_id) of the orphans, or None if the edition
+    hasn't been checked since it or its commentaries were saved. With
+    text, the current text of the edition, a report of another text is
+    None too."""
+    report = cache.get(_get_report_key(edition_id))
+    if (report is not None and text is not None and
+        report['text_hash'] != get_text_hash(text)):
+        return None
+    return report
+
+
+def _report (edition_id, label, text, text_hash, anchors):
+    orphans = get_orphans(text, anchors)
+    cache.set(_get_report_key(edition_id),
+              {'text_hash': text_hash, 'orphans': orphans}, REPORT_TIMEOUT)
+    if orphans:
+        logger.warning('%d orphaned commentaries in %s: %s' % (
+                len(orphans), label, ', '.join([element_id for pk, element_id
+                                                in orphans])))
+
+
+def check_edition (edition, using=None):
+    """Reports the orphaned commentaries of an edition in the background
+    (see get_orphan_report)."""
+    # the query here (covered by the index on edition, element_id and
+    # sort_order), the parsing of the text in the background
+    anchors = _get_anchors([edition.pk], using).get(edition.pk, [])
+    # the previous report is out of date
+    cache.delete(_get_report_key(edition.pk))
+    thread = threading.Thread(target=_report, args=(
+            edition.pk, edition.abbreviation, edition.text,
+            get_text_hash(edition.text), anchors))
+    thread.setDaemon(True)
+    thread.start()
+
+
+def _check_edition (sender, instance, **kwargs):
+    if sender._meta.app_label != 'legal_editions' or kwargs.get('raw'):
+        return
+    using = kwargs.get('using')
+    name = sender._meta.object_name
+    if name == 'Edition':
+        if kwargs.get('signal') is signals.post_delete:
+            cache.delete(_get_report_key(instance.pk))
+            return
+        report = get_orphan_report(instance.pk, instance.text)
+        if report is None:
+            check_edition(instance, using)
+    elif name == 'Commentary':
+        # the anchors changed, the text didn't
+        edition_model = get_model('legal_editions', 'Edition')
+        try:
+            edition = edition_model.objects.using(using).only(
+                'abbreviation', 'text').get(pk=instance.edition_id)
+        except edition_model.DoesNotExist:
+            # deleted with the edition
+            return
+        check_edition(edition, using)
+
+
+signals.post_save.connect(_check_edition)
+signals.post_delete.connect(_check_edition)
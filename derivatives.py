@@ -0,0 +1,260 @@
+"""Derivatives of the folio images: thumbnails and Deep Zoom tile
+pyramids, written on local disk next to a JSON manifest per manuscript.
+
+    <LEGAL_EDITIONS_DERIVATIVE_ROOT>/<manuscript id>/manifest.json
+    <LEGAL_EDITIONS_DERIVATIVE_ROOT>/<manuscript id>/<image id>_thumb.jpg
+    <LEGAL_EDITIONS_DERIVATIVE_ROOT>/<manuscript id>/<image id>.dzi
+    <LEGAL_EDITIONS_DERIVATIVE_ROOT>/<manuscript id>/<image id>_files/<level>/<column>_<row>.jpg
+
+The sources are FolioImage.filepath under LEGAL_EDITIONS_IMAGE_ROOT
+(defaults to MEDIA_ROOT). An image is processed again only if the
+modification time or size of its source changed since the manifest was
+written (and, with checksum=True, its MD5 digest too).
+
+Requires PIL (or Pillow)."""
+
+import math
+import os
+import shutil
+from multiprocessing import Pool
+
+from django.conf import settings
+from django.utils import simplejson
+from django.utils.hashcompat import md5_constructor
+
+try:
+    from PIL import Image
+except ImportError:
+    try:
+        import Image
+    except ImportError:
+        Image = None
+
+
+MANIFEST_NAME = 'manifest.json'
+# The manifest is saved every SAVE_INTERVAL processed images, so that an
+# interrupted run doesn't start again from the beginning.
+SAVE_INTERVAL = 50
+
+
+def get_settings ():
+    """Returns the derivative settings, with their default values."""
+    media_root = getattr(settings, 'MEDIA_ROOT', '')
+    return {
+        'image_root': getattr(settings, 'LEGAL_EDITIONS_IMAGE_ROOT',
+                              media_root),
+        'derivative_root': getattr(settings, 'LEGAL_EDITIONS_DERIVATIVE_ROOT',
+                                   os.path.join(media_root, 'derivatives')),
+        'derivative_url': getattr(settings, 'LEGAL_EDITIONS_DERIVATIVE_URL',
+                                  getattr(settings, 'MEDIA_URL', '/') +
+                                  'derivatives/'),
+        'thumbnail_size': getattr(settings, 'LEGAL_EDITIONS_THUMBNAIL_SIZE',
+                                  (200, 300)),
+        'tile_size': getattr(settings, 'LEGAL_EDITIONS_TILE_SIZE', 254),
+        'tile_overlap': getattr(settings, 'LEGAL_EDITIONS_TILE_OVERLAP', 1),
+        'quality': getattr(settings, 'LEGAL_EDITIONS_DERIVATIVE_QUALITY', 85),
+        }
+
+
+def get_manuscript_directory (manuscript_id):
+    return os.path.join(get_settings()['derivative_root'], str(manuscript_id))
+
+
+def get_derivative_url (image, kind='thumbnail'):
+    """Returns the URL of the thumbnail ('thumbnail') or Deep Zoom
+    descriptor ('tiles') of a FolioImage."""
+    suffix = {'thumbnail': '_thumb.jpg', 'tiles': '.dzi'}[kind]
+    return '%s%s/%s%s' % (get_settings()['derivative_url'],
+                          image.manuscript_id, image.pk, suffix)
+
+
+def file_md5 (path):
+    digest = md5_constructor()
+    source = open(path, 'rb')
+    try:
+        for block in iter(lambda: source.read(1 << 20), ''):
+            digest.update(block)
+    finally:
+        source.close()
+    return digest.hexdigest()
+
+
+def load_manifest (manuscript_id):
+    path = os.path.join(get_manuscript_directory(manuscript_id), MANIFEST_NAME)
+    try:
+        manifest = open(path)
+    except IOError:
+        return {'manuscript': manuscript_id, 'images': {}}
+    try:
+        return simplejson.load(manifest)
+    finally:
+        manifest.close()
+
+
+def save_manifest (manuscript_id, data):
+    """Writes the manifest of a manuscript, atomically."""
+    directory = get_manuscript_directory(manuscript_id)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    path = os.path.join(directory, MANIFEST_NAME)
+    output = open(path + '.tmp', 'w')
+    try:
+        simplejson.dump(data, output, indent=1, sort_keys=True)
+    finally:
+        output.close()
+    os.rename(path + '.tmp', path)
+
+
+def make_thumbnail (image, path, size, quality):
+    thumbnail = image.copy()
+    thumbnail.thumbnail(size, Image.ANTIALIAS)
+    thumbnail.save(path, 'JPEG', quality=quality)
+
+
+def make_tiles (image, prefix, tile_size, overlap, quality):
+    """Writes the Deep Zoom pyramid of image as prefix.dzi and
+    prefix_files/."""
+    width, height = image.size
+    files = prefix + '_files'
+    if os.path.isdir(files):
+        shutil.rmtree(files)
+    max_level = int(math.ceil(math.log(max(width, height, 1), 2)))
+    level_image = image
+    for level in range(max_level, -1, -1):
+        scale = 2 ** (max_level - level)
+        size = (int(math.ceil(width / float(scale))),
+                int(math.ceil(height / float(scale))))
+        # each level is reduced from the one above, not from the source
+        if level_image.size != size:
+            level_image = level_image.resize(size, Image.ANTIALIAS)
+        directory = os.path.join(files, str(level))
+        os.makedirs(directory)
+        for column in range(int(math.ceil(size[0] / float(tile_size)))):
+            for row in range(int(math.ceil(size[1] / float(tile_size)))):
+                box = (max(column * tile_size - overlap, 0),
+                       max(row * tile_size - overlap, 0),
+                       min((column + 1) * tile_size + overlap, size[0]),
+                       min((row + 1) * tile_size + overlap, size[1]))
+                level_image.crop(box).save(
+                    os.path.join(directory, '%d_%d.jpg' % (column, row)),
+                    'JPEG', quality=quality)
+    descriptor = open(prefix + '.dzi', 'w')
+    try:
+        descriptor.write(
+            '<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<Image xmlns="http://schemas.microsoft.com/deepzoom/2008" '
+            'Format="jpg" Overlap="%d" TileSize="%d">'
+            '<Size Width="%d" Height="%d"/></Image>\n' % (
+                overlap, tile_size, width, height))
+    finally:
+        descriptor.close()
+
+
+def process_image (task):
+    """Makes the derivatives of one image. Runs in the worker processes
+    of update_derivatives, so it must not use the database. Returns
+    (image id, width, height, error)."""
+    pk, source, prefix, options = task
+    try:
+        image = Image.open(source)
+        if image.mode not in ('L', 'RGB'):
+            image = image.convert('RGB')
+        make_thumbnail(image, prefix + '_thumb.jpg',
+                       options['thumbnail_size'], options['quality'])
+        make_tiles(image, prefix, options['tile_size'],
+                   options['tile_overlap'], options['quality'])
+    except Exception, e:
+        # recorded as the error of the image, so that one bad source
+        # (e.g. a truncated file PIL can't decode) doesn't stop the others
+        return pk, None, None, '%s: %s' % (e.__class__.__name__, e)
+    return pk, image.size[0], image.size[1], None
+
+
+def update_derivatives (manuscript_id, images, processes=None,
+                        checksum=False, force=False, log=None):
+    """Makes the missing or outdated derivatives of images, a list of
+    (id, filepath) of FolioImages of a manuscript, and updates its
+    manifest. Returns the numbers of (processed, up to date, failed)
+    images."""
+    if Image is None:
+        raise ImportError('The image derivatives require PIL.')
+    options = get_settings()
+    directory = get_manuscript_directory(manuscript_id)
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    manifest = load_manifest(manuscript_id)
+    entries = manifest['images']
+    # the entries of the images being processed, only added to the
+    # manifest once their derivatives are written
+    pending = {}
+    tasks = []
+    up_to_date = failed = 0
+    for pk, filepath in images:
+        key = str(pk)
+        source = os.path.join(options['image_root'], filepath)
+        try:
+            stat = os.stat(source)
+        except OSError, e:
+            failed += 1
+            if log:
+                log('%s: %s' % (filepath, e))
+            continue
+        entry = entries.get(key)
+        if entry and not force and entry.get('error') is None:
+            if (entry['mtime'], entry['size']) == (int(stat.st_mtime),
+                                                   stat.st_size):
+                up_to_date += 1
+                continue
+            if checksum and entry.get('md5') == file_md5(source):
+                entry['mtime'] = int(stat.st_mtime)
+                up_to_date += 1
+                continue
+        pending[key] = {'source': filepath, 'mtime': int(stat.st_mtime),
+                        'size': stat.st_size,
+                        'md5': checksum and file_md5(source) or None}
+        tasks.append((pk, source, os.path.join(directory, key), options))
+    processed = 0
+    try:
+        if tasks:
+            pool = Pool(processes)
+            try:
+                for pk, width, height, error in pool.imap_unordered(
+                    process_image, tasks):
+                    entry = entries[str(pk)] = pending[str(pk)]
+                    entry.update({'width': width, 'height': height,
+                                  'error': error})
+                    if error is None:
+                        processed += 1
+                    else:
+                        failed += 1
+                        if log:
+                            log('%s: %s' % (entry['source'], error))
+                    if (processed + failed) % SAVE_INTERVAL == 0:
+                        save_manifest(manuscript_id, manifest)
+            finally:
+                pool.terminate()
+                pool.join()
+    finally:
+        # the images done so far, even if the run is interrupted
+        save_manifest(manuscript_id, manifest)
+    return processed, up_to_date, failed
+
+
+def remove_derivatives (manuscript_id, keep):
+    """Removes the derivatives of the images of a manuscript whose id is
+    not in keep."""
+    manifest = load_manifest(manuscript_id)
+    directory = get_manuscript_directory(manuscript_id)
+    keep = set([str(pk) for pk in keep])
+    removed = [key for key in manifest['images'] if key not in keep]
+    for key in removed:
+        del manifest['images'][key]
+        prefix = os.path.join(directory, key)
+        for path in (prefix + '_thumb.jpg', prefix + '.dzi'):
+            if os.path.exists(path):
+                os.remove(path)
+        if os.path.isdir(prefix + '_files'):
+            shutil.rmtree(prefix + '_files')
+    if removed:
+        save_manifest(manuscript_id, manifest)
+    return len(removed)
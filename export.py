@@ -0,0 +1,309 @@
+"""Streaming export of the editions, as JSON Lines or TEI XML.
+
+    for chunk in export.export_jsonl():
+        output.write(chunk)
+
+The editions are read by chunks of CHUNK_SIZE, in order of primary key
+(each chunk starts after the last key of the previous one). The related
+rows of a chunk (editors, hyperarchetypes, witness transcriptions with
+their witnesses and manuscripts, commentaries and the facsimile images
+of the witness ranges) are read with one query per model for the whole
+chunk, so that the memory used doesn't grow with the corpus.
+
+The writers yield the output piece by piece: use them with
+write_shards() to split it into (gzipped) files, or as the content of an
+HttpResponse (see admin.EditionAdmin.export_view).
+"""
+
+import gzip
+import os
+from xml.sax.saxutils import escape, quoteattr
+
+from django.utils import simplejson
+
+from legal_editions.models import Commentary, Edition, FolioImage, \
+    Hyperarchetype, WitnessTranscription
+
+
+CHUNK_SIZE = 100
+
+FORMATS = {
+    # format: (file extension, content type)
+    'jsonl': ('jsonl', 'application/x-ndjson; charset=utf-8'),
+    'tei': ('xml', 'application/tei+xml; charset=utf-8'),
+}
+
+TEI_NS = 'http://www.tei-c.org/ns/1.0'
+
+
+def _group (rows, key):
+    ret = {}
+    for row in rows:
+        ret.setdefault(key(row), []).append(row)
+    return ret
+
+
+def _get_images (transcriptions, using):
+    # manuscript id -> images of the manuscripts of the witnesses
+    manuscript_ids = set([transcription.witness.manuscript_id
+                          for transcription in transcriptions])
+    images = FolioImage.objects.using(using).filter(
+        manuscript__in=manuscript_ids).select_related(
+        'folio_side').order_by('reading_order').only(
+        'manuscript', 'filepath', 'folio_number', 'page', 'folio_key',
+        'page_key', 'reading_order', 'folio_side__name')
+    return _group(images.iterator(), lambda image: image.manuscript_id)
+
+
+def _get_witness_images (witness, images):
+    # the images of the range of a witness, see Witness.get_folio_images
+    start, end = witness.range_start_key, witness.range_end_key
+    if start is None and end is None:
+        return []
+    key = witness.page and 'page_key' or 'folio_key'
+    ret = []
+    for image in images.get(witness.manuscript_id, ()):
+        value = getattr(image, key)
+        if value is None:
+            continue
+        if (start is None or value >= start) and (end is None or value <= end):
+            ret.append(image)
+    return ret
+
+
+def iter_editions (editions=None, chunk_size=CHUNK_SIZE):
+    """Yields a dictionary of each edition of the queryset editions (by
+    default all of them) with its related rows."""
+    if editions is None:
+        editions = Edition.objects.all()
+    editions = editions.select_related('version__work', 'status').order_by(
+        'pk')
+    using = editions.db
+    last = None
+    while True:
+        chunk = editions
+        if last is not None:
+            chunk = chunk.filter(pk__gt=last)
+        chunk = list(chunk[:chunk_size])
+        if not chunk:
+            break
+        last = chunk[-1].pk
+        ids = [edition.pk for edition in chunk]
+        through = Edition.editors.through
+        editors = _group(through.objects.using(using).filter(
+                edition__in=ids).select_related(
+                'editor').order_by('id'), lambda row: row.edition_id)
+        hyperarchetypes = _group(Hyperarchetype.objects.using(using).filter(
+                edition__in=ids).order_by('id'), lambda row: row.edition_id)
+        transcriptions = list(WitnessTranscription.objects.using(using).filter(
+                edition__in=ids).select_related(
+                'witness__manuscript__archive').order_by('id'))
+        images = _get_images(transcriptions, using)
+        transcriptions = _group(transcriptions, lambda row: row.edition_id)
+        commentaries = _group(Commentary.objects.using(using).filter(
+                edition__in=ids).select_related('user').order_by(
+                'sort_order', 'id'), lambda row: row.edition_id)
+        for edition in chunk:
+            yield get_edition_data(
+                edition, [row.editor for row in editors.get(edition.pk, ())],
+                hyperarchetypes.get(edition.pk, ()),
+                transcriptions.get(edition.pk, ()), images,
+                commentaries.get(edition.pk, ()))
+
+
+def get_edition_data (edition, editors, hyperarchetypes, transcriptions,
+                      images, commentaries):
+    version = edition.version
+    return {
+        'id': edition.pk,
+        'abbreviation': edition.abbreviation,
+        'date': edition.date and unicode(edition.date) or None,
+        'status': edition.status.name,
+        'introduction': edition.get_introduction(),
+        'text': edition.text,
+        'translation': edition.translation,
+        'version': {
+            'id': version.pk,
+            'standard_abbreviation': version.standard_abbreviation,
+            'name': version.get_name(),
+            'slug': version.slug,
+            'date': version.date and unicode(version.date) or None,
+            'work': {'id': version.work.pk, 'name': version.work.name},
+            },
+        'editors': [{'abbreviation': editor.abbreviation,
+                     'first_name': editor.first_name,
+                     'last_name': editor.last_name} for editor in editors],
+        'hyperarchetypes': [{'sigla': hyperarchetype.sigla,
+                             'description': hyperarchetype.description}
+                            for hyperarchetype in hyperarchetypes],
+        'witnesses': [{
+                'id': transcription.witness.pk,
+                'manuscript': {
+                    'id': transcription.witness.manuscript.pk,
+                    'shelf_mark': transcription.witness.manuscript.shelf_mark,
+                    'sigla': transcription.witness.manuscript.sigla,
+                    'archive': unicode(transcription.witness.manuscript.archive),
+                    },
+                'range_start': transcription.witness.range_start,
+                'range_end': transcription.witness.range_end,
+                'page': transcription.witness.page,
+                'transcription': transcription.transcription,
+                'translation': transcription.translation,
+                'facsimiles': [{
+                        'filepath': image.filepath,
+                        'folio_number': image.folio_number,
+                        'folio_side': image.folio_side.name,
+                        'page': image.page,
+                        } for image in _get_witness_images(
+                        transcription.witness, images)],
+                } for transcription in transcriptions],
+        'commentaries': [{'element_id': commentary.element_id,
+                          'user': commentary.user.username,
+                          'updated': commentary.updated and
+                          commentary.updated.isoformat() or None,
+                          'text': commentary.text}
+                         for commentary in commentaries],
+        }
+
+
+def export_jsonl (editions=None, chunk_size=CHUNK_SIZE):
+    """Yields a line of JSON for each edition."""
+    for data in iter_editions(editions, chunk_size):
+        yield '%s\n' % simplejson.dumps(data)
+
+
+def tei_header ():
+    return ('<?xml version="1.0" encoding="UTF-8"?>\n'
+            '<teiCorpus xmlns="%s">\n'
+            '<teiHeader><fileDesc><titleStmt><title>Editions</title></titleStmt>'
+            '<publicationStmt><p>Exported from legal_editions.</p></publicationStmt>'
+            '<sourceDesc><p>Born digital.</p></sourceDesc></fileDesc></teiHeader>\n'
+            % TEI_NS)
+
+
+def tei_footer ():
+    return '</teiCorpus>\n'
+
+
+def _element (name, text, **attributes):
+    attributes = ''.join([' %s=%s' % (key.rstrip('_'), quoteattr(unicode(value)))
+                          for key, value in sorted(attributes.items())
+                          if value not in (None, '')])
+    return u'<%s%s>%s</%s>' % (name, attributes, escape(text or u''), name)
+
+
+def _witness_id (data, witness):
+    # unique in a teiCorpus, where a witness can be transcribed in
+    # several editions
+    return u'wit-%d-%d' % (data['id'], witness['id'])
+
+
+def edition_to_tei (data):
+    """Returns the TEI element of an edition dictionary (see
+    iter_editions). The texts are escaped, their markup isn't
+    interpreted."""
+    version = data['version']
+    output = [u'<TEI xml:id="edition-%d">' % data['id'],
+              u'<teiHeader><fileDesc><titleStmt>',
+              _element('title', version['name']),
+              ]
+    for editor in data['editors']:
+        output.append(u'<editor>%s</editor>' % _element(
+                'persName', u' '.join(filter(None, [editor['first_name'],
+                                                    editor['last_name']]))
+                or editor['abbreviation'], n=editor['abbreviation']))
+    output.append(u'</titleStmt><publicationStmt>%s%s</publicationStmt>' % (
+            _element('idno', data['abbreviation'], type='abbreviation'),
+            _element('date', data['date'])))
+    output.append(u'<sourceDesc><listWit>')
+    for witness in data['witnesses']:
+        manuscript = witness['manuscript']
+        output.append(u'<witness xml:id="%s">%s %s</witness>' % (
+                _witness_id(data, witness),
+                _element('idno', manuscript['shelf_mark'],
+                         n=manuscript['sigla']),
+                _element('locus', u'-'.join(filter(None, [
+                                witness['range_start'],
+                                witness['range_end']])))))
+    for hyperarchetype in data['hyperarchetypes']:
+        output.append(_element('witness', hyperarchetype['description'],
+                               n=hyperarchetype['sigla'], type='hyperarchetype'))
+    output.append(u'</listWit></sourceDesc></fileDesc></teiHeader>')
+    for witness in data['witnesses']:
+        if witness['facsimiles']:
+            output.append(u'<facsimile corresp="#%s">' % _witness_id(
+                    data, witness))
+            for image in witness['facsimiles']:
+                output.append(u'<surface n=%s><graphic url=%s/></surface>' % (
+                        quoteattr(u'%s%s' % (image['folio_number'] or
+                                             image['page'] or u'',
+                                             image['folio_side'])),
+                        quoteattr(image['filepath'])))
+            output.append(u'</facsimile>')
+    output.append(u'<text><front>%s</front><body>' % _element(
+            'div', data['introduction'], type='introduction'))
+    output.append(_element('div', data['text'], type='edition'))
+    output.append(_element('div', data['translation'], type='translation'))
+    for witness in data['witnesses']:
+        output.append(_element('div', witness['transcription'],
+                               type='transcription',
+                               corresp='#%s' % _witness_id(data, witness)))
+    output.append(u'</body><back>')
+    for commentary in data['commentaries']:
+        output.append(_element('note', commentary['text'], type='commentary',
+                               target=commentary['element_id'] and
+                               '#%s' % commentary['element_id'],
+                               resp=commentary['user'],
+                               when=commentary['updated']))
+    output.append(u'</back></text></TEI>\n')
+    return u''.join(output).encode('utf-8')
+
+
+def export_tei (editions=None, chunk_size=CHUNK_SIZE, header=True):
+    """Yields a teiCorpus of the editions, one TEI element at a time
+    (without the teiCorpus element if header is False)."""
+    if header:
+        yield tei_header()
+    for data in iter_editions(editions, chunk_size):
+        yield edition_to_tei(data)
+    if header:
+        yield tei_footer()
+
+
+def write_shards (format, directory, editions=None, shard_size=None,
+                  compress=False, chunk_size=CHUNK_SIZE):
+    """Writes the export to directory/editions-<n>.<extension>[.gz], with
+    at most shard_size editions per file (all of them in one file by
+    default). Returns the paths of the files."""
+    extension = FORMATS[format][0]
+    if compress:
+        extension += '.gz'
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    paths = []
+    output = None
+    count = 0
+    try:
+        for data in iter_editions(editions, chunk_size):
+            if output is None:
+                paths.append(os.path.join(directory, 'editions-%04d.%s' % (
+                            len(paths) + 1, extension)))
+                output = (compress and gzip.open or open)(paths[-1], 'wb')
+                if format == 'tei':
+                    output.write(tei_header())
+            if format == 'tei':
+                output.write(edition_to_tei(data))
+            else:
+                output.write('%s\n' % simplejson.dumps(data))
+            count += 1
+            if shard_size and not count % shard_size:
+                if format == 'tei':
+                    output.write(tei_footer())
+                output.close()
+                output = None
+        if output is not None and format == 'tei':
+            output.write(tei_footer())
+    finally:
+        if output is not None:
+            output.close()
+    return paths
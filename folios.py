@@ -0,0 +1,90 @@
+"""Folio numbers and sides, as written in file names and folio
+references (e.g. '12', '10a', '012v' or '123r')."""
+
+import re
+
+
+# Folio number and side at the end of a string, e.g. 012v or MS_12_f.3r
+FOLIO_RE = re.compile(r'(\d+)([a-z]??)\s*([rv])?$', re.IGNORECASE)
+FOLIO_NUMBER_RE = re.compile(r'^0*(\d+)([a-z]?)$', re.IGNORECASE)
+NATURAL_SORT_RE = re.compile(r'(\d+)')
+
+# FolioSide names of each side letter
+SIDE_NAMES = {'r': ('r', 'recto'), 'v': ('v', 'verso')}
+
+
+def natural_sort_key (value):
+    """Returns a key sorting '2v' before '10r' and '10' before '10a'."""
+    return [part.isdigit() and int(part) or part.lower()
+            for part in NATURAL_SORT_RE.split(value)]
+
+
+def parse_folio (value):
+    """Returns the (folio number, side letter) at the end of value, without
+    the leading zeros of the number. Both are empty strings when they
+    can't be read."""
+    match = FOLIO_RE.search(value.strip())
+    if match is None:
+        return '', ''
+    number, suffix, side = match.groups()
+    return (number.lstrip('0') or '0') + suffix.lower(), (side or '').lower()
+
+
+def side_letter (name):
+    """Returns the side letter ('r' or 'v') of a FolioSide name, or an
+    empty string."""
+    name = (name or '').lower()
+    for letter, names in SIDE_NAMES.items():
+        if name in names:
+            return letter
+    return ''
+
+
+def folio_key (number, side='', end=False):
+    """Returns an integer sorting folio (or page) numbers and sides
+    numerically: 9v < 10 < 10r < 10v < 10a < 10ar.
+
+    Without a side (or suffix letter), the key of the end of a range
+    (end=True) comes after all the sides (and suffixes) of the number.
+    Returns None if number can't be read."""
+    match = FOLIO_NUMBER_RE.match((number or '').strip())
+    if match is None:
+        return None
+    number, suffix = match.groups()
+    if suffix:
+        suffix = ord(suffix.lower()) - ord('a') + 1
+    else:
+        suffix = end and 26 or 0
+    if side:
+        side = side_rank(side) + 1
+    else:
+        side = end and 3 or 0
+    return (int(number) * 27 + suffix) * 4 + side
+
+
+def reference_key (reference, end=False):
+    """Returns the folio_key of a folio reference such as '30r' or
+    'f. 41v'."""
+    number, side = parse_folio(reference or '')
+    return folio_key(number, side, end)
+
+
+def side_rank (name):
+    """Returns the position of a FolioSide name in a reading of the folio:
+    recto, verso, then the other sides."""
+    name = (name or '').lower()
+    for rank, letter in enumerate(('r', 'v')):
+        if name in SIDE_NAMES[letter]:
+            return rank
+    return 2
+
+
+def reading_order_key (display_order, folio_number, folio_side, filename_sort_order, filename, pk):
+    """Returns the sort key of a FolioImage in the reading order of its
+    manuscript: by display order, then folio number, side and position
+    of the file. Missing values come last."""
+    return (display_order is None, display_order,
+            not folio_number, natural_sort_key(folio_number or ''),
+            side_rank(folio_side),
+            filename_sort_order is None, filename_sort_order,
+            natural_sort_key(filename or ''), pk)
@@ -0,0 +1,204 @@
+"""Cache of the rendered fragments of editions.
+
+A fragment is any piece of an edition rendered by the project (text,
+translation, introduction, apparatus...). It is cached under the name of
+the fragment, the edition and a hash of the content it depends on: the
+edition, its version and work, editors, hyperarchetypes and commentaries.
+
+    html = fragments.get_fragment(edition, 'text', render_text)
+
+or in a template:
+
+    {% load legal_editions_fragments %}
+    {% edition_fragment edition "text" %}...{% endedition_fragment %}
+
+The content hash of each edition is itself cached, so that a hit doesn't
+query the database. The signals of the models above delete it; the next
+read computes it again and, if the content did change, renders the
+fragments again. As a read between a change and the commit of its
+transaction can cache the former hash again, the hashes are only kept
+for LEGAL_EDITIONS_FRAGMENT_HASH_TIMEOUT seconds (default: 60). The cache is the LEGAL_EDITIONS_FRAGMENT_CACHE alias of
+the CACHES setting (default: 'default'), so any Django cache backend can
+be used (local memory, file, memcached...).
+"""
+
+import threading
+
+from django.conf import settings
+from django.core.cache import get_cache
+from django.db.models import get_model, signals
+from django.utils.hashcompat import md5_constructor
+
+
+KEY_PREFIX = 'legal_editions:fragment'
+
+_cache = None
+_stats = {'hits': 0, 'misses': 0}
+_stats_lock = threading.Lock()
+
+
+def get_fragment_cache ():
+    global _cache
+    if _cache is None:
+        _cache = get_cache(getattr(settings, 'LEGAL_EDITIONS_FRAGMENT_CACHE',
+                                   'default'))
+    return _cache
+
+
+def get_timeout ():
+    return getattr(settings, 'LEGAL_EDITIONS_FRAGMENT_TIMEOUT', 60 * 60 * 24)
+
+
+def get_hash_timeout ():
+    return getattr(settings, 'LEGAL_EDITIONS_FRAGMENT_HASH_TIMEOUT', 60)
+
+
+def get_content_hash (edition):
+    """Returns the MD5 digest of the content the fragments of an edition
+    depend on (4 queries)."""
+    model = get_model('legal_editions', 'Edition')
+    edition = model.objects.select_related('version__work').get(pk=edition.pk)
+    version = edition.version
+    content = [
+        (edition.abbreviation, edition.text, edition.translation,
+         edition.introduction, unicode(edition.date), edition.status_id),
+        (version.pk, version.standard_abbreviation, version.name,
+         version.synopsis, version.slug, version.work.name),
+        list(edition.editors.values_list('id', 'abbreviation', 'first_name',
+                                         'last_name')),
+        list(edition.hyperarchetype_set.values_list('id', 'sigla',
+                                                    'description')),
+        list(edition.commentary_set.values_list(
+                'id', 'text', 'user', 'element_id', 'updated',
+                'sort_order')),
+        ]
+    return md5_constructor(repr(content)).hexdigest()
+
+
+def _get_hash_key (edition_id):
+    return '%s:hash:%s' % (KEY_PREFIX, edition_id)
+
+
+def get_cached_content_hash (edition):
+    cache = get_fragment_cache()
+    key = _get_hash_key(edition.pk)
+    content_hash = cache.get(key)
+    if content_hash is None:
+        content_hash = get_content_hash(edition)
+        cache.set(key, content_hash, get_hash_timeout())
+    return content_hash
+
+
+def _count (name):
+    _stats_lock.acquire()
+    try:
+        _stats[name] += 1
+    finally:
+        _stats_lock.release()
+
+
+def get_fragment (edition, name, render, *args, **kwargs):
+    """Returns the fragment name of edition, from the cache or else
+    rendered by render(edition, *args, **kwargs). args and kwargs must be
+    part of the name if they change the result."""
+    cache = get_fragment_cache()
+    key = '%s:%s:%s:%s' % (KEY_PREFIX, md5_constructor(name).hexdigest(),
+                           edition.pk, get_cached_content_hash(edition))
+    fragment = cache.get(key)
+    if fragment is None:
+        _count('misses')
+        fragment = render(edition, *args, **kwargs)
+        cache.set(key, fragment, get_timeout())
+    else:
+        _count('hits')
+    return fragment
+
+
+def get_stats ():
+    """Returns the hits, misses and hit ratio of the fragments read by
+    this process."""
+    _stats_lock.acquire()
+    try:
+        stats = dict(_stats)
+    finally:
+        _stats_lock.release()
+    total = stats['hits'] + stats['misses']
+    stats['ratio'] = total and float(stats['hits']) / total or 0.0
+    return stats
+
+
+def reset_stats ():
+    _stats_lock.acquire()
+    try:
+        _stats['hits'] = _stats['misses'] = 0
+    finally:
+        _stats_lock.release()
+
+
+def invalidate (edition_ids):
+    """Forgets the content hashes of some editions."""
+    keys = [_get_hash_key(pk) for pk in edition_ids]
+    if keys:
+        get_fragment_cache().delete_many(keys)
+
+
+def _get_edition_ids (sender, instance):
+    name = sender._meta.object_name
+    if name == 'Edition':
+        return [instance.pk]
+    if name in ('Commentary', 'Hyperarchetype'):
+        return [instance.edition_id]
+    editions = get_model('legal_editions', 'Edition').objects
+    if name == 'Version':
+        return editions.filter(version=instance).values_list('id', flat=True)
+    if name == 'Work':
+        return editions.filter(version__work=instance).values_list('id',
+                                                                   flat=True)
+    if name == 'Editor':
+        # the links of a deleted editor are gone, see _remember_editions
+        if '_fragment_edition_ids' in instance.__dict__:
+            return instance.__dict__.pop('_fragment_edition_ids')
+        return editions.filter(editors=instance).values_list('id', flat=True)
+    return []
+
+
+def _remember_editions (sender, instance, **kwargs):
+    # the links of an editor to its editions are deleted without signals
+    # before the post_delete signal of the editor
+    if (sender._meta.app_label, sender._meta.object_name) != (
+        'legal_editions', 'Editor'):
+        return
+    instance._fragment_edition_ids = list(instance.edition_set.values_list(
+            'id', flat=True))
+
+
+def _invalidate_fragments (sender, instance, **kwargs):
+    if sender._meta.app_label != 'legal_editions' or kwargs.get('raw'):
+        return
+    invalidate(_get_edition_ids(sender, instance))
+
+
+def _invalidate_editors (sender, instance, action, reverse, pk_set, **kwargs):
+    # changes of Edition.editors, from either side
+    edition = sender._meta.auto_created
+    if (not edition or edition._meta.app_label != 'legal_editions' or
+        edition._meta.object_name != 'Edition'):
+        return
+    if action == 'pre_clear' and reverse:
+        # the editions of an editor are gone after the clear
+        instance._fragment_edition_ids = list(instance.edition_set.values_list(
+                'id', flat=True))
+    if not action.startswith('post_'):
+        return
+    if not reverse:
+        invalidate([instance.pk])
+    elif action == 'post_clear':
+        invalidate(instance.__dict__.pop('_fragment_edition_ids', []))
+    else:
+        invalidate(pk_set)
+
+
+signals.pre_delete.connect(_remember_editions)
+signals.post_save.connect(_invalidate_fragments)
+signals.post_delete.connect(_invalidate_fragments)
+signals.m2m_changed.connect(_invalidate_editors)
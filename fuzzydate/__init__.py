@@ -1,3 +1,6 @@
 # make available at this level
 from fields import FuzzyDateField
-from core import FuzzyDate
\ No newline at end of file
+from query import FuzzyDateManager, FuzzyDateQuerySet, fuzzyDateQ
+from core import FuzzyDate, FrozenFuzzyDate, parseDateStrings, formatDates
+# connects the signals that keep the interval index up to date
+import intervals
\ No newline at end of file
@@ -0,0 +1,51 @@
+'''
+Micro-benchmark of the memoized parser of FuzzyDate.setAsString():
+
+    python -m legal_editions.fuzzydate.benchmark [number of strings]
+
+(with DJANGO_SETTINGS_MODULE set, as the package imports the fields).
+
+Times setAsString() on a mix of date strings with the parse cache of
+parseDateString() and with a cache that keeps nothing, i.e. the single
+pass parser alone.
+'''
+import sys
+import time
+
+import core
+from cache import LRUCache
+
+# the kind of strings read over and over from the forms and imports
+DATESTRS = ['c. 1066 to 1087', '12-1066', '?1100', '1-1-1200 to 31-12-1250',
+            '1066', 'c. 900', '?c. 1000 - 1050', '10-1100, 12-1100']
+
+def timeSetAsString(datestrs, cache=None):
+    ''' returns the seconds taken by setAsString() on each string,
+        with cache as the parse cache if given '''
+    saved = core._parse_cache
+    if cache is not None: core._parse_cache = cache
+    try:
+        start = time.time()
+        for datestr in datestrs:
+            core.FuzzyDate().setAsString(datestr)
+        return time.time() - start
+    finally:
+        core._parse_cache = saved
+
+def benchmarkParsing(count=20000):
+    ''' returns the seconds taken to parse count strings (uncached, cached) '''
+    datestrs = (DATESTRS * (count // len(DATESTRS) + 1))[:count]
+    uncached = timeSetAsString(datestrs, LRUCache(0))
+    core._parse_cache.clear()
+    cached = timeSetAsString(datestrs)
+    return uncached, cached
+
+def main(argv):
+    count = 20000
+    if len(argv) > 1: count = int(argv[1])
+    uncached, cached = benchmarkParsing(count)
+    print 'setAsString() x %d: %.3fs without the cache, %.3fs with it (x%.1f)' % (
+        count, uncached, cached, uncached / max(cached, 1e-6))
+
+if __name__ == '__main__':
+    main(sys.argv)
@@ -0,0 +1,61 @@
+"""
+A small bounded least-recently-used cache.
+
+Python 2 has no functools.lru_cache, so this is the minimal version we need
+to memoise the (pure) parsing and formatting of fuzzy dates. Values stored in
+the cache must be immutable as they are shared between all the callers.
+"""
+
+import threading
+from collections import OrderedDict
+
+_missing = object()
+
+class LRUCache(object):
+
+    def __init__(self, maxsize=4096):
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        self._lock.acquire()
+        try:
+            value = self._data.pop(key, _missing)
+            if value is _missing:
+                self.misses += 1
+                return default
+            # re-insert to mark the key as the most recently used
+            self._data[key] = value
+            self.hits += 1
+            return value
+        finally:
+            self._lock.release()
+
+    def set(self, key, value):
+        self._lock.acquire()
+        try:
+            self._data.pop(key, None)
+            self._data[key] = value
+            while len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+        finally:
+            self._lock.release()
+
+    def clear(self):
+        self._lock.acquire()
+        try:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+        finally:
+            self._lock.release()
+
+    def getStats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'size': len(self._data), 'maxsize': self.maxsize}
+
+    def __len__(self):
+        return len(self._data)
@@ -2,20 +2,121 @@
 import datetime
 import calendar
 import re
+from array import array
 from enum import Enum
+from cache import LRUCache
 
 modifiers = Enum()
 modifiers.addElement('DEFAULT', {'symbol': ''})
 modifiers.addElement('CIRCA', {'symbol': 'c. '})
 modifiers.addElement('UNCERTAIN', {'symbol': '?'})
 
+# ordinal used in the sort keys of undefined dates, after any valid date
+UNDEFINED_ORDINAL = datetime.date.max.toordinal() + 1
+
+def getSortKey(date):
+    ''' returns the sort key of a FuzzyDate, None sorts with the undefined
+        dates. e.g. sorted(versions, key=lambda v: getSortKey(v.date))
+    '''
+    if date is None: return (UNDEFINED_ORDINAL, UNDEFINED_ORDINAL, modifiers.DEFAULT.id)
+    return date.getSortKey()
+
+# Precompiled patterns used by parseDateString()
+_re_trim = re.compile(r'(^\s*)|(\s*$)')
+_re_circa = re.compile(r'^c\.\s*')
+_re_uncertain = re.compile(r'^\?\s*')
+_re_range = re.compile(r'\s+to\s+|\s+-\s+|\s*,\s+|\s+')
+# same formats as FuzzyDate.isFormatValid() but capturing each part
+_re_date_uk = re.compile(r'^(?:(\d{1,2})[/-])?(?:(\d{1,2})[/-])?(\d{1,4})$')
+_re_date_iso = re.compile(r'^(\d{1,4})(?:[/-](\d{1,2}))?(?:[/-](\d{1,2}))?$')
+
+_re_date_separator = re.compile(r'[/-]')
+
+# (datestr, ukFormat) -> parse result, see parseDateString()
+_parse_cache = LRUCache(8192)
+# (method, date from, date to, modifier id, ukFormat) -> rendered string,
+# see FuzzyDate.getAsString() and FuzzyDate.getWebFormat()
+_render_cache = LRUCache(16384)
+
+def getCacheStats():
+    ''' returns the hits, misses and size of the caches used by this module '''
+    return {
+        'parse': _parse_cache.getStats(),
+        'instances': _frozen_cache.getStats(),
+        'render': _render_cache.getStats(),
+    }
+
+def parseDateString(datestr, ukFormat=True):
+    ''' Parses a non-empty fuzzy date string (e.g. 'c. 1066 to 1087').
+        return :    an immutable tuple (modifier id, date from, date to, error)
+                    the dates are None and error is a message if the string
+                    is not valid.
+        The results are cached as the same strings get parsed over and over.
+    '''
+    ukFormat = bool(ukFormat)
+    key = (datestr, ukFormat)
+    ret = _parse_cache.get(key)
+    if ret is None:
+        ret = _parseDateString(datestr, ukFormat)
+        _parse_cache.set(key, ret)
+    return ret
+
+def _parseDateString(datestr, ukFormat):
+    # single pass equivalent of the original FuzzyDate.setAsString(),
+    # it must return exactly the same dates and error messages.
+    datestr = _re_trim.sub('', datestr)
+    modifier = modifiers.DEFAULT.id
+    match = _re_circa.match(datestr)
+    if match:
+        datestr = datestr[match.end():]
+        modifier = modifiers.CIRCA.id
+    match = _re_uncertain.match(datestr)
+    if match:
+        datestr = datestr[match.end():]
+        modifier = modifiers.UNCERTAIN.id
+    # split the range: '-' or 'to'
+    parts = _re_range.split(datestr)
+    if (not(len(parts) in (1, 2))):
+        return (modifier, None, None, 'invalid date format')
+    # validate each date in the range and extract [year, month, day]
+    pattern = _re_date_iso
+    if ukFormat: pattern = _re_date_uk
+    values = []
+    for part in parts:
+        match = pattern.match(part)
+        if match is None:
+            return (modifier, None, None, 'invalid date format')
+        value = [int(v) for v in match.groups() if v is not None]
+        if ukFormat: value.reverse()
+        values.append(value)
+    # expand both dates (the end of the range first, like the original code)
+    try:
+        date_to = _getMaxDate(values[-1])
+        date_from = _getMinDate(values[0])
+    except ValueError, e:
+        return (modifier, None, None, e.__str__())
+    return (modifier, date_from, date_to, None)
+
+# [2009] -> 2009-01-01
+def _getMinDate(value):
+    return datetime.date(value[0], (value[1:2] or [1])[0], (value[2:3] or [1])[0])
+
+# [2009] -> 2009-12-31
+def _getMaxDate(value):
+    if len(value) == 3:
+        return datetime.date(value[0], value[1], value[2])
+    month = 12
+    if len(value) == 2: month = value[1]
+    # validates the year and month before asking for the length of the month
+    datetime.date(value[0], month, 1)
+    return datetime.date(value[0], month, calendar.monthrange(value[0], month)[1])
+
 # date1 <= date <= date2 
 # represents an approximate date into an inclusive date range
 # Please run the regression test after modifying the code to make sure it is bug-free
 # See tester.py
 #
 # Todo:
-#    comparison
 #    support 196* or 12** format
 #    notes
 #    before X
@@ -24,11 +125,10 @@ modifiers.addElement('UNCERTAIN', {'symbol': '?'})
 #    less than 4 digits for the year
 #
 class FuzzyDate(object):
-    dates = [datetime.date.today(), datetime.date.today()]
-    modifier = modifiers.DEFAULT
-    lastError = u''
-    # if False the format is iso-8109
-    ukFormat = True
+    # no __dict__, see also FrozenFuzzyDate
+    # dates: [date from, date to]
+    # ukFormat: if False the format is iso-8109
+    __slots__ = ('dates', 'modifier', 'lastError', 'ukFormat')
     
     def isUndefined(self):
         return (self.dates[0] == None)
@@ -61,6 +161,8 @@ class FuzzyDate(object):
     def __new__(cls, date_from=None, date_to=None, modifier=modifiers.DEFAULT):
         self = object.__new__(cls)
         self.modifier = modifier
+        self.lastError = u''
+        self.ukFormat = True
         if (date_from == None):
             date_from = datetime.date.today()
         if (date_to == None):
@@ -78,44 +180,19 @@ class FuzzyDate(object):
         return self.modifier
     
     def setModifier(self, modifier):
-        self.modifer = modifier
+        self.modifier = modifier
     
     def setAsString(self, datestr):
         if (datestr == None or datestr == ''): 
             self.dates[0] = None
             self.dates[1] = None
             return True
-        # trim left and right
-        datestr = re.sub(r'(^\s*)|(\s*$)', '', datestr)
-        self.modifier = modifiers.DEFAULT
-        # get the modifier
-        if (re.search(r'^c\.', datestr)):
-            datestr = re.sub(r'^c\.\s*', '', datestr)
-            self.modifier = modifiers.CIRCA
-        if (re.search(r'^\?\s*', datestr)):
-            datestr = re.sub(r'^\?\s*', '', datestr)
-            self.modifier = modifiers.UNCERTAIN
-        # split the range: '-' or 'to'
-        dates = re.split('\s+to\s+|\s+-\s+|\s*,\s+|\s+', datestr)
-        if (not(len(dates) in (1, 2))):
-            return self.setLastError('invalid date format')
-        # validate each date in the range
-        for date in dates:
-            if (not self.isFormatValid(date)):
-                return self.setLastError('invalid date format')
-        # expand both dates (express them with the month and day)
-        try:
-            if (len(dates) == 2):
-                dates[1] = self.getMaxDateFromStr(dates[1])
-            else:
-                dates.append(self.getMaxDateFromStr(dates[0]))
-            dates[0] = self.getMinDateFromStr(dates[0])
-        except ValueError, e:
-            self.setLastError(e.__str__())
+        modifier, date_from, date_to, error = parseDateString(datestr, self.ukFormat)
+        self.modifier = modifiers.getElement(modifier)
+        if error is not None:
+            self.setLastError(error)
             return False
-            
-        self.dates = dates
-        
+        self.dates = [date_from, date_to]
         return True
     
     def setLastError(self, message):
@@ -125,6 +202,14 @@ class FuzzyDate(object):
     def getLastError(self):
         return self.lastError
     
+    def __getstate__(self):
+        # slots without __getstate__ can't be pickled with the old protocols
+        return dict([(name, getattr(self, name)) for name in FuzzyDate.__slots__])
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
     def __repr__(self):
         # only used for showing internal representation of the object
         if (self.dates[0] == None): return repr(self.dates[0])
@@ -142,38 +227,46 @@ class FuzzyDate(object):
 
     def getAsString(self, simplified_dates=None):
         if self.dates[0] == None: return ''
-        dates = []
-        # 1. reduce each date
-        for date in self.dates:
-            # reduce each end of the interval
-            # remove the day, the month if they correspond to the beginning/end of a month or a year
-            adate = date.__str__()
-            while True:
-                reduced_date = re.sub(r'-\d+$', '', adate)
-                if (reduced_date == adate or # ??? 
-                    (len(dates) == 0 and self.getMinDateFromStr(reduced_date, False) != date) or 
-                    (len(dates) == 1 and self.getMaxDateFromStr(reduced_date, False) != date)):
-                    break
-                adate = reduced_date
-            dates.append(adate)
+        key = ('getAsString',) + self._getRenderKey()
+        cached = _render_cache.get(key)
+        if cached is None:
+            dates = self._getSimplifiedDates()
+            # simplification if both dates are identical
+            if (dates[0] == dates[1]):
+                cached = ("%s%s" % (self.modifier.symbol, dates[0]), dates[:1])
+            else:
+                cached = ("%s%s to %s" % (self.modifier.symbol, dates[0], dates[1]), dates)
+            _render_cache.set(key, cached)
+        if simplified_dates is not None: simplified_dates.extend(cached[1])
+        return cached[0]
+
+    def _getRenderKey(self):
+        # identifies the rendered strings in the cache
+        return (self.dates[0], self.dates[1], self.modifier.id, bool(self.ukFormat))
+
+    def _getSimplifiedDates(self):
+        # (1066-01-01, 1087-12-31) -> ('1066', '1087')
+        date_from, date_to = self.dates[0], self.dates[1]
+        # 1. reduce each end of the interval
+        # remove the day, the month if they correspond to the beginning/end of a month or a year
+        parts_from = 3
+        if date_from.day == 1:
+            parts_from = 2
+            if date_from.month == 1: parts_from = 1
+        parts_to = 3
+        if date_to.day == calendar.monthrange(date_to.year, date_to.month)[1]:
+            parts_to = 2
+            if date_to.month == 12: parts_to = 1
         # 2. reduce both dates to the same unit of time
-        # if date[0]=2009 and date[1]=2009-11 then chop = 1
-        chop = 2 - max(dates[0].count('-'), dates[1].count('-'))
-        dates = [self.dates[0].__str__(), self.dates[1].__str__()]
-        while chop:
-            for i in (0, 1):
-                dates[i] = re.sub(r'-\d+$', '', dates[i])
-            chop = chop - 1
-        # 3. simplification if both dates are identical
-        if (self.ukFormat):
-            for i in (0, 1):
-                dates[i] = self.reverseDateFormat(dates[i])
-        if simplified_dates is not None: simplified_dates.append(dates[0])
-        if (dates[0] == dates[1]): 
-            return "%s%s" % (self.modifier.symbol, dates[0])
-        else:
-            if simplified_dates is not None: simplified_dates.append(dates[1]) 
-            return "%s%s to %s" % (self.modifier.symbol, dates[0], dates[1])
+        # if date[0]=2009 and date[1]=2009-11 then both keep the month
+        parts = max(parts_from, parts_to)
+        dates = []
+        for date in (date_from, date_to):
+            if (self.ukFormat):
+                dates.append('-'.join(['%d' % v for v in (date.day, date.month, date.year)[3 - parts:]]))
+            else:
+                dates.append(date.__str__()[:(4, 7, 10)[parts - 1]])
+        return tuple(dates)
     
     # 2009 -> 2009-01-01
     def getMinDateFromStr(self, datestr, ukFormat=None):
@@ -227,13 +320,20 @@ class FuzzyDate(object):
         return '-'.join(date)
 
     def getWebFormat(self):
-        import re
+        key = ('getWebFormat',) + self._getRenderKey()
+        ret = _render_cache.get(key)
+        if ret is None:
+            ret = self._getWebFormat()
+            _render_cache.set(key, ret)
+        return ret
+
+    def _getWebFormat(self):
         # 31-12-2010 -> 21 December 2010
         dates = []
         month_name = ['January', 'February', 'March', 'April', 'May', 'June', 'July', 'August', 'September', 'October', 'November', 'December']
         ret = self.getAsString(dates)
         for i in range(0, len(dates)):
-            d_parts = re.split('[/-]', dates[i])
+            d_parts = _re_date_separator.split(dates[i])
             if len(d_parts) > 1: d_parts[len(d_parts) - 2] = month_name[int(d_parts[len(d_parts) - 2]) - 1]
             if len(d_parts) == 3: d_parts[0] = '%d' % int(d_parts[0])
             dates[i] = ' '.join(d_parts)
@@ -269,6 +369,227 @@ class FuzzyDate(object):
             ret = u'c.%s' % ret
         return ret
 
+    # comparison
+    # FuzzyDates are ordered by (start, end, modifier), undefined dates last.
+    # For large lists, sorting with key=operator.attrgetter('sortKey')
+    # compares the keys in C rather than calling __lt__.
+    # Note that FuzzyDate is mutable: don't modify it while it is in a set or
+    # a dictionary key, use a FrozenFuzzyDate instead.
+
+    def getSortKey(self):
+        ''' returns (start ordinal, end ordinal, modifier id) '''
+        if self.isUndefined():
+            return (UNDEFINED_ORDINAL, UNDEFINED_ORDINAL, self.modifier.id)
+        return (self.getDateFrom().toordinal(), self.getDateTo().toordinal(), self.modifier.id)
+
+    sortKey = property(getSortKey)
+
+    def __eq__(self, other):
+        if not isinstance(other, FuzzyDate): return NotImplemented
+        return self.getSortKey() == other.getSortKey()
+
+    def __ne__(self, other):
+        if not isinstance(other, FuzzyDate): return NotImplemented
+        return self.getSortKey() != other.getSortKey()
+
+    def __lt__(self, other):
+        if not isinstance(other, FuzzyDate): return NotImplemented
+        return self.getSortKey() < other.getSortKey()
+
+    def __le__(self, other):
+        if not isinstance(other, FuzzyDate): return NotImplemented
+        return self.getSortKey() <= other.getSortKey()
+
+    def __gt__(self, other):
+        if not isinstance(other, FuzzyDate): return NotImplemented
+        return self.getSortKey() > other.getSortKey()
+
+    def __ge__(self, other):
+        if not isinstance(other, FuzzyDate): return NotImplemented
+        return self.getSortKey() >= other.getSortKey()
+
+    def __hash__(self):
+        return hash(self.getSortKey())
+
+    def freeze(self):
+        ''' returns an immutable copy of this date, see FrozenFuzzyDate '''
+        if self.isUndefined():
+            return FrozenFuzzyDate.fromOrdinals(None, None, self.modifier.id)
+        return FrozenFuzzyDate.getInstance(self.getDateFrom(), self.getDateTo(), self.modifier.id)
+
+# (date from, date to, modifier id) -> shared FrozenFuzzyDate instance
+_frozen_cache = LRUCache(8192)
+
+class FrozenFuzzyDate(FuzzyDate):
+    ''' An immutable and hashable FuzzyDate.
+        Both ends of the range are stored as proleptic Gregorian ordinals and
+        the modifier as its id, in slots along with the sort key. Used for
+        the values read from the model fields (see fields.FuzzyDateCreator),
+        call thaw() to get a FuzzyDate that can be modified.
+    '''
+    __slots__ = ('_from', '_to', '_mod', 'sortKey')
+
+    # instead of the inherited slots, which are left empty
+    lastError = u''
+    ukFormat = True
+
+    def __new__(cls, date_from=None, date_to=None, modifier=modifiers.DEFAULT):
+        if (date_from == None):
+            date_from = datetime.date.today()
+        if (date_to == None):
+            date_to = date_from
+        return cls.fromOrdinals(date_from.toordinal(), date_to.toordinal(), modifier.id)
+
+    @classmethod
+    def fromOrdinals(cls, date_from, date_to, modifier=0):
+        ''' date_from, date_to: ordinals or None (undefined date)
+            modifier:           the id of the modifier
+        '''
+        self = object.__new__(cls)
+        object.__setattr__(self, '_from', date_from)
+        object.__setattr__(self, '_to', date_to)
+        object.__setattr__(self, '_mod', modifier)
+        if date_from is None:
+            object.__setattr__(self, 'sortKey', (UNDEFINED_ORDINAL, UNDEFINED_ORDINAL, modifier))
+        else:
+            object.__setattr__(self, 'sortKey', (date_from, date_to, modifier))
+        return self
+
+    @classmethod
+    def getInstance(cls, date_from, date_to=None, modifier=0):
+        ''' returns a shared instance for the given dates and modifier id '''
+        if date_to is None: date_to = date_from
+        key = (date_from, date_to, modifier)
+        ret = _frozen_cache.get(key)
+        if ret is None:
+            ret = cls.fromOrdinals(date_from.toordinal(), date_to.toordinal(), modifier)
+            _frozen_cache.set(key, ret)
+        return ret
+
+    def _getDates(self):
+        return (self.getDateFrom(), self.getDateTo())
+
+    dates = property(_getDates)
+
+    def _getModifier(self):
+        return modifiers.getElement(self._mod)
+
+    modifier = property(_getModifier)
+
+    def isUndefined(self):
+        return self._from is None
+
+    def _getRenderKey(self):
+        return (self._from, self._to, self._mod, True)
+
+    def getDateFrom(self):
+        if self._from is None: return None
+        return datetime.date.fromordinal(self._from)
+
+    def getDateTo(self):
+        if self._to is None: return None
+        return datetime.date.fromordinal(self._to)
+
+    def __setattr__(self, name, value):
+        raise AttributeError('FrozenFuzzyDate instances are immutable')
+
+    def __delattr__(self, name):
+        raise AttributeError('FrozenFuzzyDate instances are immutable')
+
+    def setAsString(self, datestr):
+        raise AttributeError('FrozenFuzzyDate instances are immutable')
+
+    def getSortKey(self):
+        return self.sortKey
+
+    def __hash__(self):
+        return hash(self.sortKey)
+
+    def __reduce__(self):
+        # slots without __getstate__ can't be pickled with the old protocols
+        return (_unpickleFrozenFuzzyDate, (self._from, self._to, self._mod))
+
+    def freeze(self):
+        return self
+
+    def thaw(self):
+        ''' returns a (mutable) FuzzyDate equal to this date '''
+        ret = FuzzyDate(modifier=self.modifier)
+        ret.dates = [self.getDateFrom(), self.getDateTo()]
+        return ret
+
+def _unpickleFrozenFuzzyDate(date_from, date_to, modifier):
+    return FrozenFuzzyDate.fromOrdinals(date_from, date_to, modifier)
+
+# Bulk API
+#
+# Columnar equivalent of FuzzyDate.setAsString() and of the formatting
+# methods for imports and exports. A date is stored across three arrays:
+# the ordinal of both ends of the range and the modifier id. Undefined
+# dates (empty strings) have 0 ordinals as no valid date has that ordinal.
+
+def parseDateStrings(datestrs, ukFormat=True):
+    ''' datestrs:   a sequence of date strings, e.g. ['c. 1066 to 1087', '']
+        return :    (starts, ends, modifiers, errors)
+                    starts, ends and modifiers are array.array of the same
+                    length as datestrs, errors is a dictionary that maps the
+                    index of each invalid string to the error message
+                    (also see FuzzyDate.getLastError()). The dates of
+                    invalid strings are undefined.
+    '''
+    starts = array('l')
+    ends = array('l')
+    mods = array('b')
+    errors = {}
+    parsed = {}
+    for i, datestr in enumerate(datestrs):
+        if (datestr == None or datestr == ''):
+            starts.append(0)
+            ends.append(0)
+            mods.append(modifiers.DEFAULT.id)
+            continue
+        ret = parsed.get(datestr)
+        if ret is None:
+            modifier, date_from, date_to, error = parseDateString(datestr, ukFormat)
+            if error is None:
+                ret = (date_from.toordinal(), date_to.toordinal(), modifier, None)
+            else:
+                ret = (0, 0, modifier, error)
+            parsed[datestr] = ret
+        starts.append(ret[0])
+        ends.append(ret[1])
+        mods.append(ret[2])
+        if ret[3] is not None: errors[i] = ret[3]
+    return (starts, ends, mods, errors)
+
+def formatDates(starts, ends, mods, method='getAsString', ukFormat=True):
+    ''' starts, ends, mods: sequences of ordinals and modifier ids as
+                            returned by parseDateStrings()
+        method:             the FuzzyDate formatting method to apply:
+                            'getAsString', 'getWebFormat' or 'getShortWebFormat'
+        return :            the list of formatted dates
+    '''
+    if method not in ('getAsString', 'getWebFormat', 'getShortWebFormat'):
+        raise ValueError('unsupported format method: %s' % method)
+    ret = []
+    formatted = {}
+    for key in zip(starts, ends, mods):
+        value = formatted.get(key)
+        if value is None:
+            if key[0] == 0:
+                # undefined date
+                value = ''
+                if method == 'getShortWebFormat': value = u'?'
+            else:
+                date = FrozenFuzzyDate.fromOrdinals(int(key[0]), int(key[1]), int(key[2]))
+                if not ukFormat:
+                    date = date.thaw()
+                    date.ukFormat = False
+                value = getattr(date, method)()
+            formatted[key] = value
+        ret.append(value)
+    return ret
+
 #    from ootw.cch.fuzzydate.core import FuzzyDate
 #    if date is not None:
 #        if date.__class__.__name__ == 'FuzzyDate' and date.getDateTo() is not None:
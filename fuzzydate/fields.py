@@ -69,22 +69,29 @@ TODO:
  * No support for many lookup types, including correct month, day or range
    lookups. They work, but on the internal date instance, without respecting
    the precision field. Not sure if this can even be done reasonably well.
+   Range queries that take the end of the range into account are provided by
+   query.FuzzyDateQuerySet instead (date__overlaps, date__within, ...).
  * In in and exact lookups will not exclude incomplete days either. Again, it
    doesn't appear as if this is something that will be easily doable.
 
 """
 
-from django.db import models
-from core import FuzzyDate, modifiers
+from django.db import connections, models, transaction, DatabaseError, DEFAULT_DB_ALIAS
+from django.db.backends.util import truncate_name
+from django.db.models import signals
+from core import FuzzyDate, FrozenFuzzyDate
 import forms
 
 __all__ = (
     'FuzzyDateField',
+    'getRangeIndexSQL',
+    'createRangeIndexes',
 )
 
 _precision_field_name = lambda name: "%s_precision"%name
 _date_to_field_name = lambda name: "%s_to"%name
 _date_mod_field_name = lambda name: "%s_mod"%name
+_date_cache_name = lambda name: "_%s_fuzzydate_cache"%name
 
 class FuzzyDateCreator(object):
     """
@@ -93,26 +100,38 @@ class FuzzyDateCreator(object):
     of callig to_python() on our FuzzyDateField class, it stores the two
     different party of a fuzzy date, the date and the precision, separately, and
     updates them whenever something is assigned. If the attribute is read, it
-    builds the FuzzyDate instance "on-demand" with the current data.
+    returns an immutable FrozenFuzzyDate for the current data. Equal dates
+    share the same instance.
+
+    The value is cached on the model instance until the date or one of the
+    hidden fields is assigned (see FuzzyDatePartCreator).
     """
     def __init__(self, field):
         self.field = field
         self.date_to_name = _date_to_field_name(self.field.name)
         self.date_mod_name = _date_mod_field_name(self.field.name)
+        self.cache_name = _date_cache_name(self.field.name)
 
     def __get__(self, obj, type=None):
         if obj is None:
             raise AttributeError('Can only be accessed via an instance.')
 
+        try:
+            return obj.__dict__[self.cache_name]
+        except KeyError:
+            pass
         date = obj.__dict__[self.field.name]
-        if date is None: return None
+        if date is None: ret = None
         else:
             modifier = 0
             if (self.field.useModifier):
                 modifier = getattr(obj, self.date_mod_name)
-            return FuzzyDate(date, getattr(obj, self.date_to_name), modifiers.getElement(modifier))
+            ret = FrozenFuzzyDate.getInstance(date, getattr(obj, self.date_to_name), modifier)
+        obj.__dict__[self.cache_name] = ret
+        return ret
 
     def __set__(self, obj, value):
+        obj.__dict__.pop(self.cache_name, None)
         if isinstance(value, FuzzyDate):
             # fuzzy date is assigned: take over it's values
             obj.__dict__[self.field.name] = value.getDateFrom()
@@ -127,15 +146,48 @@ class FuzzyDateCreator(object):
             # assigns to this while loading a row from the database, we want
             # to keep the precision that was already set!
 
+class FuzzyDatePartCreator(object):
+    """
+    Descriptor for the hidden fields of a fuzzy date (the end of the range and
+    the modifier). The values are stored in the instance dict as usual but
+    any assignment discards the FuzzyDate cached by FuzzyDateCreator.
+    """
+    def __init__(self, name, cache_name):
+        self.name = name
+        self.cache_name = cache_name
+
+    def __get__(self, obj, type=None):
+        if obj is None:
+            raise AttributeError('Can only be accessed via an instance.')
+        try:
+            return obj.__dict__[self.name]
+        except KeyError:
+            raise AttributeError(self.name)
+
+    def __set__(self, obj, value):
+        obj.__dict__.pop(self.cache_name, None)
+        obj.__dict__[self.name] = value
+
 class FuzzyDateField(models.DateField):
     
     useModifier = False
+    # composite indexes on (date, date_to) and optionally (date, date_to, mod)
+    # see getRangeIndexSQL()
+    rangeIndex = False
+    rangeIndexModifier = False
     
     def __init__(self, *args, **kwargs):
         if ('modifier' in kwargs):
             self.useModifier = (kwargs['modifier'] == True)
             # remove it from the kwargs otherwise the DateField will scream in horror.
             del kwargs['modifier']
+        if ('range_index' in kwargs):
+            self.rangeIndex = (kwargs['range_index'] == True)
+            del kwargs['range_index']
+        if ('range_index_modifier' in kwargs):
+            self.rangeIndexModifier = (kwargs['range_index_modifier'] == True)
+            if self.rangeIndexModifier: self.rangeIndex = True
+            del kwargs['range_index_modifier']
         # add help line to the help_text
         if not kwargs.has_key('help_text'):
             kwargs['help_text'] = ur''
@@ -158,6 +210,7 @@ class FuzzyDateField(models.DateField):
         # and when the date field is added later, it won't be sorted before it.
         date_to.creation_counter = self.creation_counter
         cls.add_to_class(_date_to_field_name(name), date_to)
+        setattr(cls, _date_to_field_name(name), FuzzyDatePartCreator(_date_to_field_name(name), _date_cache_name(name)))
 
         if (self.useModifier):
             # first, create a hidden "precision" field. It is *crucial* that this
@@ -170,6 +223,7 @@ class FuzzyDateField(models.DateField):
             # and when the date field is added later, it won't be sorted before it.
             date_modifier.creation_counter = self.creation_counter
             cls.add_to_class(_date_mod_field_name(name), date_modifier)
+            setattr(cls, _date_mod_field_name(name), FuzzyDatePartCreator(_date_mod_field_name(name), _date_cache_name(name)))
         
         # add the date field as normal
         super(FuzzyDateField, self).contribute_to_class(cls, name)
@@ -192,7 +246,7 @@ class FuzzyDateField(models.DateField):
         else:
             # let the base class deal with the rest; some will work out fine,
             # like 'year', others will probably give unexpected results,
-            # like 'range'.
+            # like 'range' (use query.FuzzyDateQuerySet lookups instead).
             return super(FuzzyDateField, self).get_db_prep_lookup(lookup_type, value)
 
     def formfield(self, **kwargs):
@@ -216,3 +270,65 @@ class FuzzyDateField(models.DateField):
     # Although we need flatten_data for (oldforms) admin, we don't need to
     # implement it here, as the DateField baseclass will just call strftime on
     # our FuzzyDate object, which is something we support.
+
+def getRangeIndexes(model, connection=None):
+    """
+    Returns the (name, columns) of the composite indexes requested by the
+    FuzzyDateFields of a model (range_index and range_index_modifier).
+    """
+    if connection is None:
+        from django.db import connection
+    opts = model._meta
+    ret = []
+    for field in opts.local_fields:
+        if not isinstance(field, FuzzyDateField) or not field.rangeIndex:
+            continue
+        columns = [field.column, opts.get_field(_date_to_field_name(field.name)).column]
+        suffix = 'range'
+        if field.rangeIndexModifier and field.useModifier:
+            columns.append(opts.get_field(_date_mod_field_name(field.name)).column)
+            suffix = 'range_mod'
+        name = truncate_name('%s_%s_%s' % (opts.db_table, field.column, suffix),
+                             connection.ops.max_name_length())
+        ret.append((name, columns))
+    return ret
+
+def getRangeIndexSQL(model, connection=None):
+    """
+    Returns the CREATE INDEX statements of the composite indexes requested by
+    the FuzzyDateFields of a model (range_index and range_index_modifier).
+    """
+    if connection is None:
+        from django.db import connection
+    qn = connection.ops.quote_name
+    return ['CREATE INDEX %s ON %s (%s);' % (qn(name), qn(model._meta.db_table),
+                                            ', '.join([qn(c) for c in columns]))
+            for name, columns in getRangeIndexes(model, connection)]
+
+def createRangeIndexes(model, using=DEFAULT_DB_ALIAS, verbosity=1):
+    """
+    Creates the composite indexes of a model in the database. This is done
+    by syncdb for new tables, use this (or the fuzzydate_indexes command) to
+    add them to existing tables. Indexes that already exist are skipped.
+    """
+    connection = connections[using]
+    cursor = connection.cursor()
+    for sql in getRangeIndexSQL(model, connection):
+        try:
+            cursor.execute(sql)
+        except DatabaseError, e:
+            transaction.rollback_unless_managed(using=using)
+            if verbosity >= 1:
+                print "Skipped index for %s (%s)" % (model._meta.object_name, e)
+        else:
+            transaction.commit_unless_managed(using=using)
+            if verbosity >= 2:
+                print sql
+
+def _createRangeIndexesOnSyncdb(sender, created_models, verbosity=1, db=DEFAULT_DB_ALIAS, **kwargs):
+    # sent once per application, with the models created for all of them
+    for model in models.get_models(sender):
+        if model in created_models:
+            createRangeIndexes(model, db, verbosity)
+
+signals.post_syncdb.connect(_createRangeIndexesOnSyncdb)
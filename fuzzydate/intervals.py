@@ -0,0 +1,289 @@
+"""
+In-memory index of the date ranges of all the records with a FuzzyDateField.
+
+Answers "which records could date from X" (stabbing) and "which records
+overlap X to Y" queries in O(log n + k) without touching the database:
+
+    from fuzzydate import intervals
+    keys = intervals.getIndex().overlapping('1066 to 1100')
+    works = intervals.getObjects(keys)
+
+Each range is identified by a key: (model label, field name, primary key),
+e.g. ('legal_editions.King', 'end_regnal_year', 12).
+
+The process-wide index is loaded from the database the first time it is
+used, then kept up to date by the post_save and post_delete signals. Changes
+made with QuerySet.update() don't send signals, call resetIndex() after
+them. The index can be pickled, use saveIndex() and loadIndex() to give
+worker processes a warm copy at startup.
+
+Implementation: an interval overlaps [a, b] if it contains a or if it begins
+in ]a, b]. The first set is found with a centered interval tree and the
+second with a binary search on the intervals sorted by beginning. Both are
+static structures, the records changed since they were built are kept aside
+and scanned linearly until there are enough of them to rebuild.
+"""
+
+import bisect
+import cPickle
+import datetime
+import threading
+
+from django.db import models
+from django.db.models import signals
+
+from fields import FuzzyDateField, _date_to_field_name
+from query import getDateRange
+
+__all__ = (
+    'IntervalIndex',
+    'getIndex',
+    'resetIndex',
+    'saveIndex',
+    'loadIndex',
+    'getObjects',
+)
+
+def _getModelLabel(model):
+    return '%s.%s' % (model._meta.app_label, model._meta.object_name)
+
+def _getOrdinals(value):
+    # value as accepted by query.getDateRange() -> (from, to) ordinals
+    date_from, date_to = getDateRange(value)
+    return (date_from.toordinal(), date_to.toordinal())
+
+def _buildTree(intervals):
+    # centered interval tree: [center, by start, by end desc, left, right]
+    # each node holds the intervals that contain its center.
+    if not intervals:
+        return None
+    points = sorted([i[0] for i in intervals] + [i[1] for i in intervals])
+    center = points[len(points) // 2]
+    here, left, right = [], [], []
+    for interval in intervals:
+        if interval[1] < center:
+            left.append(interval)
+        elif interval[0] > center:
+            right.append(interval)
+        else:
+            here.append(interval)
+    by_end = sorted(here, key=lambda i: -i[1])
+    here.sort()
+    return [center, here, by_end, _buildTree(left), _buildTree(right)]
+
+class IntervalIndex(object):
+    """
+    A set of (from, to) ordinal ranges identified by keys. See module doc.
+    """
+
+    # minimum number of pending changes before a rebuild
+    rebuildThreshold = 256
+
+    def __init__(self, intervals=None):
+        # key -> (from, to), the reference content of the index
+        self._current = {}
+        # key -> (from, to) or None (deleted), changes since the last build
+        self._pending = {}
+        self._tree = None
+        self._starts = []
+        self._by_start = []
+        self._lock = threading.RLock()
+        if intervals:
+            for key, date_from, date_to in intervals:
+                self._current[key] = (date_from, date_to)
+        self._build()
+
+    def __getstate__(self):
+        # the lock can't be pickled
+        state = self.__dict__.copy()
+        del state['_lock']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._lock = threading.RLock()
+
+    def __len__(self):
+        return len(self._current)
+
+    def _build(self):
+        intervals = [(v[0], v[1], k) for k, v in self._current.iteritems()]
+        intervals.sort()
+        self._by_start = intervals
+        self._starts = [i[0] for i in intervals]
+        self._tree = _buildTree(intervals)
+        self._pending = {}
+
+    def set(self, key, date_from, date_to):
+        ''' adds or replaces the range (ordinals) of a key '''
+        self._lock.acquire()
+        try:
+            if self._current.get(key) == (date_from, date_to):
+                return
+            self._current[key] = (date_from, date_to)
+            self._pending[key] = (date_from, date_to)
+            self._rebuildIfNeeded()
+        finally:
+            self._lock.release()
+
+    def remove(self, key):
+        self._lock.acquire()
+        try:
+            if self._current.pop(key, None) is None:
+                return
+            self._pending[key] = None
+            self._rebuildIfNeeded()
+        finally:
+            self._lock.release()
+
+    def _rebuildIfNeeded(self):
+        if len(self._pending) > max(self.rebuildThreshold, len(self._current) // 16):
+            self._build()
+
+    def _stab(self, point, ret):
+        node = self._tree
+        while node is not None:
+            center, by_start, by_end, left, right = node
+            if point < center:
+                for interval in by_start:
+                    if interval[0] > point: break
+                    ret.append(interval)
+                node = left
+            else:
+                for interval in by_end:
+                    if interval[1] < point: break
+                    ret.append(interval)
+                if point == center: break
+                node = right
+
+    def _query(self, date_from, date_to):
+        self._lock.acquire()
+        try:
+            found = []
+            self._stab(date_from, found)
+            begin = bisect.bisect_right(self._starts, date_from)
+            end = bisect.bisect_right(self._starts, date_to)
+            found.extend(self._by_start[begin:end])
+            pending = self._pending
+            ret = [i[2] for i in found if i[2] not in pending]
+            for key, interval in pending.iteritems():
+                if interval is not None and interval[0] <= date_to and interval[1] >= date_from:
+                    ret.append(key)
+            return ret
+        finally:
+            self._lock.release()
+
+    def stab(self, date):
+        ''' returns the keys of the ranges that contain a date (or ordinal) '''
+        if isinstance(date, datetime.date): date = date.toordinal()
+        return self._query(date, date)
+
+    def overlapping(self, value):
+        ''' returns the keys of the ranges that overlap a fuzzy date, string,
+            date or (from, to) tuple of dates (see query.getDateRange) '''
+        return self._query(*_getOrdinals(value))
+
+    def get(self, key):
+        ''' returns the (from, to) ordinals of a key or None '''
+        return self._current.get(key)
+
+# The process-wide index
+
+_index = None
+_index_lock = threading.Lock()
+# model -> list of (label, field name, to field name), see _getFuzzyDateFields
+_model_fields = {}
+
+def _getFuzzyDateFields(model):
+    ret = _model_fields.get(model)
+    if ret is None:
+        ret = []
+        for field in model._meta.fields:
+            if isinstance(field, FuzzyDateField):
+                # inherited fields are indexed under the model declaring them
+                ret.append((_getModelLabel(field.model), field.name,
+                            _date_to_field_name(field.name)))
+        _model_fields[model] = ret
+    return ret
+
+def _loadIntervals():
+    intervals = []
+    for model in models.get_models():
+        for label, name, to_name in _getFuzzyDateFields(model):
+            # the fields inherited from a parent are loaded with the parent
+            if label != _getModelLabel(model): continue
+            rows = model._default_manager.values_list('pk', name, to_name)
+            for pk, date_from, date_to in rows.iterator():
+                if date_from is None: continue
+                if date_to is None: date_to = date_from
+                intervals.append(((label, name, pk), date_from.toordinal(), date_to.toordinal()))
+    return intervals
+
+def getIndex():
+    ''' returns the process-wide IntervalIndex, loading it if needed '''
+    global _index
+    if _index is None:
+        _index_lock.acquire()
+        try:
+            if _index is None:
+                _index = IntervalIndex(_loadIntervals())
+        finally:
+            _index_lock.release()
+    return _index
+
+def resetIndex():
+    ''' the index will be loaded again from the database on next use '''
+    global _index
+    _index = None
+
+def saveIndex(filename):
+    index = getIndex()
+    output = open(filename, 'wb')
+    try:
+        cPickle.dump(index, output, cPickle.HIGHEST_PROTOCOL)
+    finally:
+        output.close()
+
+def loadIndex(filename):
+    ''' replaces the process-wide index by the one saved in a file '''
+    global _index
+    input = open(filename, 'rb')
+    try:
+        _index = cPickle.load(input)
+    finally:
+        input.close()
+    return _index
+
+def getObjects(keys):
+    ''' returns the model instances of a list of keys (in the same order),
+        with one query per model '''
+    pks = {}
+    for label, name, pk in keys:
+        pks.setdefault(label, set()).add(pk)
+    objects = {}
+    for label, model_pks in pks.iteritems():
+        model = models.get_model(*label.split('.'))
+        objects[label] = model._default_manager.in_bulk(list(model_pks))
+    ret = []
+    for label, name, pk in keys:
+        obj = objects[label].get(pk)
+        if obj is not None: ret.append(obj)
+    return ret
+
+def _updateIndex(sender, instance, **kwargs):
+    if _index is None: return
+    for label, name, to_name in _getFuzzyDateFields(sender):
+        key = (label, name, instance.pk)
+        date = getattr(instance, name)
+        if date is None or date.isUndefined():
+            _index.remove(key)
+        else:
+            _index.set(key, date.getDateFrom().toordinal(), date.getDateTo().toordinal())
+
+def _removeFromIndex(sender, instance, **kwargs):
+    if _index is None: return
+    for label, name, to_name in _getFuzzyDateFields(sender):
+        _index.remove((label, name, instance.pk))
+
+signals.post_save.connect(_updateIndex)
+signals.post_delete.connect(_removeFromIndex)
@@ -0,0 +1,101 @@
+"""
+Range lookups on fuzzy dates.
+
+A FuzzyDateField stores the beginning of the range in its own column and the
+end in the hidden <name>_to column, so a lookup such as __range or __lt on the
+field only sees the beginning. The lookups below are translated into
+conditions on both columns so the database can do the filtering:
+
+    Work.objects.filter(date__overlaps='1066 to 1100')
+
+    overlaps        the date range overlaps the value
+    within          the date range is inside the value
+    contains_date   the date range contains the value
+    before          the date range ends before the value begins
+    after           the date range begins after the value ends
+
+The value can be a FuzzyDate, a fuzzy date string, a date or a (from, to)
+tuple of dates. The lookups are only understood by FuzzyDateQuerySet (e.g.
+through FuzzyDateManager) and can follow relations
+(e.g. version__date__before='1100'). Use fuzzyDateQ() to combine them with
+other Q objects.
+
+Rows saved with a plain date have no <name>_to value, their range is the
+date itself (as in FuzzyDateCreator).
+"""
+
+import datetime
+
+from django.db import models
+from django.db.models.query import QuerySet
+
+from core import FuzzyDate
+
+__all__ = (
+    'FuzzyDateManager',
+    'FuzzyDateQuerySet',
+    'fuzzyDateQ',
+)
+
+LOOKUP_TYPES = ('overlaps', 'within', 'contains_date', 'before', 'after')
+
+def getDateRange(value):
+    """ Returns the value of a lookup as a (from, to) tuple of dates. """
+    if isinstance(value, FuzzyDate):
+        if value.isUndefined():
+            raise ValueError('Undefined fuzzy date in lookup')
+        return (value.getDateFrom(), value.getDateTo())
+    if isinstance(value, basestring):
+        date = FuzzyDate()
+        if (not date.setAsString(value)) or date.isUndefined():
+            raise ValueError('Invalid fuzzy date "%s" in lookup (%s)' % (value, date.getLastError()))
+        return (date.getDateFrom(), date.getDateTo())
+    if isinstance(value, datetime.date):
+        return (value, value)
+    date_from, date_to = value
+    return (date_from, date_to)
+
+def _fromQ(path, lookup, value):
+    return models.Q(**{'%s__%s' % (path, lookup): value})
+
+def _toQ(path, lookup, value):
+    # falls back to the beginning of the range when there is no end
+    path_to = '%s_to' % path
+    return (models.Q(**{'%s__%s' % (path_to, lookup): value}) |
+            models.Q(**{'%s__isnull' % path_to: True, '%s__%s' % (path, lookup): value}))
+
+def fuzzyDateQ(path, lookup_type, value):
+    """
+    Returns a Q object for a fuzzy date lookup, e.g.
+    fuzzyDateQ('date', 'overlaps', '1066 to 1100')
+    """
+    date_from, date_to = getDateRange(value)
+    if lookup_type == 'overlaps':
+        return _fromQ(path, 'lte', date_to) & _toQ(path, 'gte', date_from)
+    elif lookup_type == 'within':
+        return _fromQ(path, 'gte', date_from) & _toQ(path, 'lte', date_to)
+    elif lookup_type == 'contains_date':
+        return _fromQ(path, 'lte', date_from) & _toQ(path, 'gte', date_to)
+    elif lookup_type == 'before':
+        return _toQ(path, 'lt', date_from)
+    elif lookup_type == 'after':
+        return _fromQ(path, 'gt', date_to)
+    raise ValueError('Unknown fuzzy date lookup type: %s' % lookup_type)
+
+class FuzzyDateQuerySet(QuerySet):
+    """
+    A QuerySet that translates the fuzzy date lookups (see module doc) passed
+    as keyword arguments to filter(), exclude() and get().
+    """
+    def _filter_or_exclude(self, negate, *args, **kwargs):
+        args = list(args)
+        for key in kwargs.keys():
+            parts = key.rsplit('__', 1)
+            if len(parts) == 2 and parts[1] in LOOKUP_TYPES:
+                args.append(fuzzyDateQ(parts[0], parts[1], kwargs.pop(key)))
+        return super(FuzzyDateQuerySet, self)._filter_or_exclude(negate, *args, **kwargs)
+
+class FuzzyDateManager(models.Manager):
+    """ Default manager for the models that have a FuzzyDateField. """
+    def get_query_set(self):
+        return FuzzyDateQuerySet(self.model, using=self._db)
@@ -0,0 +1,403 @@
+"""Bulk import of archives, manuscripts, works, versions and witnesses.
+
+    importer = Importer(using='default', dry_run=False)
+    importer.run({'manuscripts': read_csv('manuscripts.csv'), ...})
+
+Each kind of record is read from rows of dictionaries (see read_csv),
+whose keys are the names of the model fields. Related records are
+referred to by their natural key, resolved in memory:
+
+    archives:     name, city, country
+    manuscripts:  sigla, shelf_mark, archive, archive_city,
+                  sigla_provenance, description and the boolean fields
+    works:        name, date, king, text_attributes
+    versions:     standard_abbreviation, work, name, date, synopsis,
+                  print_editions, synopsis_manuscripts, languages
+    witnesses:    work, manuscript (sigla), range_start, range_end,
+                  description, languages and the boolean fields
+
+Many-to-many columns list names separated by LIST_SEPARATOR. Dates are
+fuzzy date strings, all parsed in one batch per kind of record. Records
+whose natural key already exists are left alone, so an import can be
+run again.
+
+The records and many-to-many links are inserted with one statement per
+table, all in a single transaction which is rolled back if any row is
+not valid. In a dry run, the rows are only validated. No signals are sent:
+the slugs and witness range keys are set here, and afterwards the
+listings of the manuscripts are updated and the interval index of the
+dates (fuzzydate.intervals) and the stemma graph reloaded on next use.
+"""
+
+import csv
+import datetime
+
+from django.core.exceptions import ValidationError
+from django.db import connections, models, transaction, DEFAULT_DB_ALIAS
+from django.template.defaultfilters import slugify
+
+from fuzzydate import intervals
+from fuzzydate.core import FrozenFuzzyDate, parseDateStrings
+from legal_editions import stemma
+from legal_editions.listings import update_listings
+from legal_editions.models import Archive, King, Language, Manuscript, \
+    SiglaProvenance, TextAttribute, Version, Witness, Work
+
+
+# Order of the imports, each kind of record can refer to the previous ones.
+KINDS = ('archives', 'manuscripts', 'works', 'versions', 'witnesses')
+
+LIST_SEPARATOR = ';'
+
+TRUE_VALUES = ('1', 'x', 'y', 'yes', 'true')
+
+
+def read_csv (path, delimiter=','):
+    """Returns the rows of a UTF-8 CSV file with a header line, as
+    dictionaries of stripped unicode values with lowercase keys."""
+    csv_file = open(path, 'rb')
+    try:
+        reader = csv.reader(csv_file, delimiter=delimiter)
+        header = [name.decode('utf-8').strip().lower() for name in reader.next()]
+        return [dict(zip(header, [value.decode('utf-8').strip()
+                                  for value in row]))
+                for row in reader if any(row)]
+    finally:
+        csv_file.close()
+
+
+def insert_rows (model, objects, using):
+    """Inserts unsaved objects with a single statement, in the current
+    transaction, without sending signals."""
+    connection = connections[using]
+    qn = connection.ops.quote_name
+    fields = [field for field in model._meta.local_fields
+              if not field.primary_key]
+    sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+        qn(model._meta.db_table),
+        ', '.join([qn(field.column) for field in fields]),
+        ', '.join(['%s'] * len(fields)))
+    rows = [[field.get_db_prep_save(field.pre_save(obj, True),
+                                    connection=connection)
+             for field in fields] for obj in objects]
+    connection.cursor().executemany(sql, rows)
+
+
+def insert_objects (model, objects, using):
+    """Inserts unsaved objects in a single statement and transaction,
+    without sending signals."""
+    transaction.enter_transaction_management(using=using)
+    transaction.managed(True, using=using)
+    try:
+        insert_rows(model, objects, using)
+        transaction.commit(using=using)
+    except:
+        transaction.rollback(using=using)
+        transaction.leave_transaction_management(using=using)
+        raise
+    transaction.leave_transaction_management(using=using)
+
+
+def parse_boolean (value):
+    return value.lower() in TRUE_VALUES
+
+
+def split_list (value):
+    return [name.strip() for name in value.split(LIST_SEPARATOR)
+            if name.strip()]
+
+
+class Importer (object):
+
+    """Imports rows of records in bulk, see the module documentation.
+    The problems found are listed in errors as (kind, row number,
+    message); nothing is written if there is any."""
+
+    def __init__ (self, using=DEFAULT_DB_ALIAS, dry_run=False):
+        self.using = using
+        self.dry_run = dry_run
+        self.errors = []
+        # kind: (created, existing)
+        self.counts = {}
+        # the manuscripts whose listing must be updated
+        self.manuscript_ids = set()
+        # ids of the records until they are inserted
+        self._placeholders = iter(xrange(-1, -2 ** 31, -1))
+
+    def _names (self, model, field='name'):
+        return dict([(name.lower(), pk) for pk, name in
+                     model.objects.using(self.using).order_by(
+                         '-pk').values_list('pk', field)])
+
+    def load (self):
+        """Reads the natural keys of the existing records."""
+        self.archives = dict([((name.lower(), city.lower()), pk)
+                              for pk, name, city in
+                              Archive.objects.using(self.using).values_list(
+                                  'pk', 'name', 'city')])
+        # the oldest manuscript of a sigla wins
+        self.manuscripts = self._names(Manuscript, 'sigla')
+        self.works = self._names(Work)
+        self.versions = self._names(Version, 'standard_abbreviation')
+        self.witnesses = set(Witness.objects.using(self.using).values_list(
+                'work', 'manuscript', 'range_start', 'range_end'))
+        self.kings = self._names(King)
+        self.languages = self._names(Language)
+        self.sigla_provenances = self._names(SiglaProvenance)
+        self.text_attributes = self._names(TextAttribute)
+
+    def run (self, rows):
+        """Imports rows, a dictionary of lists of rows by kind (see
+        KINDS). Returns True if the rows were imported (or would have been
+        in a dry run)."""
+        self.load()
+        transaction.enter_transaction_management(using=self.using)
+        transaction.managed(True, using=self.using)
+        try:
+            for kind in KINDS:
+                if not rows.get(kind):
+                    continue
+                # each kind of record can refer to the records inserted
+                # before it; the rows are still validated after an error
+                model, objects = getattr(self, 'read_%s' % kind)(rows[kind])
+                if not self.errors and not self.dry_run:
+                    self.insert(kind, model, objects)
+            if self.errors or self.dry_run:
+                transaction.rollback(using=self.using)
+            else:
+                update_listings(self.manuscript_ids, self.using)
+                transaction.commit(using=self.using)
+                # the in-memory indexes the signals would have updated:
+                # the dates of the works and versions, and the stemma
+                intervals.resetIndex()
+                stemma.reset_graph()
+        except:
+            transaction.rollback(using=self.using)
+            transaction.leave_transaction_management(using=self.using)
+            raise
+        transaction.leave_transaction_management(using=self.using)
+        return not self.errors
+
+    def error (self, kind, number, message):
+        self.errors.append((kind, number, message))
+
+    def resolve (self, kind, number, names, value, label):
+        if not value:
+            return None
+        pk = names.get(value.lower())
+        if pk is None:
+            self.error(kind, number, 'Unknown %s "%s".' % (label, value))
+        return pk
+
+    def resolve_list (self, kind, number, names, value, label):
+        ids = []
+        for name in split_list(value):
+            pk = self.resolve(kind, number, names, name, label)
+            if pk is not None and pk not in ids:
+                ids.append(pk)
+        return ids
+
+    def parse_dates (self, kind, rows):
+        """Returns the FuzzyDate (or None) of the date column of each
+        row."""
+        starts, ends, modifiers, errors = parseDateStrings(
+            [row.get('date') for row in rows])
+        for index, message in sorted(errors.items()):
+            self.error(kind, index + 1, 'Invalid date "%s": %s.' % (
+                    rows[index]['date'], message))
+        return [starts[i] and FrozenFuzzyDate.getInstance(
+                datetime.date.fromordinal(starts[i]),
+                datetime.date.fromordinal(ends[i]), modifiers[i]) or None
+                for i in range(len(rows))]
+
+    def make_object (self, kind, number, model, row, **values):
+        """Returns an unsaved model object of the fields of row (as named
+        in the model) and values, or None if they aren't valid."""
+        obj = model()
+        for field in model._meta.local_fields:
+            if field.name not in row or not field.editable or field.rel:
+                continue
+            value = row[field.name]
+            if isinstance(field, models.BooleanField):
+                value = parse_boolean(value)
+            elif isinstance(field, models.DateField):
+                # see parse_dates
+                continue
+            setattr(obj, field.name, value)
+        for name, value in values.items():
+            setattr(obj, name, value)
+        # the relations and dates are resolved and parsed beforehand
+        exclude = [field.name for field in model._meta.local_fields
+                   if field.rel or isinstance(field, models.DateField)]
+        try:
+            obj.clean_fields(exclude)
+        except ValidationError, e:
+            for name, messages in sorted(e.message_dict.items()):
+                self.error(kind, number, '%s: %s' % (name, ' '.join(messages)))
+            return None
+        return obj
+
+    def add (self, kind, names, key, obj, objects, many_to_many=None):
+        # registers a new record, unless its key exists or is a duplicate
+        created, existing = self.counts.get(kind, (0, 0))
+        if key in names:
+            self.counts[kind] = (created, existing + 1)
+            return
+        if isinstance(names, set):
+            names.add(key)
+        else:
+            # replaced by the id once inserted
+            names[key] = self._placeholders.next()
+        objects.append((key, obj, many_to_many or {}))
+        self.counts[kind] = (created + 1, existing)
+
+    def read_archives (self, rows):
+        objects = []
+        for number, row in enumerate(rows):
+            obj = self.make_object('archives', number + 1, Archive, row)
+            if obj is not None:
+                self.add('archives', self.archives,
+                         (obj.name.lower(), obj.city.lower()), obj, objects)
+        return Archive, objects
+
+    def read_manuscripts (self, rows):
+        objects = []
+        for number, row in enumerate(rows):
+            number += 1
+            errors = len(self.errors)
+            if not row.get('sigla'):
+                self.error('manuscripts', number, 'The sigla is required.')
+            archive = (row.get('archive', u'').lower(),
+                       row.get('archive_city', u'').lower())
+            archive_id = self.archives.get(archive)
+            if archive_id is None:
+                self.error('manuscripts', number, 'Unknown archive "%s (%s)".'
+                           % (row.get('archive', u''),
+                              row.get('archive_city', u'')))
+            provenance_id = self.resolve(
+                'manuscripts', number, self.sigla_provenances,
+                row.get('sigla_provenance'), 'sigla provenance')
+            obj = self.make_object(
+                'manuscripts', number, Manuscript, row, archive_id=archive_id,
+                sigla_provenance_id=provenance_id,
+                slug=slugify(row.get('sigla', u'')))
+            if obj is not None and len(self.errors) == errors:
+                self.add('manuscripts', self.manuscripts, obj.sigla.lower(),
+                         obj, objects)
+        return Manuscript, objects
+
+    def read_works (self, rows):
+        objects = []
+        dates = self.parse_dates('works', rows)
+        for number, row in enumerate(rows):
+            number += 1
+            errors = len(self.errors)
+            king_id = self.resolve('works', number, self.kings,
+                                   row.get('king'), 'king')
+            text_attributes = self.resolve_list(
+                'works', number, self.text_attributes,
+                row.get('text_attributes', u''), 'text attribute')
+            obj = self.make_object('works', number, Work, row, king_id=king_id,
+                                   date=dates[number - 1])
+            if obj is not None and len(self.errors) == errors:
+                self.add('works', self.works, obj.name.lower(), obj, objects,
+                         {'text_attributes': text_attributes})
+        return Work, objects
+
+    def read_versions (self, rows):
+        objects = []
+        dates = self.parse_dates('versions', rows)
+        for number, row in enumerate(rows):
+            number += 1
+            errors = len(self.errors)
+            work_id = self.resolve('versions', number, self.works,
+                                   row.get('work'), 'work')
+            if work_id is None and not row.get('work'):
+                self.error('versions', number, 'The work is required.')
+            languages = self.resolve_list(
+                'versions', number, self.languages, row.get('languages', u''),
+                'language')
+            obj = self.make_object(
+                'versions', number, Version, row, work_id=work_id,
+                date=dates[number - 1],
+                slug=slugify(row.get('standard_abbreviation', u'')))
+            if obj is not None and len(self.errors) == errors:
+                self.add('versions', self.versions,
+                         obj.standard_abbreviation.lower(), obj, objects,
+                         {'languages': languages})
+        return Version, objects
+
+    def read_witnesses (self, rows):
+        objects = []
+        for number, row in enumerate(rows):
+            number += 1
+            errors = len(self.errors)
+            work_id = self.resolve('witnesses', number, self.works,
+                                   row.get('work'), 'work')
+            manuscript_id = self.resolve('witnesses', number, self.manuscripts,
+                                         row.get('manuscript'), 'manuscript')
+            if work_id is None and not row.get('work'):
+                self.error('witnesses', number, 'The work is required.')
+            if manuscript_id is None and not row.get('manuscript'):
+                self.error('witnesses', number, 'The manuscript is required.')
+            languages = self.resolve_list(
+                'witnesses', number, self.languages, row.get('languages', u''),
+                'language')
+            obj = self.make_object('witnesses', number, Witness, row,
+                                   work_id=work_id, manuscript_id=manuscript_id)
+            if obj is not None and len(self.errors) == errors:
+                # save() isn't called on the inserted witnesses
+                obj.set_keys()
+                self.add('witnesses', self.witnesses,
+                         (work_id, manuscript_id, obj.range_start,
+                          obj.range_end), obj, objects,
+                         {'languages': languages})
+        return Witness, objects
+
+    def get_new_ids (self, kind, model, last_pk):
+        # natural key -> id of the records inserted after last_pk
+        rows = model.objects.using(self.using).filter(pk__gt=last_pk)
+        if kind == 'archives':
+            return dict([((name.lower(), city.lower()), pk) for pk, name, city
+                         in rows.values_list('pk', 'name', 'city')])
+        if kind == 'witnesses':
+            return dict([(key[1:], key[0]) for key in rows.values_list(
+                        'pk', 'work', 'manuscript', 'range_start',
+                        'range_end')])
+        field = {'manuscripts': 'sigla', 'versions': 'standard_abbreviation'
+                 }.get(kind, 'name')
+        return dict([(name.lower(), pk) for pk, name in
+                     rows.order_by('-pk').values_list('pk', field)])
+
+    def insert (self, kind, model, objects):
+        if not objects:
+            return
+        last_pk = model.objects.using(self.using).order_by('-pk').values_list(
+            'pk', flat=True)[:1]
+        last_pk = last_pk and last_pk[0] or 0
+        insert_rows(model, [obj for key, obj, many_to_many in objects],
+                    self.using)
+        ids = self.get_new_ids(kind, model, last_pk)
+        names = getattr(self, kind)
+        if not isinstance(names, set):
+            for key, obj, many_to_many in objects:
+                names[key] = ids[key]
+        if kind == 'manuscripts':
+            self.manuscript_ids.update(ids.values())
+        elif kind == 'witnesses':
+            self.manuscript_ids.update([obj.manuscript_id for key, obj,
+                                        many_to_many in objects])
+        # the many-to-many links, one insert per field
+        links = {}
+        for key, obj, many_to_many in objects:
+            for name, related_ids in many_to_many.items():
+                links.setdefault(name, []).extend(
+                    [(ids[key], related_id) for related_id in related_ids])
+        for name, pairs in links.items():
+            field = model._meta.get_field(name)
+            through = field.rel.through
+            source = field.m2m_field_name()
+            target = field.m2m_reverse_field_name()
+            insert_rows(through, [through(**{'%s_id' % source: pk,
+                                             '%s_id' % target: related_id})
+                                  for pk, related_id in pairs], self.using)
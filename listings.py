@@ -0,0 +1,153 @@
+"""The listings of the manuscripts in the public catalogue.
+
+Each manuscript has a ManuscriptListing row with the data of its
+catalogue entry: archive, sigla provenance, number of folio images and
+the works of its witnesses (except those hidden from the listings). The
+catalogue and its filters read that table only:
+
+    from legal_editions import listings
+    listings.get_catalogue(checked_folios=True, archive=archive)
+
+The rows are updated by the signals of Manuscript, Archive,
+SiglaProvenance, FolioImage, Witness and Work. Changes made without
+signals (QuerySet.update(), bulk imports) need update_listings() or the
+update_manuscript_listings command.
+"""
+
+from django.db.models import Count, get_model, signals
+
+
+CHUNK_SIZE = 500
+
+
+def get_catalogue (**filters):
+    """Returns the listings of the manuscripts shown in the catalogue, in
+    order of archive and shelf mark, filtered by filters."""
+    listing_model = get_model('legal_editions', 'ManuscriptListing')
+    return listing_model.objects.filter(hide_from_listings=False, **filters)
+
+
+def update_listings (manuscript_ids, using=None):
+    """Brings the listings of some manuscripts in line with the
+    normalized tables: 4 queries per CHUNK_SIZE manuscripts, and a write
+    per listing that changed. Returns the number of listings written."""
+    manuscript_ids = list(set(manuscript_ids))
+    written = 0
+    for start in range(0, len(manuscript_ids), CHUNK_SIZE):
+        written += _update_listings(manuscript_ids[start:start + CHUNK_SIZE],
+                                    using)
+    return written
+
+
+def _update_listings (ids, using):
+    manuscript_model = get_model('legal_editions', 'Manuscript')
+    listing_model = get_model('legal_editions', 'ManuscriptListing')
+    image_model = get_model('legal_editions', 'FolioImage')
+    witness_model = get_model('legal_editions', 'Witness')
+    manuscripts = manuscript_model.objects.using(using).filter(
+        pk__in=ids).select_related('archive', 'sigla_provenance')
+    counts = dict(image_model.objects.using(using).filter(
+            manuscript__in=ids).values_list('manuscript').annotate(
+            Count('id')).order_by())
+    works = {}
+    for manuscript_id, name in witness_model.objects.using(using).filter(
+        manuscript__in=ids, hide_from_listings=False).values_list(
+        'manuscript', 'work__name').order_by('work__name').distinct():
+        works.setdefault(manuscript_id, []).append(name)
+    listings = listing_model.objects.using(using)
+    existing = dict([(listing.pk, listing) for listing in
+                     listings.filter(pk__in=ids)])
+    written = 0
+    for manuscript in manuscripts:
+        archive = manuscript.archive
+        values = {
+            'archive_id': archive.pk,
+            'archive_name': archive.name,
+            'archive_city': archive.city,
+            'archive_country': archive.country,
+            'shelf_mark': manuscript.shelf_mark,
+            'sigla': manuscript.sigla,
+            'slug': manuscript.slug,
+            'sigla_provenance': manuscript.sigla_provenance and
+            manuscript.sigla_provenance.name or u'',
+            'hide_from_listings': manuscript.hide_from_listings,
+            'checked_folios': manuscript.checked_folios,
+            'single_sheet': manuscript.single_sheet,
+            'standard_edition': manuscript.standard_edition,
+            'folio_image_count': counts.get(manuscript.pk, 0),
+            'works': u'\n'.join(works.get(manuscript.pk, [])),
+            }
+        listing = existing.pop(manuscript.pk, None)
+        if listing is None:
+            listing_model(manuscript_id=manuscript.pk, **values).save(
+                using=using, force_insert=True)
+        elif [getattr(listing, name) for name in values] != values.values():
+            values['archive'] = values.pop('archive_id')
+            listings.filter(pk=manuscript.pk).update(**values)
+        else:
+            continue
+        written += 1
+    # the listings of the deleted manuscripts
+    if existing:
+        listings.filter(pk__in=existing.keys()).delete()
+    return written
+
+
+def rebuild_listings (using=None):
+    """Updates the listings of all the manuscripts and deletes the others.
+    Returns the number of listings written."""
+    manuscript_model = get_model('legal_editions', 'Manuscript')
+    listing_model = get_model('legal_editions', 'ManuscriptListing')
+    ids = list(manuscript_model.objects.using(using).values_list('id',
+                                                                flat=True))
+    listing_model.objects.using(using).exclude(pk__in=ids).delete()
+    return update_listings(ids, using)
+
+
+def _get_manuscript_ids (sender, instance, using):
+    name = sender._meta.object_name
+    if name == 'Manuscript':
+        return [instance.pk]
+    if name in ('FolioImage', 'Witness'):
+        # and the former manuscript, see _remember_manuscript
+        return [instance.manuscript_id] + instance.__dict__.pop(
+            '_listing_manuscript_ids', [])
+    manuscripts = get_model('legal_editions', 'Manuscript').objects.using(using)
+    if name == 'Archive':
+        return manuscripts.filter(archive=instance).values_list('id',
+                                                                flat=True)
+    if name == 'SiglaProvenance':
+        return manuscripts.filter(sigla_provenance=instance).values_list(
+            'id', flat=True)
+    if name == 'Work':
+        return manuscripts.filter(witness__work=instance).values_list(
+            'id', flat=True).distinct()
+    return []
+
+
+def _remember_manuscript (sender, instance, **kwargs):
+    # the manuscript of an image or witness before it is changed
+    if (sender._meta.app_label != 'legal_editions' or
+        sender._meta.object_name not in ('FolioImage', 'Witness') or
+        instance.pk is None or kwargs.get('raw')):
+        return
+    instance._listing_manuscript_ids = [pk for pk in sender._default_manager.using(
+            kwargs.get('using')).filter(pk=instance.pk).values_list(
+            'manuscript', flat=True) if pk != instance.manuscript_id]
+
+
+def _update_listings_signal (sender, instance, **kwargs):
+    if sender._meta.app_label != 'legal_editions' or kwargs.get('raw'):
+        return
+    if (sender._meta.object_name == 'Manuscript' and
+        kwargs.get('signal') is signals.post_delete):
+        # the listing is deleted with the manuscript
+        return
+    ids = _get_manuscript_ids(sender, instance, kwargs.get('using'))
+    if ids:
+        update_listings(ids, kwargs.get('using'))
+
+
+signals.pre_save.connect(_remember_manuscript)
+signals.post_save.connect(_update_listings_signal)
+signals.post_delete.connect(_update_listings_signal)
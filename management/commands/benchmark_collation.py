@@ -0,0 +1,107 @@
+import difflib
+import random
+import time
+from optparse import make_option
+
+from django.core.cache import get_cache
+from django.core.management.base import BaseCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from legal_editions import collation
+from legal_editions.models import Archive, Edition, EditionStatus, \
+    Manuscript, Version, Witness, WitnessTranscription, Work
+from legal_editions.testing import call_in_test_database
+
+
+VOCABULARY = [u'cyning', u'laga', u'wite', u'scilling', u'\xf0eof', u'mon',
+              u'gif', u'sie', u'he', u'forgielde', u'\xfe\xe6t', u'and'] + [
+    u'w%d' % i for i in range(500)]
+
+
+class Command (BaseCommand):
+
+    help = 'Times the collation of a synthetic edition (cold, after a change of one witness, with the alignments stored and cached) in a test database.'
+    option_list = BaseCommand.option_list + (
+        make_option('--witnesses', action='store', dest='witnesses',
+                    type='int', default=20,
+                    help='Number of witnesses (default: 20).'),
+        make_option('--words', action='store', dest='words', type='int',
+                    default=5000,
+                    help='Number of words of each transcription (default: 5000).'),
+        make_option('--edits', action='store', dest='edits', type='int',
+                    default=100,
+                    help='Number of edits of each witness against the base (default: 100).'),
+        make_option('--database', action='store', dest='database',
+                    default=DEFAULT_DB_ALIAS,
+                    help='Nominates the database whose test database is used. Defaults to the "default" database.'),)
+
+    def handle (self, **options):
+        call_in_test_database(lambda: self.run(options), options.get('database'))
+
+    def time (self, label, func, *args):
+        start = time.time()
+        ret = func(*args)
+        self.stdout.write('%s: %.0f ms\n' % (label, (time.time() - start) * 1000))
+        return ret
+
+    def get_texts (self, options):
+        random.seed(0)
+        base = [random.choice(VOCABULARY) for i in range(options['words'])]
+        texts = [base]
+        for i in range(options['witnesses'] - 1):
+            words = list(base)
+            for j in range(options['edits']):
+                position = random.randrange(len(words))
+                edit = random.random()
+                if edit < 0.3:
+                    words.insert(position, random.choice(VOCABULARY))
+                elif edit < 0.6:
+                    del words[position]
+                else:
+                    words[position] = random.choice(VOCABULARY)
+            texts.append(words)
+        return [u' '.join(words) for words in texts]
+
+    def run (self, options):
+        texts = self.get_texts(options)
+        work = Work.objects.create(name='Benchmark')
+        edition = Edition.objects.create(
+            abbreviation='Benchmark',
+            status=EditionStatus.objects.create(name='Benchmark'),
+            version=Version.objects.create(standard_abbreviation='Benchmark',
+                                           work=work))
+        archive = Archive.objects.create(name='Benchmark', city='Benchmark')
+        for i, text in enumerate(texts):
+            manuscript = Manuscript.objects.create(
+                shelf_mark='Benchmark %d' % i, sigla='B%d' % i,
+                archive=archive)
+            WitnessTranscription.objects.create(
+                witness=Witness.objects.create(manuscript=manuscript,
+                                               work=work),
+                edition=edition, transcription=text)
+        self.stdout.write('%d witnesses of %d words, %d edits each\n' % (
+                options['witnesses'], options['words'], options['edits']))
+        words = [collation.get_words(text)[0] for text in texts]
+        self.time('Diff against the base (Myers)', lambda: [
+                collation.get_opcodes(words[0], other) for other in words[1:]])
+        self.time('Diff against the base (difflib)', lambda: [
+                difflib.SequenceMatcher(None, words[0], other,
+                                        False).get_opcodes()
+                for other in words[1:]])
+        # a cache of the benchmark only
+        saved = collation.cache
+        collation.cache = get_cache(
+            'django.core.cache.backends.locmem.LocMemCache')
+        try:
+            self.time('Cold collation', collation.collate, edition)
+            self.time('Cached collation', collation.collate, edition)
+            changed = WitnessTranscription.objects.filter(
+                edition=edition).order_by('-id')[0]
+            changed.transcription += u' amen'
+            changed.save()
+            self.time('One witness changed', collation.collate, edition)
+            collation.cache.clear()
+            self.time('Alignments stored, not cached', collation.collate,
+                      edition)
+        finally:
+            collation.cache = saved
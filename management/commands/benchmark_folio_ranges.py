@@ -0,0 +1,87 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from legal_editions.folios import folio_key, reference_key
+from legal_editions.importer import insert_objects
+from legal_editions.models import Archive, FolioImage, FolioSide, \
+    Manuscript, Witness, Work
+from legal_editions.testing import call_in_test_database
+
+
+class Command (BaseCommand):
+
+    help = 'Times the images of a witness range (Witness.get_folio_images) against parsing every image of the manuscript in Python, on manuscripts of many folios in a test database.'
+    option_list = BaseCommand.option_list + (
+        make_option('--manuscripts', action='store', dest='manuscripts',
+                    type='int', default=20,
+                    help='Number of manuscripts (default: 20).'),
+        make_option('--folios', action='store', dest='folios', type='int',
+                    default=600,
+                    help='Number of folios of each manuscript, recto and verso (default: 600).'),
+        make_option('--repeat', action='store', dest='repeat', type='int',
+                    default=20,
+                    help='Number of runs timed (default: 20).'),
+        make_option('--database', action='store', dest='database',
+                    default=DEFAULT_DB_ALIAS,
+                    help='Nominates the database whose test database is used. Defaults to the "default" database.'),)
+
+    def handle (self, **options):
+        if options['folios'] < 42:
+            raise CommandError('The witness range is f. 30r-41v.')
+        call_in_test_database(lambda: self.run(options), options.get('database'))
+
+    def get_images (self, witness):
+        # without the keys: every image of the manuscript parsed and
+        # compared in Python
+        start = reference_key(witness.range_start)
+        end = reference_key(witness.range_end, end=True)
+        return [image for image in FolioImage.objects.filter(
+                manuscript=witness.manuscript_id).select_related(
+                'folio_side').order_by('reading_order')
+                if start <= folio_key(image.folio_number,
+                                      image.folio_side.name) <= end]
+
+    def time (self, label, func, repeat):
+        start = time.time()
+        for i in range(repeat):
+            ret = func()
+        self.stdout.write('%s: %.2f ms\n' % (
+                label, (time.time() - start) / repeat * 1000))
+        return ret
+
+    def run (self, options):
+        using = options.get('database')
+        archive = Archive.objects.create(name='Benchmark', city='Benchmark')
+        sides = [FolioSide.objects.create(name='recto'),
+                 FolioSide.objects.create(name='verso')]
+        for i in range(options['manuscripts']):
+            manuscript = Manuscript.objects.create(
+                shelf_mark='Benchmark %d' % i, sigla='B%d' % i,
+                archive=archive)
+            images = []
+            for number in range(1, options['folios'] + 1):
+                for side in sides:
+                    image = FolioImage(
+                        filename='%03d%s.jpg' % (number, side.name[0]),
+                        filepath='%d/%03d%s.jpg' % (i, number, side.name[0]),
+                        folio_number=str(number), manuscript=manuscript,
+                        folio_side=side)
+                    image.set_keys(side.name)
+                    images.append(image)
+            insert_objects(FolioImage, images, using)
+            manuscript.update_reading_order()
+        witness = Witness.objects.create(
+            manuscript=manuscript, work=Work.objects.create(name='Benchmark'),
+            range_start='30r', range_end='41v')
+        self.stdout.write('%d manuscripts of %d folios, witness f. 30r-41v\n' % (
+                options['manuscripts'], options['folios']))
+        parsed = self.time('Parsed in Python', lambda: self.get_images(
+                witness), options['repeat'])
+        indexed = self.time('Indexed range query', lambda: list(
+                witness.get_folio_images()), options['repeat'])
+        if parsed != indexed:
+            raise CommandError('The images differ.')
+        self.stdout.write('%d images\n' % len(indexed))
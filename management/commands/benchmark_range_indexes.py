@@ -0,0 +1,91 @@
+import datetime
+import random
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+from django.db import connections, transaction, DEFAULT_DB_ALIAS
+
+from legal_editions.fuzzydate.fields import getRangeIndexes
+from legal_editions.models import Work
+from legal_editions.testing import call_in_test_database
+
+
+CHUNK_SIZE = 10000
+
+
+class Command (BaseCommand):
+
+    help = 'Times the queries on the fuzzy dates of a large Work table (a page deep in date order and an overlap filter) with and without the composite range index, in a test database.'
+    option_list = BaseCommand.option_list + (
+        make_option('--rows', action='store', dest='rows', type='int',
+                    default=1000000,
+                    help='Number of works (default: 1000000).'),
+        make_option('--database', action='store', dest='database',
+                    default=DEFAULT_DB_ALIAS,
+                    help='Nominates the database whose test database is used. Defaults to the "default" database.'),)
+
+    def handle (self, **options):
+        call_in_test_database(lambda: self.run(options), options.get('database'))
+
+    def insert_works (self, connection, rows):
+        # a raw statement, as a million objects don't fit in memory
+        qn = connection.ops.quote_name
+        opts = Work._meta
+        columns = ['name', 'date', 'date_to', 'date_mod']
+        sql = 'INSERT INTO %s (%s) VALUES (%s)' % (
+            qn(opts.db_table),
+            ', '.join([qn(opts.get_field(name).column) for name in columns]),
+            ', '.join(['%s'] * len(columns)))
+        random.seed(0)
+        start = datetime.date(600, 1, 1).toordinal()
+        end = datetime.date(1300, 1, 1).toordinal()
+        cursor = connection.cursor()
+        for first in range(0, rows, CHUNK_SIZE):
+            values = []
+            for i in range(first, min(first + CHUNK_SIZE, rows)):
+                date_from = random.randint(start, end)
+                date_to = date_from + random.choice((0, 30, 365, 365 * 20))
+                values.append((
+                        'Work %d' % i,
+                        datetime.date.fromordinal(date_from),
+                        datetime.date.fromordinal(date_to),
+                        random.randint(0, 2)))
+            cursor.executemany(sql, values)
+            transaction.commit_unless_managed(using=connection.alias)
+
+    def time (self, label, func, repeat=3):
+        # the best of repeat runs
+        timings = []
+        for i in range(repeat):
+            start = time.time()
+            func()
+            timings.append(time.time() - start)
+        self.stdout.write('%s: %.1f ms\n' % (label, min(timings) * 1000))
+
+    def time_queries (self, rows, label):
+        works = Work.objects.all()
+        self.time('%s, page at offset %d in date order' % (label, rows // 2),
+                  lambda: list(works.order_by('date', 'date_to').values_list(
+                    'id', flat=True)[rows // 2:rows // 2 + 20]))
+        self.time('%s, works overlapping 1066 to 1070' % label,
+                  lambda: works.filter(date__overlaps='1066 to 1070').count())
+
+    def run (self, options):
+        connection = connections[options.get('database')]
+        rows = options['rows']
+        start = time.time()
+        self.insert_works(connection, rows)
+        self.stdout.write('%d works inserted in %.1fs\n' % (
+                rows, time.time() - start))
+        # created with the table by syncdb
+        self.time_queries(rows, 'With the range index')
+        cursor = connection.cursor()
+        qn = connection.ops.quote_name
+        for name, columns in getRangeIndexes(Work, connection):
+            sql = 'DROP INDEX %s' % qn(name)
+            if connection.vendor == 'mysql':
+                sql += ' ON %s' % qn(Work._meta.db_table)
+            cursor.execute(sql)
+        transaction.commit_unless_managed(using=connection.alias)
+        self.time_queries(rows, 'Without')
@@ -0,0 +1,36 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from legal_editions.commentaries import find_orphaned_commentaries
+from legal_editions.models import Edition
+
+
+class Command (BaseCommand):
+
+    help = 'Lists the commentaries whose element_id is no longer in the text of their edition.'
+    args = '[edition id ...]'
+    option_list = BaseCommand.option_list + (
+        make_option('--database', action='store', dest='database',
+                    default=DEFAULT_DB_ALIAS,
+                    help='Nominates a database. Defaults to the "default" database.'),)
+
+    def handle (self, *args, **options):
+        editions = Edition.objects.using(options.get('database'))
+        if args:
+            try:
+                editions = editions.filter(pk__in=[int(pk) for pk in args])
+            except ValueError:
+                raise CommandError('Edition ids must be integers.')
+        orphans = find_orphaned_commentaries(editions)
+        labels = dict(editions.filter(pk__in=orphans.keys()).values_list(
+                'pk', 'abbreviation'))
+        for edition_id, edition_orphans in sorted(orphans.items()):
+            for pk, element_id in edition_orphans:
+                self.stdout.write('%s (%d): commentary %d on "%s"\n' % (
+                        labels[edition_id], edition_id, pk, element_id))
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write('%d orphaned commentaries in %d editions\n' % (
+                    sum([len(edition_orphans) for edition_orphans in
+                         orphans.values()]), len(orphans)))
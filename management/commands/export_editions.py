@@ -0,0 +1,57 @@
+import sys
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from legal_editions import export
+from legal_editions.models import Edition
+
+
+class Command (BaseCommand):
+
+    option_list = BaseCommand.option_list + (
+        make_option('--format', action='store', dest='format', default='tei',
+                    help='Export format: tei (a teiCorpus) or jsonl (one JSON object per line). Defaults to tei.'),
+        make_option('--output', action='store', dest='output', default=None,
+                    help='Directory of the export files. Defaults to the standard output (one file, not compressed).'),
+        make_option('--shard-size', action='store', dest='shard_size', type='int', default=0,
+                    help='Number of editions per export file. Defaults to all the editions in one file.'),
+        make_option('--gzip', action='store_true', dest='gzip', default=False,
+                    help='Compress the export files with gzip.'),
+        make_option('--chunk-size', action='store', dest='chunk_size', type='int', default=export.CHUNK_SIZE,
+                    help='Number of editions read from the database at a time. Defaults to %d.' % export.CHUNK_SIZE),
+        make_option('--database', action='store', dest='database', default=DEFAULT_DB_ALIAS,
+                    help='Nominates a database to export from. Defaults to the "default" database.'),
+        )
+    help = 'Exports the editions (or those of the given ids) with their witnesses, transcriptions, commentaries and facsimiles, as TEI XML or JSON Lines.'
+    args = '[edition id ...]'
+
+    def handle (self, *args, **options):
+        format = options['format']
+        if format not in export.FORMATS:
+            raise CommandError('Unknown format %r, use one of: %s.' % (
+                    format, ', '.join(sorted(export.FORMATS))))
+        editions = Edition.objects.using(options['database'])
+        if args:
+            try:
+                editions = editions.filter(pk__in=[int(pk) for pk in args])
+            except ValueError:
+                raise CommandError('Edition ids must be integers.')
+        start = time.time()
+        if options['output'] is None:
+            if options['shard_size'] or options['gzip']:
+                raise CommandError('--shard-size and --gzip need --output.')
+            writer = format == 'tei' and export.export_tei or export.export_jsonl
+            for chunk in writer(editions, options['chunk_size']):
+                sys.stdout.write(chunk)
+            return
+        paths = export.write_shards(format, options['output'], editions,
+                                    options['shard_size'], options['gzip'],
+                                    options['chunk_size'])
+        if int(options.get('verbosity', 1)) > 0:
+            for path in paths:
+                self.stdout.write('%s\n' % path)
+            self.stdout.write('Exported in %d file(s) in %.1fs.\n' % (
+                    len(paths), time.time() - start))
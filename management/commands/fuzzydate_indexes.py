@@ -0,0 +1,38 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connections, DEFAULT_DB_ALIAS
+from django.db.models import get_app, get_models
+
+from legal_editions.fuzzydate.fields import createRangeIndexes, getRangeIndexSQL
+
+
+class Command (BaseCommand):
+
+    help = 'Creates the composite indexes of the fuzzy date fields (range_index option) on existing tables.'
+    args = '[appname ...]'
+    option_list = BaseCommand.option_list + (
+        make_option('--sql', action='store_true', dest='sql', default=False,
+                    help='Print the SQL statements instead of running them.'),
+        make_option('--database', action='store', dest='database',
+                    default=DEFAULT_DB_ALIAS,
+                    help='Nominates a database. Defaults to the "default" database.'),)
+
+    def handle (self, *app_labels, **options):
+        using = options.get('database')
+        verbosity = int(options.get('verbosity', 1))
+        if app_labels:
+            try:
+                model_list = []
+                for app_label in app_labels:
+                    model_list.extend(get_models(get_app(app_label)))
+            except Exception, e:
+                raise CommandError(e)
+        else:
+            model_list = get_models()
+        for model in model_list:
+            if options.get('sql'):
+                for sql in getRangeIndexSQL(model, connections[using]):
+                    self.stdout.write('%s\n' % sql)
+            else:
+                createRangeIndexes(model, using, verbosity)
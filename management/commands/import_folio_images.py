@@ -0,0 +1,217 @@
+import os
+import time
+from multiprocessing.pool import ThreadPool
+from optparse import make_option
+
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from legal_editions.folios import natural_sort_key, parse_folio, SIDE_NAMES
+from legal_editions.importer import insert_objects
+from legal_editions.listings import update_listings
+from legal_editions.models import FolioImage, FolioSide, Manuscript
+
+
+IMAGE_EXTENSIONS = ('.jpg', '.jpeg', '.jp2', '.png', '.tif', '.tiff')
+
+FILEPATH_MAX_LENGTH = FolioImage._meta.get_field('filepath').max_length
+
+
+def stat_file (path):
+    try:
+        return path, os.stat(path)
+    except OSError:
+        return path, None
+
+
+class Command (BaseCommand):
+
+    help = '''Creates the FolioImage records of the image files found under a directory.
+
+The files are expected to be laid out as <directory>/<manuscript>/.../<folio>.<ext>,
+where <manuscript> is the slug or the sigla of a manuscript and <folio> ends with
+a folio number and side (e.g. 012v.jpg). The batch is the name of the directory
+and the filepath of an image is its path from the parent of the directory.
+Files already recorded (same filepath) are skipped, so an interrupted import can
+be run again.'''
+    args = '<directory>'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch', action='store', dest='batch', default=None,
+                    help='Batch of the images. Defaults to the name of the directory.'),
+        make_option('--manuscript', action='store', dest='manuscript',
+                    default=None,
+                    help='Slug or sigla of the manuscript of all the images, instead of inferring it from the path.'),
+        make_option('--default-side', action='store', dest='default_side',
+                    default=None,
+                    help='Name of the folio side of the images whose side can\'t be read from the file name. They are skipped otherwise.'),
+        make_option('--chunk-size', action='store', dest='chunk_size',
+                    default=500, type='int',
+                    help='Number of records inserted per transaction. Defaults to 500.'),
+        make_option('--threads', action='store', dest='threads', default=8,
+                    type='int',
+                    help='Number of threads reading the file metadata. Defaults to 8.'),
+        make_option('--derivatives', action='store_true', dest='derivatives',
+                    default=False,
+                    help='Make the thumbnails and tiles of the batch afterwards (see make_folio_derivatives).'),
+        make_option('--dry-run', action='store_true', dest='dry_run',
+                    default=False,
+                    help='Read the directory and report without saving anything.'),
+        make_option('--database', action='store', dest='database',
+                    default=DEFAULT_DB_ALIAS,
+                    help='Nominates a database. Defaults to the "default" database.'),)
+
+    def handle (self, *args, **options):
+        if len(args) != 1:
+            raise CommandError('Enter the directory of the images.')
+        root = os.path.abspath(args[0])
+        if not os.path.isdir(root):
+            raise CommandError('%s is not a directory.' % root)
+        self.using = options.get('database')
+        self.verbosity = int(options.get('verbosity', 1))
+        self.dry_run = options.get('dry_run')
+        self.chunk_size = max(1, options.get('chunk_size'))
+        self.batch = options.get('batch') or os.path.basename(root)
+        self.load_manuscripts(options.get('manuscript'))
+        self.load_sides(options.get('default_side'))
+        self.created = self.existing = self.skipped = 0
+        self.manuscript_ids = set()
+        self.start = time.time()
+        pool = ThreadPool(max(1, options.get('threads')))
+        try:
+            chunk = []
+            for image in self.read_images(root, pool):
+                chunk.append(image)
+                if len(chunk) >= self.chunk_size:
+                    self.save_chunk(chunk)
+                    chunk = []
+            if chunk:
+                self.save_chunk(chunk)
+        finally:
+            pool.close()
+            pool.join()
+        # the records inserted in bulk haven't been numbered by the signals
+        for manuscript in Manuscript.objects.using(self.using).filter(
+            pk__in=self.manuscript_ids):
+            manuscript.update_reading_order()
+        update_listings(self.manuscript_ids, self.using)
+        if self.verbosity > 0:
+            self.stdout.write('%s\n' % self.get_progress())
+        if options.get('derivatives') and not self.dry_run:
+            call_command('make_folio_derivatives', batch=self.batch,
+                         database=self.using, verbosity=self.verbosity)
+
+    def load_manuscripts (self, manuscript):
+        qs = Manuscript.objects.using(self.using)
+        if manuscript is not None:
+            try:
+                self.manuscript_id = qs.filter(slug=manuscript).values_list(
+                    'id', flat=True)[0]
+            except IndexError:
+                try:
+                    self.manuscript_id = qs.filter(
+                        sigla__iexact=manuscript).values_list('id', flat=True)[0]
+                except IndexError:
+                    raise CommandError('No manuscript "%s".' % manuscript)
+            return
+        self.manuscript_id = None
+        rows = qs.order_by('-id').values_list('id', 'slug', 'sigla')
+        # slugs have priority over siglas
+        self.manuscripts = dict([(sigla.lower(), pk) for pk, slug, sigla in rows
+                                 if sigla])
+        self.manuscripts.update([(slug.lower(), pk) for pk, slug, sigla in rows
+                                 if slug])
+
+    def load_sides (self, default_side):
+        rows = list(FolioSide.objects.using(self.using).values_list(
+                'id', 'name'))
+        names = dict([(name.lower(), pk) for pk, name in rows])
+        # for the folio keys
+        self.side_names = dict(rows)
+        self.sides = {}
+        for letter, side_names in SIDE_NAMES.items():
+            for name in side_names:
+                if name in names:
+                    self.sides[letter] = names[name]
+                    break
+        self.default_side_id = None
+        if default_side is not None:
+            if default_side.lower() not in names:
+                raise CommandError('No folio side "%s".' % default_side)
+            self.default_side_id = names[default_side.lower()]
+
+    def get_manuscript_id (self, relative_path):
+        if self.manuscript_id is not None:
+            return self.manuscript_id
+        directory = relative_path.split('/')[0]
+        if directory == os.curdir:
+            return None
+        return self.manuscripts.get(directory.lower())
+
+    def read_images (self, root, pool):
+        """Yields the unsaved FolioImage of each image file under root,
+        one directory at a time."""
+        parent = os.path.dirname(root)
+        for dirpath, dirnames, filenames in os.walk(root):
+            dirnames.sort(key=natural_sort_key)
+            filenames = [filename for filename in filenames
+                         if os.path.splitext(filename)[1].lower() in IMAGE_EXTENSIONS]
+            filenames.sort(key=natural_sort_key)
+            path = os.path.relpath(dirpath, parent).replace(os.sep, '/')
+            relative_path = os.path.relpath(dirpath, root).replace(os.sep, '/')
+            manuscript_id = self.get_manuscript_id(relative_path)
+            if manuscript_id is None:
+                if filenames:
+                    self.skip(path, 'unknown manuscript', len(filenames))
+                continue
+            paths = [os.path.join(dirpath, filename) for filename in filenames]
+            stats = dict(pool.imap_unordered(stat_file, paths, 64))
+            for sort_order, filename in enumerate(filenames):
+                stat = stats[os.path.join(dirpath, filename)]
+                filepath = '%s/%s' % (path, filename)
+                # files still being copied are left for the next run
+                if stat is None or not stat.st_size:
+                    self.skip(filepath, 'empty or unreadable file')
+                    continue
+                if len(filepath) > FILEPATH_MAX_LENGTH:
+                    self.skip(filepath, 'path too long')
+                    continue
+                folio_number, side = parse_folio(os.path.splitext(filename)[0])
+                side_id = self.sides.get(side, self.default_side_id)
+                if side_id is None:
+                    self.skip(filepath, 'unknown folio side')
+                    continue
+                image = FolioImage(
+                    filename=filename, filepath=filepath, batch=self.batch,
+                    path=path, folio_number=folio_number,
+                    filename_sort_order=sort_order + 1,
+                    manuscript_id=manuscript_id, folio_side_id=side_id)
+                # save() isn't called on the bulk inserted images
+                image.set_keys(self.side_names[side_id])
+                yield image
+
+    def skip (self, path, reason, count=1):
+        self.skipped += count
+        if self.verbosity > 1:
+            self.stdout.write('Skipped %s: %s\n' % (path, reason))
+
+    def save_chunk (self, chunk):
+        existing = set(FolioImage.objects.using(self.using).filter(
+                filepath__in=[image.filepath for image in chunk]).values_list(
+                'filepath', flat=True))
+        new = [image for image in chunk if image.filepath not in existing]
+        self.existing += len(chunk) - len(new)
+        if new and not self.dry_run:
+            insert_objects(FolioImage, new, self.using)
+            self.manuscript_ids.update([image.manuscript_id for image in new])
+        self.created += len(new)
+        if self.verbosity > 1:
+            self.stdout.write('%s\n' % self.get_progress())
+
+    def get_progress (self):
+        elapsed = max(time.time() - self.start, 0.001)
+        processed = self.created + self.existing
+        return '%d created, %d already recorded, %d skipped in %.1fs (%d rows/s)' % (
+            self.created, self.existing, self.skipped, elapsed,
+            processed / elapsed)
+
@@ -0,0 +1,61 @@
+import time
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from legal_editions.importer import Importer, KINDS, read_csv
+
+
+class Command (BaseCommand):
+
+    help = '''Creates archives, manuscripts, works, versions and witnesses in bulk from CSV files.
+
+Each file has a header line naming its columns, see legal_editions.importer for
+the columns of each kind of record. Records that already exist (same natural
+key) are skipped. Nothing is saved if any row is not valid.'''
+    option_list = BaseCommand.option_list + tuple([
+        make_option('--%s' % kind, action='store', dest=kind, default=None,
+                    help='CSV file of the %s.' % kind) for kind in KINDS]) + (
+        make_option('--delimiter', action='store', dest='delimiter',
+                    default=',',
+                    help='Delimiter of the CSV columns. Defaults to ",".'),
+        make_option('--dry-run', action='store_true', dest='dry_run',
+                    default=False,
+                    help='Validate the files and report without saving anything.'),
+        make_option('--database', action='store', dest='database',
+                    default=DEFAULT_DB_ALIAS,
+                    help='Nominates a database. Defaults to the "default" database.'),)
+
+    def handle (self, *args, **options):
+        paths = dict([(kind, options.get(kind)) for kind in KINDS
+                      if options.get(kind)])
+        if not paths:
+            raise CommandError('Enter at least one file: %s.' % ', '.join(
+                    ['--%s' % kind for kind in KINDS]))
+        start = time.time()
+        rows = {}
+        for kind, path in paths.items():
+            try:
+                rows[kind] = read_csv(path, options.get('delimiter'))
+            except (IOError, StopIteration, UnicodeDecodeError), e:
+                raise CommandError('Can\'t read %s: %s' % (path, e))
+        importer = Importer(options.get('database'), options.get('dry_run'))
+        importer.run(rows)
+        for kind, number, message in importer.errors:
+            self.stderr.write('%s, line %d: %s\n' % (paths[kind], number + 1,
+                                                   message))
+        if importer.errors:
+            raise CommandError('%d error(s), nothing was saved.' %
+                               len(importer.errors))
+        if int(options.get('verbosity', 1)) > 0:
+            elapsed = max(time.time() - start, 0.001)
+            total = sum([len(kind_rows) for kind_rows in rows.values()])
+            for kind in KINDS:
+                if kind in importer.counts:
+                    created, existing = importer.counts[kind]
+                    self.stdout.write('%s: %d created, %d already recorded\n'
+                                      % (kind, created, existing))
+            self.stdout.write('%d rows %s in %.1fs (%d rows/s)\n' % (
+                    total, options.get('dry_run') and 'checked' or 'imported',
+                    elapsed, total / elapsed))
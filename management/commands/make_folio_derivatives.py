@@ -0,0 +1,58 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from legal_editions import derivatives
+from legal_editions.models import FolioImage, Manuscript
+
+
+class Command (BaseCommand):
+
+    help = 'Makes the missing or outdated thumbnails and Deep Zoom tiles of the folio images (see legal_editions.derivatives).'
+    args = '[slug ...]'
+    option_list = BaseCommand.option_list + (
+        make_option('--batch', action='store', dest='batch', default=None,
+                    help='Only process the images of this batch.'),
+        make_option('--processes', action='store', dest='processes',
+                    default=None, type='int',
+                    help='Number of worker processes. Defaults to the number of CPUs.'),
+        make_option('--checksum', action='store_true', dest='checksum',
+                    default=False,
+                    help='Compare the MD5 digests of the sources whose modification time changed.'),
+        make_option('--force', action='store_true', dest='force',
+                    default=False,
+                    help='Process all the images, even the up to date ones.'),
+        make_option('--database', action='store', dest='database',
+                    default=DEFAULT_DB_ALIAS,
+                    help='Nominates a database. Defaults to the "default" database.'),)
+
+    def handle (self, *slugs, **options):
+        if derivatives.Image is None:
+            raise CommandError('The image derivatives require PIL.')
+        using = options.get('database')
+        verbosity = int(options.get('verbosity', 1))
+        images = FolioImage.objects.using(using)
+        if options.get('batch'):
+            images = images.filter(batch=options.get('batch'))
+        manuscripts = Manuscript.objects.using(using).filter(
+            pk__in=images.values('manuscript'))
+        if slugs:
+            manuscripts = manuscripts.filter(slug__in=slugs)
+        log = None
+        if verbosity > 1:
+            log = lambda message: self.stdout.write('%s\n' % message)
+        for manuscript in manuscripts:
+            manuscript_images = images.filter(manuscript=manuscript)
+            processed, up_to_date, failed = derivatives.update_derivatives(
+                manuscript.pk,
+                manuscript_images.order_by('reading_order').values_list(
+                    'id', 'filepath'),
+                options.get('processes'), options.get('checksum'),
+                options.get('force'), log)
+            removed = derivatives.remove_derivatives(
+                manuscript.pk, manuscript.folioimage_set.values_list(
+                    'id', flat=True))
+            if verbosity > 0:
+                self.stdout.write('%s: %d processed, %d up to date, %d failed, %d removed\n' % (
+                        manuscript, processed, up_to_date, failed, removed))
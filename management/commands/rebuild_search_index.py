@@ -0,0 +1,17 @@
+from django.core.management.base import CommandError, NoArgsCommand
+
+from legal_editions import search
+
+
+class Command (NoArgsCommand):
+
+    help = 'Rebuilds the full-text index of the editions, witness transcriptions and commentaries (see legal_editions.search).'
+
+    def handle_noargs (self, **options):
+        index = search.get_index()
+        if index is None:
+            raise CommandError('The LEGAL_EDITIONS_SEARCH_INDEX setting is not set.')
+        log = None
+        if int(options.get('verbosity', 1)) > 0:
+            log = lambda message: self.stdout.write('%s\n' % message)
+        index.rebuild(log)
@@ -0,0 +1,38 @@
+from optparse import make_option
+
+from django.core.management.base import NoArgsCommand
+from django.db import DEFAULT_DB_ALIAS
+
+from legal_editions.models import FolioImage, Witness
+
+
+class Command (NoArgsCommand):
+
+    help = 'Computes the folio keys of the folio images and witness ranges, e.g. after changes made with QuerySet.update().'
+    option_list = NoArgsCommand.option_list + (
+        make_option('--database', action='store', dest='database',
+                    default=DEFAULT_DB_ALIAS,
+                    help='Nominates a database. Defaults to the "default" database.'),)
+
+    def handle_noargs (self, **options):
+        using = options.get('database')
+        verbosity = int(options.get('verbosity', 1))
+        count = 0
+        images = FolioImage.objects.using(using).select_related('folio_side')
+        for image in images.iterator():
+            old = (image.folio_key, image.page_key)
+            image.set_keys()
+            if (image.folio_key, image.page_key) != old:
+                FolioImage.objects.using(using).filter(pk=image.pk).update(
+                    folio_key=image.folio_key, page_key=image.page_key)
+                count += 1
+        for witness in Witness.objects.using(using).iterator():
+            old = (witness.range_start_key, witness.range_end_key)
+            witness.set_keys()
+            if (witness.range_start_key, witness.range_end_key) != old:
+                Witness.objects.using(using).filter(pk=witness.pk).update(
+                    range_start_key=witness.range_start_key,
+                    range_end_key=witness.range_end_key)
+                count += 1
+        if verbosity > 0:
+            self.stdout.write('%d records updated\n' % count)
@@ -0,0 +1,31 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from legal_editions.listings import rebuild_listings, update_listings
+from legal_editions.models import Manuscript
+
+
+class Command (BaseCommand):
+
+    help = 'Updates the catalogue listings of manuscripts (ManuscriptListing), e.g. after changes made with QuerySet.update(). Without slugs, all the listings are rebuilt.'
+    args = '[slug ...]'
+    option_list = BaseCommand.option_list + (
+        make_option('--database', action='store', dest='database',
+                    default=DEFAULT_DB_ALIAS,
+                    help='Nominates a database. Defaults to the "default" database.'),)
+
+    def handle (self, *slugs, **options):
+        using = options.get('database')
+        if slugs:
+            manuscripts = Manuscript.objects.using(using).filter(slug__in=slugs)
+            missing = set(slugs) - set(manuscripts.values_list('slug', flat=True))
+            if missing:
+                raise CommandError('No manuscript "%s".' % '", "'.join(sorted(missing)))
+            written = update_listings(manuscripts.values_list('id', flat=True),
+                                      using)
+        else:
+            written = rebuild_listings(using)
+        if int(options.get('verbosity', 1)) > 0:
+            self.stdout.write('%d listings written\n' % written)
@@ -0,0 +1,29 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DEFAULT_DB_ALIAS
+
+from legal_editions.models import Manuscript
+
+
+class Command (BaseCommand):
+
+    help = 'Numbers the folio images of manuscripts in reading order (FolioImage.reading_order), e.g. after changes made with QuerySet.update().'
+    args = '[slug ...]'
+    option_list = BaseCommand.option_list + (
+        make_option('--database', action='store', dest='database',
+                    default=DEFAULT_DB_ALIAS,
+                    help='Nominates a database. Defaults to the "default" database.'),)
+
+    def handle (self, *slugs, **options):
+        verbosity = int(options.get('verbosity', 1))
+        manuscripts = Manuscript.objects.using(options.get('database'))
+        if slugs:
+            manuscripts = manuscripts.filter(slug__in=slugs)
+            missing = set(slugs) - set(manuscripts.values_list('slug', flat=True))
+            if missing:
+                raise CommandError('No manuscript "%s".' % '", "'.join(sorted(missing)))
+        for manuscript in manuscripts:
+            changed = manuscript.update_reading_order()
+            if verbosity > 1:
+                self.stdout.write('%s: %d images moved\n' % (manuscript, len(changed)))
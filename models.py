@@ -1,8 +1,10 @@
 from django.contrib.auth.models import User
-from django.db import models
+from django.db import connections, models, router, transaction
+from django.db.models import signals
 from django.template.defaultfilters import slugify
 
-from fuzzydate import FuzzyDateField
+from fuzzydate import FuzzyDateField, FuzzyDateManager
+from legal_editions.folios import folio_key, parse_folio, reading_order_key, reference_key
 
 
 class Archive (models.Model):
@@ -43,7 +45,7 @@ class Commentary (models.Model):
 
 class Edition (models.Model):
 
-    date = FuzzyDateField(blank=True, modifier=True, null=True)
+    date = FuzzyDateField(blank=True, modifier=True, null=True, range_index=True)
     text = models.TextField(blank=True)
     translation = models.TextField(blank=True)
     abbreviation = models.CharField(max_length=32)
@@ -53,8 +55,22 @@ class Edition (models.Model):
     status = models.ForeignKey('EditionStatus')
     version = models.ForeignKey('Version')
 
+    objects = FuzzyDateManager()
+
+    def get_collation (self, base=None):
+        """Returns the collation of the witness transcriptions of this
+        edition (see collation.collate)."""
+        from legal_editions.collation import collate
+        return collate(self, base)
+
+    def get_commentaries (self):
+        """Returns the commentaries of this edition grouped by element
+        (see commentaries.get_commentaries)."""
+        from legal_editions.commentaries import get_commentaries
+        return get_commentaries(self)
+
     def get_editors (self):
-        return self.editors.all()
+        return get_prefetched(self, 'editors', self.editors.all)
 
     def get_introduction (self):
         introduction = self.introduction or self.version.synopsis
@@ -98,9 +114,49 @@ class FolioImage (models.Model):
     path = models.CharField(blank=True, max_length=128)
     filename_sort_order = models.IntegerField(blank=True, null=True)
     archived = models.BooleanField()
+    reading_order = models.IntegerField(blank=True, editable=False, null=True, help_text='Position of this image in a sequential reading of the manuscript, maintained by Manuscript.update_reading_order.')
+    folio_key = models.IntegerField(blank=True, editable=False, null=True, help_text='Numeric key of the folio number and side (see folios.folio_key).')
+    page_key = models.IntegerField(blank=True, editable=False, null=True, help_text='Numeric key of the page number (see folios.folio_key).')
     manuscript = models.ForeignKey('Manuscript')
     folio_side = models.ForeignKey('FolioSide')
 
+    def get_next (self):
+        """Returns the next image in the reading order of the
+        manuscript, or None."""
+        return self._get_neighbour('gt', 'reading_order')
+
+    def get_previous (self):
+        """Returns the previous image in the reading order of the
+        manuscript, or None."""
+        return self._get_neighbour('lt', '-reading_order')
+
+    def _get_neighbour (self, lookup, ordering):
+        if self.reading_order is None:
+            return None
+        images = FolioImage.objects.filter(**{
+                'manuscript': self.manuscript_id,
+                'reading_order__%s' % lookup: self.reading_order}).order_by(
+            ordering)[:1]
+        return images and images[0] or None
+
+    def get_reading_order_key (self):
+        return reading_order_key(
+            self.display_order, self.folio_number, self.folio_side.name,
+            self.filename_sort_order, self.filename, self.pk)
+
+    def set_keys (self, side=None):
+        """Computes folio_key and page_key. side is the name of
+        folio_side, if known."""
+        if side is None:
+            side = self.folio_side.name
+        # sides other than recto and verso come after them
+        self.folio_key = folio_key(self.folio_number, side)
+        self.page_key = folio_key(self.page)
+
+    def save (self, *args, **kwargs):
+        self.set_keys()
+        super(FolioImage, self).save(*args, **kwargs)
+
     def __unicode__ (self):
         return self.filepath
 
@@ -153,13 +209,60 @@ class Manuscript (models.Model):
     sigla_provenance = models.ForeignKey('SiglaProvenance', blank=True,
                                          null=True)
 
+    def get_folio_image (self, folio):
+        """Returns the first image of a folio such as '123r' or '10a'
+        (any side), or None."""
+        number, side = parse_folio(folio)
+        key = folio_key(number, side)
+        if key is None:
+            return None
+        if side:
+            images = self.folioimage_set.filter(folio_key=key)
+        else:
+            # the number without a side, recto, verso and the other sides
+            images = self.folioimage_set.filter(folio_key__range=(key,
+                                                                  key + 3))
+        images = images.order_by('reading_order')[:1]
+        return images and images[0] or None
+
+    def get_folio_images (self):
+        """Returns the images of this manuscript in reading order."""
+        return self.folioimage_set.order_by('reading_order')
+
     def get_type_label (self):
         label = 'manuscript'
         if self.standard_edition:
             label = 'edition'
         return label
 
-    def __save__ (self, *args, **kwargs):
+    def update_reading_order (self):
+        """Numbers the images of this manuscript in reading order (see
+        folios.reading_order_key). Only the images whose position
+        changed are saved. Returns a dictionary of the new positions by
+        image id."""
+        images = self.folioimage_set.values_list(
+            'id', 'display_order', 'folio_number', 'folio_side__name',
+            'filename_sort_order', 'filename', 'reading_order')
+        keys = [(reading_order_key(*image[1:6] + (image[0],)), image[0],
+                 image[6]) for image in images]
+        keys.sort()
+        changed = dict([(pk, position) for position, (key, pk, old) in
+                        enumerate(keys) if old != position])
+        if changed:
+            # in one statement, an image inserted at the beginning
+            # moves all the others
+            using = router.db_for_write(FolioImage, instance=self)
+            connection = connections[using]
+            qn = connection.ops.quote_name
+            connection.cursor().executemany(
+                'UPDATE %s SET %s = %%s WHERE %s = %%s' % (
+                    qn(FolioImage._meta.db_table), qn('reading_order'),
+                    qn('id')),
+                [(position, pk) for pk, position in changed.items()])
+            transaction.commit_unless_managed(using=using)
+        return changed
+
+    def save (self, *args, **kwargs):
         self.slug = slugify(self.sigla)
         super(Manuscript, self).save(*args, **kwargs)
 
@@ -170,6 +273,42 @@ class Manuscript (models.Model):
         return u'%s%s' % (self.shelf_mark, sigla)
 
 
+class ManuscriptListing (models.Model):
+
+    """Stores the row of a :model:`legal_editions.Manuscript` in the
+    public catalogue: its archive, sigla provenance, number of folio
+    images and the works of its listed witnesses. Maintained by
+    listings.py."""
+
+    manuscript = models.OneToOneField('Manuscript', primary_key=True, related_name='listing')
+    archive = models.ForeignKey('Archive')
+    archive_name = models.CharField(max_length=128)
+    archive_city = models.CharField(max_length=128)
+    archive_country = models.CharField(blank=True, max_length=128)
+    shelf_mark = models.CharField(max_length=128)
+    sigla = models.CharField(blank=True, max_length=32)
+    slug = models.SlugField(max_length=250)
+    sigla_provenance = models.CharField(blank=True, max_length=32)
+    hide_from_listings = models.BooleanField()
+    checked_folios = models.BooleanField()
+    single_sheet = models.BooleanField()
+    standard_edition = models.BooleanField()
+    folio_image_count = models.IntegerField(default=0)
+    works = models.TextField(blank=True, help_text='Names of the works of the listed witnesses, one per line.')
+
+    class Meta:
+        ordering = ['archive_name', 'archive_city', 'shelf_mark']
+
+    def get_works (self):
+        return self.works and self.works.split('\n') or []
+
+    def __unicode__ (self):
+        sigla = ''
+        if self.sigla:
+            sigla = ' (%s)' % self.sigla
+        return u'%s%s' % (self.shelf_mark, sigla)
+
+
 class Person (models.Model):
     
     name = models.CharField(max_length=128, unique=True)
@@ -186,8 +325,10 @@ class King (Person):
     """Stores details about a king, related when appropriate to a
     :model:`legal_editions.Work`."""
 
-    beginning_regnal_year = FuzzyDateField(blank=True, modifier=True, null=True)
-    end_regnal_year = FuzzyDateField(blank=True, modifier=True, null=True)
+    beginning_regnal_year = FuzzyDateField(blank=True, modifier=True, null=True, range_index=True)
+    end_regnal_year = FuzzyDateField(blank=True, modifier=True, null=True, range_index=True)
+
+    objects = FuzzyDateManager()
 
 
 class SiglaProvenance (models.Model):
@@ -211,6 +352,57 @@ class TextAttribute (models.Model):
         return self.name
 
 
+def get_prefetched (obj, name, query):
+    """Returns the related objects name prefetched on obj (see
+    VersionManager.get_detail), or else the result of query()."""
+    prefetched = obj.__dict__.get('_prefetched', {})
+    if name in prefetched:
+        return prefetched[name]
+    return query()
+
+
+def set_prefetched (obj, name, objects):
+    obj.__dict__.setdefault('_prefetched', {})[name] = objects
+
+
+class VersionManager (FuzzyDateManager):
+
+    def get_detail (self, **kwargs):
+        """Returns the version matching kwargs (as QuerySet.get) with the
+        objects shown on its page, in 6 queries: the version and its work,
+        its languages, its witnesses with their manuscripts, archives and
+        works, the languages of the witnesses, its editions with their
+        statuses and the editors of the editions. get_languages,
+        get_witnesses and get_editions of the version, get_languages of
+        its witnesses and get_editors of its editions return them without
+        further queries."""
+        version = self.get_query_set().select_related('work').get(**kwargs)
+        set_prefetched(version, 'languages', list(Language.objects.filter(
+                    version=version)))
+        witnesses = list(Witness.objects.filter(version=version).select_related(
+                'manuscript__archive', 'work').order_by('manuscript__sigla',
+                                                        'id'))
+        languages = {}
+        for link in Witness.languages.through.objects.filter(
+            witness__in=witnesses).select_related('language').order_by('id'):
+            languages.setdefault(link.witness_id, []).append(link.language)
+        for witness in witnesses:
+            set_prefetched(witness, 'languages', languages.get(witness.pk, []))
+        set_prefetched(version, 'witnesses', witnesses)
+        editions = list(version.edition_set.select_related('status').order_by(
+                'id'))
+        editors = {}
+        for link in Edition.editors.through.objects.filter(
+            edition__in=editions).select_related('editor').order_by('id'):
+            editors.setdefault(link.edition_id, []).append(link.editor)
+        for edition in editions:
+            # Edition.__unicode__ shows the name of the version
+            edition._version_cache = version
+            set_prefetched(edition, 'editors', editors.get(edition.pk, []))
+        set_prefetched(version, 'editions', editions)
+        return version
+
+
 class Version (models.Model):
 
     standard_abbreviation = models.CharField(max_length=32, unique=True)
@@ -219,26 +411,42 @@ class Version (models.Model):
     slug = models.SlugField(max_length=250)
     print_editions = models.TextField(blank=True)
     synopsis_manuscripts = models.TextField(blank=True)
-    date = FuzzyDateField(blank=True, modifier=True, null=True)
+    date = FuzzyDateField(blank=True, modifier=True, null=True, range_index=True)
     graph = models.TextField(blank=True)
     work = models.ForeignKey('Work')
     witnesses = models.ManyToManyField('Witness')
     languages = models.ManyToManyField('Language')
 
+    objects = VersionManager()
+
     class Meta:
         ordering = ['standard_abbreviation']
 
+    def get_ancestors (self):
+        """Returns the versions this version derives from, through any
+        number of relationships."""
+        return Version.objects.filter(descendant_links__descendant=self)
+
+    def get_descendants (self):
+        """Returns the versions derived from this version, through any
+        number of relationships."""
+        return Version.objects.filter(ancestor_links__ancestor=self)
+
+    def get_editions (self):
+        return get_prefetched(self, 'editions', self.edition_set.all)
+
     def get_languages (self):
-        return self.languages.all()
+        return get_prefetched(self, 'languages', self.languages.all)
 
     def get_name (self):
         name = self.name or self.work.name
         return name
 
     def get_witnesses (self):
-        self.witness_set.all().order_by('manuscript__sigla')
+        return get_prefetched(self, 'witnesses', lambda: self.witnesses.order_by(
+                'manuscript__sigla', 'id'))
 
-    def __save__ (self, *args, **kwargs):
+    def save (self, *args, **kwargs):
         self.slug = slugify(self.standard_abbreviation)
         super(Version, self).save(*args, **kwargs)
 
@@ -246,6 +454,25 @@ class Version (models.Model):
         return u'%s - %s' % (self.standard_abbreviation, self.get_name())
 
 
+class VersionClosure (models.Model):
+
+    """Stores the transitive closure of the
+    :model:`legal_editions.VersionRelationship` graph: a descendant
+    derives from an ancestor through depth relationships (the fewest).
+    Maintained by stemma.update_closure."""
+
+    ancestor = models.ForeignKey('Version', related_name='descendant_links')
+    descendant = models.ForeignKey('Version', related_name='ancestor_links')
+    depth = models.IntegerField()
+
+    class Meta:
+        unique_together = (('ancestor', 'descendant'),)
+
+    def __unicode__ (self):
+        return u'%s -> %s (%d)' % (self.ancestor_id, self.descendant_id,
+                                   self.depth)
+
+
 class VersionRelationship (models.Model):
 
     """Stores a directed relationship between two versions. Related to
@@ -284,6 +511,8 @@ class Witness (models.Model):
     medieval_translation = models.BooleanField()
     page = models.BooleanField(help_text='Tick this box if the range is expressed in page numbers. Leave it unticked if the range is expressed in folio numbers.')
     hide_from_listings = models.BooleanField(help_text='Hide this witness from the manuscript listings on the webiste.')
+    range_start_key = models.IntegerField(blank=True, editable=False, null=True)
+    range_end_key = models.IntegerField(blank=True, editable=False, null=True)
     manuscript = models.ForeignKey('Manuscript')
     work = models.ForeignKey('Work')
     languages = models.ManyToManyField('Language')
@@ -291,8 +520,55 @@ class Witness (models.Model):
     class Meta:
         verbose_name_plural = 'Witnesses'
 
+    def get_folio_images (self):
+        """Returns the images of the range of this witness, in reading
+        order. An empty bound leaves the range open on that side; without
+        any bound, there are no images."""
+        images = FolioImage.objects.filter(manuscript=self.manuscript_id)
+        if self.range_start_key is None and self.range_end_key is None:
+            return images.none()
+        key = self.page and 'page_key' or 'folio_key'
+        if self.range_start_key is not None:
+            images = images.filter(**{'%s__gte' % key: self.range_start_key})
+        if self.range_end_key is not None:
+            images = images.filter(**{'%s__lte' % key: self.range_end_key})
+        return images.order_by('reading_order')
+
     def get_languages (self):
-        return self.languages.all()
+        return get_prefetched(self, 'languages', self.languages.all)
+
+    def set_keys (self):
+        """Computes range_start_key and range_end_key."""
+        self.range_start_key = reference_key(self.range_start)
+        self.range_end_key = reference_key(self.range_end, end=True)
+
+    def save (self, *args, **kwargs):
+        self.set_keys()
+        super(Witness, self).save(*args, **kwargs)
+
+    def __unicode__ (self):
+        return u'%s in %s' % (self.work, self.manuscript)
+
+
+class WitnessAlignment (models.Model):
+
+    """Stores the differences between a
+    :model:`legal_editions.WitnessTranscription` and the base
+    transcription of a collation, with the digests of both texts when
+    they were computed (see collation.py)."""
+
+    transcription = models.ForeignKey('WitnessTranscription', related_name='alignments')
+    base = models.ForeignKey('WitnessTranscription', related_name='base_alignments')
+    transcription_hash = models.CharField(max_length=32)
+    base_hash = models.CharField(max_length=32)
+    differences = models.TextField(help_text='JSON list of the (base start, base end, reading, normalized reading) of the differences.')
+
+    class Meta:
+        unique_together = (('transcription', 'base'),)
+
+    def __unicode__ (self):
+        return u'Alignment of %s against %s' % (self.transcription_id,
+                                                self.base_id)
 
 
 class WitnessTranscription (models.Model):
@@ -318,10 +594,12 @@ class Work (models.Model):
     particular instance of that text."""
 
     name = models.CharField(max_length=128, unique=True)
-    date = FuzzyDateField(blank=True, modifier=True, null=True)
+    date = FuzzyDateField(blank=True, modifier=True, null=True, range_index=True)
     king = models.ForeignKey('King', blank=True, null=True)
     text_attributes = models.ManyToManyField('TextAttribute')
 
+    objects = FuzzyDateManager()
+
     class Meta:
         ordering = ['name']
 
@@ -330,3 +608,39 @@ class Work (models.Model):
 
     def __unicode__ (self):
         return self.name
+
+
+def get_reading_order_inputs (image):
+    # the fields of FolioImage.get_reading_order_key, and the manuscript
+    return (image.display_order, image.folio_number, image.folio_side_id,
+            image.filename_sort_order, image.filename, image.manuscript_id)
+
+
+def remember_folio_image_reading_order (sender, instance, **kwargs):
+    # the values of get_reading_order_inputs before the image is changed
+    if instance.pk is None:
+        return
+    values = list(FolioImage.objects.using(kwargs.get('using')).filter(
+            pk=instance.pk).values_list(
+            'display_order', 'folio_number', 'folio_side',
+            'filename_sort_order', 'filename', 'manuscript'))
+    instance._reading_order_inputs = values and values[0] or None
+
+
+def update_folio_image_reading_order (sender, instance, created, **kwargs):
+    # Deleting an image leaves a gap, which doesn't affect the navigation.
+    inputs = instance.__dict__.pop('_reading_order_inputs', None)
+    if (not created and instance.reading_order is not None and
+        inputs == get_reading_order_inputs(instance)):
+        # the position of no image changed
+        return
+    changed = instance.manuscript.update_reading_order()
+    instance.reading_order = changed.get(instance.pk, instance.reading_order)
+
+signals.pre_save.connect(remember_folio_image_reading_order, sender=FolioImage)
+signals.post_save.connect(update_folio_image_reading_order, sender=FolioImage)
+
+# connect the signals that keep the search index, the stemma, the
+# fragment cache and the manuscript listings up to date, and report the
+# orphaned commentaries
+from legal_editions import commentaries, fragments, listings, search, stemma
@@ -0,0 +1,505 @@
+"""Full-text index of the texts of the editions, witness transcriptions
+and commentaries.
+
+The index is an SQLite file (LEGAL_EDITIONS_SEARCH_INDEX setting) holding
+a positional inverted index: the postings of a term list the positions of
+the term in each indexed field. It is updated by the post_save and
+post_delete signals; without the setting, nothing is indexed. Build it
+for existing records with ./manage.py rebuild_search_index.
+
+    from legal_editions import search
+    for result in search.search(u'"cyninges laga" NEAR/5 wite'):
+        print result.object, result.field, result.score, result.snippet
+
+A query is a list of clauses that must all match a field:
+
+    word            the word
+    "a b c"         the words in that order
+    a NEAR/n b      the two words (or phrases) at most n words apart (n
+                    defaults to 10)
+
+Results are ranked with BM25. The tokenizer ignores markup, case, accents
+and abbreviation marks, and folds the spellings of Old English and Latin
+(thorn and eth, wynn, yogh, long s, u/v, i/j, ...), so that a query finds
+all the spellings it folds to.
+"""
+
+import array
+import heapq
+import math
+import os
+import re
+import sqlite3
+import threading
+import unicodedata
+
+from django.conf import settings
+from django.db.models import get_model, signals
+from django.utils.encoding import force_unicode
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+
+# Indexed fields of each model
+SEARCH_FIELDS = {
+    'legal_editions.Commentary': ('text',),
+    'legal_editions.Edition': ('text', 'translation'),
+    'legal_editions.WitnessTranscription': ('transcription', 'translation'),
+}
+
+# Letters folded by normalize_token, after the accents and combining
+# abbreviation marks are removed
+FOLDED_LETTERS = {
+    u'\u00fe': u'th',  # thorn
+    u'\u00f0': u'th',  # eth
+    u'\u01bf': u'w',   # wynn
+    u'\u021d': u'g',   # yogh
+    u'\u00e6': u'ae',  # ash
+    u'\u0153': u'oe',
+    u'\u017f': u's',   # long s
+    u'\u204a': u'et',  # Tironian et
+    u'\ua751': u'per', # p with stroke through descender
+    u'\ua753': u'pro', # p with flourish
+    u'\ua75d': u'rum', # rum rotunda
+    u'j': u'i',
+    u'v': u'u',
+}
+
+# Markup and character references are replaced by spaces so that the
+# offsets of the words are those of the original text.
+MARKUP_RE = re.compile(r'<[^>]*>|&#?\w+;')
+# Words, with their combining marks (abbreviation marks, accents)
+WORD_RE = re.compile(u'(?:[\\w\u204a][\u0300-\u036f\u1dc0-\u1dff\ufe20-\ufe2f]*)+',
+                     re.UNICODE)
+QUERY_RE = re.compile(r'"([^"]*)"|(\S+)', re.UNICODE)
+NEAR_RE = re.compile(r'^NEAR(?:/(\d+))?$')
+DEFAULT_NEAR_DISTANCE = 10
+
+# BM25 parameters
+K1 = 1.2
+B = 0.75
+
+SNIPPET_WORDS = 12
+# Number of documents read per query in the documents table
+CHUNK_SIZE = 500
+
+SCHEMA = '''
+CREATE TABLE IF NOT EXISTS documents (
+    id INTEGER PRIMARY KEY,
+    model TEXT NOT NULL,
+    object_id INTEGER NOT NULL,
+    field TEXT NOT NULL,
+    length INTEGER NOT NULL,
+    UNIQUE (model, object_id, field));
+CREATE TABLE IF NOT EXISTS terms (
+    id INTEGER PRIMARY KEY,
+    term TEXT NOT NULL UNIQUE);
+CREATE TABLE IF NOT EXISTS postings (
+    term_id INTEGER NOT NULL,
+    document_id INTEGER NOT NULL,
+    positions BLOB NOT NULL,
+    PRIMARY KEY (term_id, document_id));
+CREATE INDEX IF NOT EXISTS postings_document ON postings (document_id);
+'''
+
+
+# word -> normalized word, emptied when it reaches NORMALIZED_CACHE_SIZE
+_normalized = {}
+NORMALIZED_CACHE_SIZE = 100000
+
+
+def normalize_token (word):
+    """Returns the indexed form of a word."""
+    ret = _normalized.get(word)
+    if ret is None:
+        if len(_normalized) >= NORMALIZED_CACHE_SIZE:
+            _normalized.clear()
+        ret = unicodedata.normalize('NFKD', word.lower())
+        ret = _normalized[word] = u''.join(
+            [FOLDED_LETTERS.get(c, c) for c in ret
+             if not unicodedata.combining(c)])
+    return ret
+
+
+def tokenize (text):
+    """Yields the (normalized word, start, end) of the words of text,
+    outside the markup. A bytestring is decoded from UTF-8."""
+    text = MARKUP_RE.sub(lambda match: u' ' * len(match.group()),
+                         force_unicode(text))
+    for match in WORD_RE.finditer(text):
+        token = normalize_token(match.group())
+        if token:
+            yield token, match.start(), match.end()
+
+
+def parse_query (query):
+    """Returns the clauses of a query: a list of ('phrase', words) and
+    ('near', first words, second words, distance). A single word is a
+    phrase of one word. Raises ValueError if a NEAR lacks a word or
+    phrase on either side."""
+    clauses = []
+    near = None
+    for phrase, word in QUERY_RE.findall(query):
+        match = word and NEAR_RE.match(word)
+        if match:
+            if not clauses or near is not None:
+                raise ValueError('NEAR needs a word or phrase on each side.')
+            near = int(match.group(1) or DEFAULT_NEAR_DISTANCE)
+            continue
+        words = [token for token, start, end in tokenize(phrase or word)]
+        if not words:
+            continue
+        if near is None:
+            clauses.append(('phrase', words))
+        elif clauses[-1][0] == 'phrase':
+            clauses[-1] = ('near', clauses[-1][1], words, near)
+        else:
+            # a NEAR b NEAR c: b near c too
+            clauses.append(('near', clauses[-1][2], words, near))
+        near = None
+    if near is not None:
+        raise ValueError('NEAR needs a word or phrase on each side.')
+    return clauses
+
+
+def _get_phrase_starts (postings, words):
+    # positions of the first word followed by the others
+    return [position for position in postings[words[0]]
+            if all([position + offset in postings[word]
+                    for offset, word in enumerate(words[1:], 1)])]
+
+
+def _match_phrase (postings, words):
+    if len(words) == 1:
+        return postings[words[0]]
+    ret = []
+    for position in _get_phrase_starts(postings, words):
+        ret.extend(range(position, position + len(words)))
+    return ret
+
+
+def _match_near (postings, first, second, distance):
+    # the phrases first and second at most distance words apart, from the
+    # end of one to the start of the other
+    ret = set()
+    second_starts = sorted(_get_phrase_starts(postings, second))
+    for start in _get_phrase_starts(postings, first):
+        end = start + len(first) - 1
+        for other in second_starts:
+            other_end = other + len(second) - 1
+            if other > end + distance:
+                break
+            if other_end >= start - distance:
+                ret.update(range(start, end + 1))
+                ret.update(range(other, other_end + 1))
+    return sorted(ret)
+
+
+def get_label (model):
+    """Returns the label of a model in SEARCH_FIELDS."""
+    # the classes of the instances with deferred fields are proxies
+    if getattr(model, '_deferred', False):
+        model = model._meta.proxy_for_model
+    return '%s.%s' % (model._meta.app_label, model._meta.object_name)
+
+
+class SearchResult (object):
+
+    """A field of an object matching a query. snippet is the HTML of the
+    text around the first match, with the matching words in <b>."""
+
+    def __init__ (self, model, object_id, field, score, positions):
+        self.model = model
+        self.object_id = object_id
+        self.field = field
+        self.score = score
+        self.positions = positions
+        self.object = None
+        self.snippet = None
+
+    def make_snippet (self, text, size=SNIPPET_WORDS):
+        positions = set(self.positions)
+        all_words = list(tokenize(text))
+        first = min(positions or [0])
+        begin, end = max(first - size // 2, 0), first + size
+        words = all_words[begin:end]
+        if not words:
+            return mark_safe(u'')
+        output = []
+        if begin:
+            output.append(u'... ')
+        last = words[0][1]
+        for position, (token, start, end_offset) in enumerate(words):
+            # the text between the words, without the markup
+            output.append(escape(MARKUP_RE.sub(u' ', text[last:start])))
+            word = escape(text[start:end_offset])
+            if position + begin in positions:
+                word = u'<b>%s</b>' % word
+            output.append(word)
+            last = end_offset
+        if end < len(all_words):
+            output.append(u' ...')
+        return mark_safe(u''.join(output))
+
+
+class SearchIndex (object):
+
+    """A positional inverted index in an SQLite file. See module doc."""
+
+    def __init__ (self, path):
+        self.path = path
+        self._local = threading.local()
+
+    @property
+    def connection (self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            directory = os.path.dirname(self.path)
+            if directory and not os.path.isdir(directory):
+                os.makedirs(directory)
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.executescript(SCHEMA)
+            self._local.connection = connection
+        return connection
+
+    def _get_term_ids (self, cursor, terms, create=False):
+        ids = {}
+        terms = list(terms)
+        for i in range(0, len(terms), CHUNK_SIZE):
+            chunk = terms[i:i + CHUNK_SIZE]
+            cursor.execute('SELECT term, id FROM terms WHERE term IN (%s)' %
+                           ', '.join(['?'] * len(chunk)), chunk)
+            ids.update(cursor.fetchall())
+        if create:
+            for term in terms:
+                if term not in ids:
+                    cursor.execute('INSERT INTO terms (term) VALUES (?)',
+                                   (term,))
+                    ids[term] = cursor.lastrowid
+        return ids
+
+    def _remove (self, cursor, model, object_id):
+        cursor.execute('SELECT id FROM documents WHERE model = ? AND object_id = ?',
+                       (model, object_id))
+        for (document_id,) in cursor.fetchall():
+            cursor.execute('DELETE FROM postings WHERE document_id = ?',
+                           (document_id,))
+            cursor.execute('DELETE FROM documents WHERE id = ?',
+                           (document_id,))
+
+    def index_object (self, obj, commit=True):
+        """Indexes (again) the search fields of a model instance."""
+        model = get_label(obj.__class__)
+        connection = self.connection
+        cursor = connection.cursor()
+        try:
+            self._remove(cursor, model, obj.pk)
+            for field in SEARCH_FIELDS[model]:
+                postings = {}
+                length = 0
+                for position, (token, start, end) in enumerate(
+                    tokenize(getattr(obj, field) or u'')):
+                    postings.setdefault(token, array.array('I')).append(
+                        position)
+                    length = position + 1
+                if not length:
+                    continue
+                cursor.execute('INSERT INTO documents (model, object_id, field, length) VALUES (?, ?, ?, ?)',
+                               (model, obj.pk, field, length))
+                document_id = cursor.lastrowid
+                ids = self._get_term_ids(cursor, postings, create=True)
+                cursor.executemany(
+                    'INSERT INTO postings (term_id, document_id, positions) VALUES (?, ?, ?)',
+                    [(ids[term], document_id, buffer(positions.tostring()))
+                     for term, positions in postings.iteritems()])
+            if commit:
+                connection.commit()
+        except:
+            connection.rollback()
+            raise
+
+    def remove_object (self, obj):
+        model = get_label(obj.__class__)
+        connection = self.connection
+        try:
+            self._remove(connection.cursor(), model, obj.pk)
+            connection.commit()
+        except:
+            connection.rollback()
+            raise
+
+    def clear (self):
+        connection = self.connection
+        connection.executescript('DELETE FROM postings; DELETE FROM documents; DELETE FROM terms;')
+        connection.commit()
+
+    def rebuild (self, log=None):
+        """Indexes all the objects of the models in SEARCH_FIELDS."""
+        self.clear()
+        for label, fields in SEARCH_FIELDS.items():
+            model = get_model(*label.split('.'))
+            count = 0
+            for obj in model._default_manager.only(*fields).iterator():
+                self.index_object(obj, commit=False)
+                count += 1
+                if not count % CHUNK_SIZE:
+                    self.connection.commit()
+            self.connection.commit()
+            if log:
+                log('%s: %d objects' % (label, count))
+        self.connection.execute('VACUUM')
+
+    def _get_positions (self, cursor, term_ids, documents):
+        # term -> {document id: set of positions}, for some documents
+        ret = dict([(term, {}) for term in term_ids])
+        documents = list(documents)
+        for term, term_id in term_ids.items():
+            for i in range(0, len(documents), CHUNK_SIZE):
+                chunk = documents[i:i + CHUNK_SIZE]
+                cursor.execute('SELECT document_id, positions FROM postings WHERE term_id = ? AND document_id IN (%s)' %
+                               ', '.join(['?'] * len(chunk)),
+                               [term_id] + chunk)
+                for document_id, positions in cursor:
+                    ret[term][document_id] = set(
+                        array.array('I', str(positions)))
+        return ret
+
+    def search (self, query, limit=20, models=None):
+        """Returns the SearchResults of the fields matching query, best
+        first, without their objects. models restricts the results to
+        some model labels (e.g. 'legal_editions.Edition'). Raises
+        ValueError if the query isn't valid (see parse_query)."""
+        clauses = parse_query(query)
+        if not clauses:
+            return []
+        terms = set()
+        for clause in clauses:
+            terms.update(clause[1])
+            if clause[0] == 'near':
+                terms.update(clause[2])
+        cursor = self.connection.cursor()
+        term_ids = self._get_term_ids(cursor, terms)
+        if len(term_ids) < len(terms):
+            return []
+        # the fields containing all the words, from the primary key index
+        # (the positions are only read for these fields)
+        frequencies = {}
+        candidates = None
+        for term, term_id in term_ids.items():
+            cursor.execute('SELECT document_id FROM postings WHERE term_id = ?',
+                           (term_id,))
+            documents = set([row[0] for row in cursor])
+            frequencies[term] = len(documents)
+            if candidates is None:
+                candidates = documents
+            else:
+                candidates &= documents
+        if not candidates:
+            return []
+        cursor.execute('SELECT COUNT(*), AVG(length) FROM documents')
+        count, average_length = cursor.fetchone()
+        candidates = list(candidates)
+        documents = {}
+        for i in range(0, len(candidates), CHUNK_SIZE):
+            chunk = candidates[i:i + CHUNK_SIZE]
+            cursor.execute('SELECT id, model, object_id, field, length FROM documents WHERE id IN (%s)' %
+                           ', '.join(['?'] * len(chunk)), chunk)
+            for row in cursor:
+                if models is None or row[1] in models:
+                    documents[row[0]] = row[1:]
+        postings = self._get_positions(cursor, term_ids, documents)
+        idf = dict([(term, math.log(1 + (count - frequencies[term] + 0.5) /
+                                    (frequencies[term] + 0.5)))
+                    for term in terms])
+        results = []
+        for document_id, (model, object_id, field, length) in documents.iteritems():
+            document_postings = dict([(term, postings[term][document_id])
+                                      for term in terms])
+            positions = []
+            for clause in clauses:
+                if clause[0] == 'phrase':
+                    matches = _match_phrase(document_postings, clause[1])
+                else:
+                    matches = _match_near(document_postings, clause[1],
+                                          clause[2], clause[3])
+                if not matches:
+                    break
+                positions.extend(matches)
+            else:
+                score = 0
+                for term in terms:
+                    frequency = len(document_postings[term])
+                    score += idf[term] * frequency * (K1 + 1) / (
+                        frequency + K1 * (1 - B + B * length / average_length))
+                results.append(SearchResult(model, object_id, field, score,
+                                            positions))
+        return heapq.nlargest(limit, results, key=lambda result: result.score)
+
+
+_index = None
+_index_lock = threading.Lock()
+
+
+def get_index ():
+    """Returns the SearchIndex of the LEGAL_EDITIONS_SEARCH_INDEX setting,
+    or None if it isn't set."""
+    global _index
+    path = getattr(settings, 'LEGAL_EDITIONS_SEARCH_INDEX', None)
+    if path is None:
+        return None
+    if _index is None or _index.path != path:
+        _index_lock.acquire()
+        try:
+            if _index is None or _index.path != path:
+                _index = SearchIndex(path)
+        finally:
+            _index_lock.release()
+    return _index
+
+
+def search (query, limit=20, models=None, snippets=True):
+    """Returns the SearchResults of query (see SearchIndex.search) with
+    their objects and, unless snippets is False, their snippets. Reads
+    one query per model."""
+    index = get_index()
+    if index is None:
+        raise ValueError('The LEGAL_EDITIONS_SEARCH_INDEX setting is required to search.')
+    results = index.search(query, limit, models)
+    object_ids = {}
+    for result in results:
+        object_ids.setdefault(result.model, set()).add(result.object_id)
+    objects = {}
+    for label, ids in object_ids.items():
+        model = get_model(*label.split('.'))
+        objects[label] = model._default_manager.in_bulk(list(ids))
+    ret = []
+    for result in results:
+        result.object = objects[result.model].get(result.object_id)
+        # deleted without the signals (e.g. QuerySet.delete())
+        if result.object is None:
+            continue
+        if snippets:
+            result.snippet = result.make_snippet(
+                getattr(result.object, result.field) or u'')
+        ret.append(result)
+    return ret
+
+
+def _update_index (sender, instance, **kwargs):
+    if get_label(sender) not in SEARCH_FIELDS:
+        return
+    index = get_index()
+    if index is not None:
+        index.index_object(instance)
+
+
+def _remove_from_index (sender, instance, **kwargs):
+    if get_label(sender) not in SEARCH_FIELDS:
+        return
+    index = get_index()
+    if index is not None:
+        index.remove_object(instance)
+
+
+signals.post_save.connect(_update_index)
+signals.post_delete.connect(_remove_from_index)
@@ -0,0 +1,4 @@
+-- The commentaries of an edition grouped by element (see commentaries.py).
+-- For an existing table, run:
+-- ./manage.py sqlcustom legal_editions | ./manage.py dbshell
+CREATE INDEX legal_editions_commentary_edition_element_sort_order ON legal_editions_commentary (edition_id, element_id, sort_order);
@@ -0,0 +1,21 @@
+-- Composite index used by the keyset pagination of the FolioImage changelist
+-- (see admin.KeysetChangeList). For an existing table, run:
+-- ./manage.py sqlcustom legal_editions | ./manage.py dbshell
+CREATE INDEX legal_editions_folioimage_batch_path_filename ON legal_editions_folioimage (batch, path, filename, id);
+-- Navigation in the reading order of a manuscript (FolioImage.get_next
+-- and get_previous). Tables created before the reading_order column need:
+-- ALTER TABLE legal_editions_folioimage ADD COLUMN reading_order integer NULL;
+-- then ./manage.py update_reading_order
+CREATE INDEX legal_editions_folioimage_manuscript_reading_order ON legal_editions_folioimage (manuscript_id, reading_order);
+-- Images of the folio (or page) range of a witness (Witness.get_folio_images)
+-- and of a folio (Manuscript.get_folio_image). The index on (manuscript_id,
+-- folio_number) of earlier versions is no longer used:
+-- DROP INDEX legal_editions_folioimage_manuscript_folio_number;
+-- Tables created before the folio_key and page_key columns need:
+-- ALTER TABLE legal_editions_folioimage ADD COLUMN folio_key integer NULL;
+-- ALTER TABLE legal_editions_folioimage ADD COLUMN page_key integer NULL;
+-- ALTER TABLE legal_editions_witness ADD COLUMN range_start_key integer NULL;
+-- ALTER TABLE legal_editions_witness ADD COLUMN range_end_key integer NULL;
+-- then ./manage.py update_folio_keys
+CREATE INDEX legal_editions_folioimage_manuscript_folio_key ON legal_editions_folioimage (manuscript_id, folio_key);
+CREATE INDEX legal_editions_folioimage_manuscript_page_key ON legal_editions_folioimage (manuscript_id, page_key);
@@ -0,0 +1,5 @@
+-- The public catalogue: the listings of an archive, and all the listings in
+-- order of archive and shelf mark (see listings.py). For an existing
+-- database, run syncdb then ./manage.py update_manuscript_listings
+CREATE INDEX legal_editions_manuscriptlisting_archive_shelf_mark ON legal_editions_manuscriptlisting (archive_id, shelf_mark);
+CREATE INDEX legal_editions_manuscriptlisting_catalogue ON legal_editions_manuscriptlisting (hide_from_listings, archive_name, archive_city, shelf_mark);
@@ -0,0 +1,46 @@
+// Search box for the foreign keys rendered by widgets.ForeignKeySearchInput.
+// The results come from the JSON lookup view of the related model's admin:
+// {"results": [{"id": ..., "text": ...}, ...], "more": true|false}
+(function($) {
+    var timer = null;
+
+    function showResults(input, query, page) {
+        $.getJSON(input.attr('data-lookup'), {'q': query, 'page': page}, function(data) {
+            var list = input.next('ul.vForeignKeySearchResults');
+            if (page == 1) {
+                list.remove();
+                list = $('<ul class="vForeignKeySearchResults"></ul>').insertAfter(input);
+            }
+            list.find('li.more').remove();
+            $.each(data.results, function(i, result) {
+                $('<li></li>').text(result.text).data('id', result.id).appendTo(list);
+            });
+            if (data.more) {
+                $('<li class="more">&hellip;</li>').data('page', page + 1).appendTo(list);
+            }
+        });
+    }
+
+    $(document).delegate('input.vForeignKeySearch', 'keyup', function(e) {
+        var input = $(this);
+        var query = $.trim(input.val());
+        if (query == '') {
+            input.prev('input').val('');
+        }
+        clearTimeout(timer);
+        timer = setTimeout(function() { showResults(input, query, 1); }, 250);
+    });
+
+    $(document).delegate('ul.vForeignKeySearchResults li', 'click', function(e) {
+        var item = $(this);
+        var list = item.parent();
+        var input = list.prev('input.vForeignKeySearch');
+        if (item.hasClass('more')) {
+            showResults(input, $.trim(input.val()), item.data('page'));
+            return;
+        }
+        input.prev('input').val(item.data('id'));
+        input.val(item.text());
+        list.remove();
+    });
+})(django.jQuery);
@@ -0,0 +1,287 @@
+"""The stemma: the graph of the VersionRelationships (source -> target)
+between versions.
+
+    from legal_editions import stemma
+    graph = stemma.get_graph()
+    graph.descendants(version.pk)
+    graph.path(source.pk, target.pk)
+    graph.to_dot()
+
+The graph is loaded in one query the first time it is used in a process,
+then reloaded after a VersionRelationship or a Version is saved or
+deleted (signals) in any process sharing the cache, and at least every
+LEGAL_EDITIONS_STEMMA_TIMEOUT seconds (default: 5 minutes).
+
+The transitive closure of the graph is also stored in the database
+(VersionClosure, kept in sync by the same signals), for the queries of
+Version.get_ancestors and get_descendants: a change of a relationship
+only updates the rows from its source and ancestors to its target and
+descendants. Call update_closure() after changes made without signals
+(e.g. QuerySet.update()).
+"""
+
+import random
+import threading
+import time
+from collections import deque
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import get_model, signals
+
+
+class StemmaGraph (object):
+
+    """The versions and relationships of the stemma, in memory. The
+    versions are identified by their primary key."""
+
+    def __init__ (self, versions, edges):
+        # versions: {id: label}, edges: [(source, target, type name)]
+        self.versions = versions
+        self.edges = edges
+        self.children = {}
+        self.parents = {}
+        for source, target, relationship_type in edges:
+            self.children.setdefault(source, []).append(target)
+            self.parents.setdefault(target, []).append(source)
+
+    @classmethod
+    def load (cls, using=None):
+        relationship_model = get_model('legal_editions', 'VersionRelationship')
+        rows = relationship_model.objects.using(using).values_list(
+            'source', 'source__standard_abbreviation', 'target',
+            'target__standard_abbreviation', 'relationship_type__name')
+        versions = {}
+        edges = []
+        for source, source_label, target, target_label, type_name in rows:
+            versions[source] = source_label
+            versions[target] = target_label
+            edges.append((source, target, type_name))
+        return cls(versions, edges)
+
+    def _walk (self, start, neighbours):
+        # breadth first: {version: distance} of the versions reachable
+        # from start, without start
+        distances = {start: 0}
+        queue = deque([start])
+        while queue:
+            current = queue.popleft()
+            for neighbour in neighbours.get(current, ()):
+                if neighbour not in distances:
+                    distances[neighbour] = distances[current] + 1
+                    queue.append(neighbour)
+        del distances[start]
+        return distances
+
+    def descendants (self, version):
+        """Returns {version: number of relationships from version} of the
+        versions derived from version."""
+        return self._walk(version, self.children)
+
+    def ancestors (self, version):
+        """Returns {version: number of relationships to version} of the
+        versions version derives from."""
+        return self._walk(version, self.parents)
+
+    def path (self, source, target, directed=True):
+        """Returns a shortest list of versions from source to target
+        following the relationships (in both directions if directed is
+        False), or None."""
+        if source == target:
+            return [source]
+        neighbours = self.children
+        if not directed:
+            neighbours = {}
+            for version in self.versions:
+                neighbours[version] = (self.children.get(version, []) +
+                                       self.parents.get(version, []))
+        previous = {source: None}
+        queue = deque([source])
+        while queue:
+            current = queue.popleft()
+            for neighbour in neighbours.get(current, ()):
+                if neighbour in previous:
+                    continue
+                previous[neighbour] = current
+                if neighbour == target:
+                    path = [target]
+                    while previous[path[-1]] is not None:
+                        path.append(previous[path[-1]])
+                    path.reverse()
+                    return path
+                queue.append(neighbour)
+        return None
+
+    def roots (self):
+        """Returns the versions that derive from no other version."""
+        return sorted([version for version in self.versions
+                       if not self.parents.get(version)])
+
+    def closure (self):
+        """Returns {(ancestor, descendant): depth} of the transitive
+        closure."""
+        ret = {}
+        for version in self.versions:
+            for descendant, depth in self.descendants(version).items():
+                ret[(version, descendant)] = depth
+        return ret
+
+    def as_dict (self):
+        """Returns the graph as JSON serializable nodes and edges, e.g. for
+        a JavaScript renderer."""
+        return {
+            'nodes': [{'id': version, 'label': label} for version, label in
+                      sorted(self.versions.items())],
+            'edges': [{'source': source, 'target': target,
+                       'type': relationship_type}
+                      for source, target, relationship_type in self.edges],
+            }
+
+    def to_dot (self, name='stemma'):
+        """Returns the graph in the DOT language of Graphviz."""
+        def quote (value):
+            return u'"%s"' % unicode(value).replace(u'\\', u'\\\\').replace(
+                u'"', u'\\"')
+        lines = [u'digraph %s {' % quote(name)]
+        for version, label in sorted(self.versions.items()):
+            lines.append(u'    %d [label=%s];' % (version, quote(label)))
+        for source, target, relationship_type in self.edges:
+            lines.append(u'    %d -> %d [label=%s];' % (
+                    source, target, quote(relationship_type)))
+        lines.append(u'}')
+        return u'\n'.join(lines)
+
+
+_graph = None
+_graph_stamp = None
+_graph_loaded = 0
+_graph_lock = threading.Lock()
+
+STAMP_KEY = 'legal_editions:stemma:stamp'
+
+
+def get_timeout ():
+    # the longest a process keeps its graph, for the changes made without
+    # signals or without a cache shared by the processes
+    return getattr(settings, 'LEGAL_EDITIONS_STEMMA_TIMEOUT', 60 * 5)
+
+
+def get_graph ():
+    """Returns the StemmaGraph of the process, loading it if needed: the
+    first time, after a change in any process sharing the cache (see
+    reset_graph) and after LEGAL_EDITIONS_STEMMA_TIMEOUT seconds."""
+    global _graph, _graph_stamp, _graph_loaded
+    stamp = cache.get(STAMP_KEY)
+    if (_graph is None or stamp != _graph_stamp or
+        time.time() - _graph_loaded > get_timeout()):
+        _graph_lock.acquire()
+        try:
+            _graph = StemmaGraph.load()
+            _graph_stamp = stamp
+            _graph_loaded = time.time()
+        finally:
+            _graph_lock.release()
+    return _graph
+
+
+def reset_graph ():
+    """The graph will be loaded again from the database on next use, in
+    this process and the others sharing the cache."""
+    global _graph
+    _graph = None
+    cache.set(STAMP_KEY, random.random())
+
+
+def _write_closure (rows, closure, using):
+    # brings rows, a queryset of VersionClosure, in line with closure
+    closure_model = get_model('legal_editions', 'VersionClosure')
+    stale = []
+    changes = 0
+    for pk, ancestor, descendant, depth in rows.values_list(
+        'id', 'ancestor', 'descendant', 'depth'):
+        new_depth = closure.pop((ancestor, descendant), None)
+        if new_depth is None:
+            stale.append(pk)
+        elif new_depth != depth:
+            rows.filter(pk=pk).update(depth=new_depth)
+            changes += 1
+    if stale:
+        closure_model.objects.using(using).filter(pk__in=stale).delete()
+    for (ancestor, descendant), depth in closure.items():
+        closure_model(ancestor_id=ancestor, descendant_id=descendant,
+                      depth=depth).save(using=using)
+    return changes + len(stale) + len(closure)
+
+
+def update_closure (graph=None, using=None):
+    """Brings the VersionClosure table in line with the graph: only the
+    rows that changed are written. Returns the number of changes."""
+    closure_model = get_model('legal_editions', 'VersionClosure')
+    if graph is None:
+        graph = StemmaGraph.load(using)
+    return _write_closure(closure_model.objects.using(using), graph.closure(),
+                          using)
+
+
+def update_edge_closure (edges, using=None):
+    """Updates the VersionClosure rows a change of the relationships
+    edges, a list of (source, target) added or removed, can affect: from
+    the source and its ancestors to the target and its descendants,
+    before and after the change. Returns the number of changes."""
+    closure_model = get_model('legal_editions', 'VersionClosure')
+    graph = StemmaGraph.load(using)
+    rows = closure_model.objects.using(using)
+    ancestors = set()
+    descendants = set()
+    for source, target in edges:
+        # the table is the closure before the change, the graph after
+        ancestors.add(source)
+        ancestors.update(graph.ancestors(source))
+        ancestors.update(rows.filter(descendant=source).values_list(
+                'ancestor', flat=True))
+        descendants.add(target)
+        descendants.update(graph.descendants(target))
+        descendants.update(rows.filter(ancestor=target).values_list(
+                'descendant', flat=True))
+    closure = {}
+    for ancestor in ancestors:
+        for descendant, depth in graph.descendants(ancestor).items():
+            if descendant in descendants:
+                closure[(ancestor, descendant)] = depth
+    return _write_closure(rows.filter(ancestor__in=ancestors,
+                                      descendant__in=descendants),
+                          closure, using)
+
+
+def _remember_edge (sender, instance, **kwargs):
+    # the source and target of a relationship before it is changed
+    if (sender._meta.app_label, sender._meta.object_name) != (
+        'legal_editions', 'VersionRelationship') or instance.pk is None:
+        return
+    instance._stemma_edges = list(sender._default_manager.using(
+            kwargs.get('using')).filter(pk=instance.pk).values_list(
+            'source', 'target'))
+
+
+def _update_stemma (sender, instance, **kwargs):
+    label = (sender._meta.app_label, sender._meta.object_name)
+    if label == ('legal_editions', 'VersionRelationship'):
+        reset_graph()
+        edge = (instance.source_id, instance.target_id)
+        edges = [edge]
+        if kwargs.get('signal') is signals.post_save:
+            edges += [old for old in instance.__dict__.pop('_stemma_edges', [])
+                      if old != edge]
+            if not kwargs.get('created') and len(edges) == 1:
+                # only the type changed
+                return
+        update_edge_closure(edges, kwargs.get('using'))
+    elif label == ('legal_editions', 'Version'):
+        # the labels of the versions; their relationships are deleted
+        # with them
+        reset_graph()
+
+
+signals.pre_save.connect(_remember_edge)
+signals.post_save.connect(_update_stemma)
+signals.post_delete.connect(_update_stemma)
@@ -0,0 +1,42 @@
+from django import template
+
+from legal_editions.fragments import get_fragment
+
+
+register = template.Library()
+
+
+class EditionFragmentNode (template.Node):
+
+    def __init__ (self, nodelist, edition, name):
+        self.nodelist = nodelist
+        self.edition = template.Variable(edition)
+        self.name = template.Variable(name)
+
+    def render (self, context):
+        try:
+            edition = self.edition.resolve(context)
+            name = self.name.resolve(context)
+        except template.VariableDoesNotExist:
+            return u''
+        return get_fragment(edition, unicode(name).encode('utf-8'),
+                            lambda edition: self.nodelist.render(context))
+
+
+@register.tag
+def edition_fragment (parser, token):
+    """Caches the content of the tag for an edition, until the edition
+    or its related rows change (see legal_editions.fragments):
+
+        {% edition_fragment edition "text" %}...{% endedition_fragment %}
+
+    The name must be unique among the fragments of an edition and
+    include the values the content depends on, other than the
+    edition."""
+    bits = token.split_contents()
+    if len(bits) != 3:
+        raise template.TemplateSyntaxError(
+            '%r tag requires an edition and a fragment name.' % bits[0])
+    nodelist = parser.parse(('endedition_fragment',))
+    parser.delete_first_token()
+    return EditionFragmentNode(nodelist, bits[1], bits[2])
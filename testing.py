@@ -0,0 +1,93 @@
+"""Helpers for the tests of projects using legal_editions."""
+
+import sys
+
+from django.conf import settings
+from django.core.urlresolvers import reverse
+from django.core.signals import request_started
+from django.db import connections, reset_queries, DEFAULT_DB_ALIAS
+
+
+class MaxQueriesContext (object):
+
+    """Context manager failing a test case if more than num queries are
+    run in its block. See django.test.TestCase.assertNumQueries for an
+    exact count."""
+
+    def __init__ (self, test_case, num, using=DEFAULT_DB_ALIAS):
+        self.test_case = test_case
+        self.num = num
+        self.connection = connections[using]
+
+    def __enter__ (self):
+        self.old_debug_cursor = self.connection.use_debug_cursor
+        self.connection.use_debug_cursor = True
+        # the queries would be reset by each request made in the block
+        request_started.disconnect(reset_queries)
+        self.starting_queries = len(self.connection.queries)
+        return self
+
+    def __exit__ (self, exc_type, exc_value, traceback):
+        self.connection.use_debug_cursor = self.old_debug_cursor
+        request_started.connect(reset_queries)
+        if exc_type is not None:
+            return
+        queries = self.connection.queries[self.starting_queries:]
+        self.test_case.assertTrue(
+            len(queries) <= self.num,
+            '%d queries executed, at most %d expected:\n%s' % (
+                len(queries), self.num,
+                '\n'.join([query['sql'] for query in queries])))
+
+
+def assert_max_queries (test_case, num, func=None, *args, **kwargs):
+    """Asserts that calling func runs at most num queries. Without func,
+    returns a context manager."""
+    using = kwargs.pop('using', DEFAULT_DB_ALIAS)
+    context = MaxQueriesContext(test_case, num, using)
+    if func is None:
+        return context
+    context.__enter__()
+    try:
+        func(*args, **kwargs)
+    except:
+        context.__exit__(*sys.exc_info())
+        raise
+    else:
+        context.__exit__(None, None, None)
+
+
+def assert_changelist_max_queries (test_case, client, model, num, page=0):
+    """Asserts that a page of the admin changelist of model runs at most
+    num queries. client must be logged in as a staff user allowed to
+    change model."""
+    url = reverse('admin:%s_%s_changelist' % (model._meta.app_label,
+                                               model._meta.module_name))
+    context = MaxQueriesContext(test_case, num)
+    context.__enter__()
+    try:
+        response = client.get(url, {'p': page})
+    except:
+        context.__exit__(*sys.exc_info())
+        raise
+    context.__exit__(None, None, None)
+    test_case.assertEqual(response.status_code, 200)
+    return response
+
+
+def call_in_test_database (func, using=DEFAULT_DB_ALIAS):
+    """Returns func() called with the database using replaced by a new
+    test database (created as by the test runner, then destroyed) and
+    without the search index, e.g. for the benchmark commands."""
+    connection = connections[using]
+    # nothing is written to the search index, which isn't part of the
+    # database (see search.get_index)
+    search_index = getattr(settings, 'LEGAL_EDITIONS_SEARCH_INDEX', None)
+    settings.LEGAL_EDITIONS_SEARCH_INDEX = None
+    old_name = connection.creation.create_test_db(verbosity=0,
+                                                  autoclobber=True)
+    try:
+        return func()
+    finally:
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        settings.LEGAL_EDITIONS_SEARCH_INDEX = search_index
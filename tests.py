@@ -0,0 +1,60 @@
+from __future__ import with_statement
+
+from django.test import TestCase
+
+from legal_editions.models import Archive, Edition, EditionStatus, Editor, \
+    Language, Manuscript, Version, Witness, Work
+from legal_editions.testing import MaxQueriesContext
+
+
+class VersionDetailTestCase (TestCase):
+
+    def setUp (self):
+        latin = Language.objects.create(name='Latin')
+        old_english = Language.objects.create(name='Old English')
+        work = Work.objects.create(name='Ine')
+        self.version = Version.objects.create(standard_abbreviation='In',
+                                              work=work)
+        self.version.languages.add(latin, old_english)
+        archive = Archive.objects.create(name='British Library', city='London')
+        status = EditionStatus.objects.create(name='Draft')
+        for i in range(5):
+            manuscript = Manuscript.objects.create(
+                shelf_mark='Cotton %d' % i, sigla='S%d' % (5 - i),
+                archive=archive)
+            witness = Witness.objects.create(manuscript=manuscript, work=work)
+            witness.languages.add(i % 2 and latin or old_english)
+            self.version.witnesses.add(witness)
+            edition = Edition.objects.create(abbreviation='In%d' % i,
+                                             status=status,
+                                             version=self.version)
+            edition.editors.add(Editor.objects.create(abbreviation='ed%d' % i),
+                                Editor.objects.create(abbreviation='co%d' % i))
+
+    def get_page (self, version):
+        # what the version page shows, Editor and Language have no ordering
+        page = [version.get_name(),
+                sorted([language.name for language in
+                        version.get_languages()])]
+        for witness in version.get_witnesses():
+            page.append((unicode(witness), witness.manuscript.sigla,
+                         unicode(witness.manuscript.archive),
+                         sorted([language.name for language in
+                                 witness.get_languages()])))
+        for edition in version.get_editions():
+            page.append((unicode(edition), edition.status.name,
+                         sorted([editor.abbreviation for editor in
+                                 edition.get_editors()])))
+        return page
+
+    def test_get_detail_queries (self):
+        with MaxQueriesContext(self, 6):
+            page = self.get_page(Version.objects.get_detail(
+                    pk=self.version.pk))
+        self.assertEqual(len(page), 2 + 5 + 5)
+
+    def test_get_detail_objects (self):
+        # the same objects as the lazy accessors, in the same order
+        self.assertEqual(
+            self.get_page(Version.objects.get_detail(pk=self.version.pk)),
+            self.get_page(Version.objects.get(pk=self.version.pk)))
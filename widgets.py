@@ -0,0 +1,51 @@
+from django import forms
+from django.core.urlresolvers import reverse
+from django.utils.html import escape
+from django.utils.safestring import mark_safe
+
+
+class ForeignKeySearchInput (forms.TextInput):
+
+    """Widget for a foreign key to a large table. The primary key is
+    kept in a hidden input and the related object is chosen with a
+    search box completed from the lookup view of the related model's
+    admin (see admin.ForeignKeySearchMixin.lookup_view).
+
+    Unlike a <select>, only the current value is read from the
+    database. Not a HiddenInput subclass: the tabular inlines leave out
+    the header of hidden fields."""
+
+    class Media:
+        js = ('legal_editions/js/lookup.js',)
+
+    def __init__ (self, rel, select_related=(), using=None, attrs=None):
+        self.rel = rel
+        self.select_related = select_related
+        self.db = using
+        super(ForeignKeySearchInput, self).__init__(attrs)
+
+    def get_lookup_url (self):
+        opts = self.rel.to._meta
+        return reverse('admin:%s_%s_lookup' % (opts.app_label,
+                                               opts.module_name))
+
+    def label_for_value (self, value):
+        key = self.rel.get_related_field().name
+        qs = self.rel.to._default_manager.using(self.db)
+        if self.select_related:
+            qs = qs.select_related(*self.select_related)
+        try:
+            return unicode(qs.get(**{key: value}))
+        except (ValueError, self.rel.to.DoesNotExist):
+            return u''
+
+    def render (self, name, value, attrs=None):
+        label = u''
+        if value:
+            label = self.label_for_value(value)
+        output = [forms.HiddenInput(self.attrs).render(name, value, attrs)]
+        # The JavaScript looks for the vForeignKeySearch class and stores
+        # the chosen key in the hidden input just before the search box.
+        output.append(u'<input type="text" class="vForeignKeySearch" size="40" autocomplete="off" data-lookup="%s" value="%s" />' % (
+                escape(self.get_lookup_url()), escape(label)))
+        return mark_safe(u''.join(output))